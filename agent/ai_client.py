@@ -1,16 +1,41 @@
 """AI Client - OpenAI API wrapper для анализа кода"""
+import asyncio
 import os
-import json
+import time
+import weakref
+from abc import ABC, abstractmethod
 from pathlib import Path
-from dataclasses import dataclass
-from openai import OpenAI
+from typing import Callable
+from dataclasses import dataclass, field
+from openai import APIConnectionError, AsyncOpenAI, InternalServerError, OpenAI, RateLimitError, Timeout
 from dotenv import load_dotenv
 
+from json_stream import JSONStreamReader, extract_json
+from llm_cache import LLM_CACHE_MAX_MB, LLMCache, cache_key
+from llm_metrics import ParseMetrics
+from quotas import QuotaTracker, current_quota_key
+from rate_limiter import MAX_SLEEP_SECONDS, RateLimiter, estimate_tokens, retry_after_seconds
+
 load_dotenv()
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
 MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+# Сколько раз повторять запрос после 429 (пауза - по Retry-After), 5xx и сетевых ошибок.
+# Встроенные повторы SDK выключены (max_retries=0): они шли мимо rate limiter
+RATE_LIMIT_RETRIES = int(os.getenv("RATE_LIMIT_RETRIES", "3"))
+# Таймауты HTTP запроса к LLM (секунды): чтение ответа и установка соединения
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "120"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+# Сколько запросов AsyncAIClient держит в полёте одновременно
+LLM_ASYNC_CONCURRENCY = int(os.getenv("LLM_ASYNC_CONCURRENCY", "32"))
+# Формат исправлений: patch - search/replace правки, full - файл целиком
+ANALYSIS_RESPONSE_MODE = os.getenv("ANALYSIS_RESPONSE_MODE", "patch")
+# Стримить ответы analyze_file и обрывать генерацию на "issue_found": false
+ANALYSIS_STREAMING = os.getenv("ANALYSIS_STREAMING", "true").lower() == "true"
+# Формат ответов с JSON: text - только промпт, json_object - JSON mode,
+# json_schema - structured outputs по схеме (если провайдер поддерживает)
+LLM_RESPONSE_FORMAT = os.getenv("LLM_RESPONSE_FORMAT", "text")
 
 
 @dataclass
@@ -19,6 +44,10 @@ class AnalysisResult:
     issue_found: bool
     code_correction: str
     explanation: str = ""
+    # Правки [{search, replace}] в режиме patch (code_correction тогда пустой)
+    edits: list[dict] = field(default_factory=list)
+    # Анализ не состоялся (ошибка LLM) - "issue не найден" тут ничего не значит
+    error: bool = False
 
 
 @dataclass
@@ -60,6 +89,87 @@ ANALYSIS_PROMPT = """You are an expert code reviewer. Analyze this file for the
 Return ONLY valid JSON, no markdown, no additional text."""
 
 
+PATCH_PROMPT = """You are an expert code reviewer. Analyze this file for the described issue.
+
+## Issue Description:
+{issue_description}
+
+## File: {filepath}
+```{language}
+{file_content}
+```
+
+## Your Task:
+1. Analyze if this file contains the issue described above
+2. If yes, describe the fix as search/replace edits
+3. If no, indicate that no changes needed
+
+## IMPORTANT:
+- "search" must be copied EXACTLY from the file (whitespace included) and match only one place
+- Include a few unchanged lines around the change so the search block is unique
+- "replace" is the new text for that block; use an empty string to delete it
+- Edits are applied in order; do NOT return the whole file
+- Follow best practices (PEP8 for Python, etc.)
+
+## Response Format (JSON only):
+{{
+    "issue_found": true/false,
+    "edits": [{{"search": "exact lines from the file", "replace": "corrected lines"}}],
+    "explanation": "Brief explanation of what was found/fixed"
+}}
+
+Return ONLY valid JSON, no markdown, no additional text."""
+
+
+REPAIR_PROMPT = """Your previous response could not be parsed: {error}
+
+Return the same answer again as a single valid JSON object in the requested format.
+Return ONLY valid JSON, no markdown, no additional text."""
+
+
+def object_schema(**properties) -> dict:
+    """JSON schema объекта для strict structured outputs: все поля обязательны."""
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+ANALYSIS_SCHEMA = object_schema(
+    issue_found={"type": "boolean"},
+    code_correction={"type": "string"},
+    explanation={"type": "string"},
+)
+
+PATCH_SCHEMA = object_schema(
+    issue_found={"type": "boolean"},
+    edits={
+        "type": "array",
+        "items": object_schema(search={"type": "string"}, replace={"type": "string"}),
+    },
+    explanation={"type": "string"},
+)
+
+REVIEW_SCHEMA = object_schema(
+    approved={"type": "boolean"},
+    summary={"type": "string"},
+    issues={"type": "array", "items": {"type": "string"}},
+    suggestions={"type": "array", "items": {"type": "string"}},
+    score={"type": "integer"},
+)
+
+
+def json_response_format(name: str, schema: dict) -> dict | None:
+    """response_format запроса по LLM_RESPONSE_FORMAT (None - обычный текст)."""
+    if LLM_RESPONSE_FORMAT == "json_schema":
+        return {"type": "json_schema", "json_schema": {"name": name, "schema": schema, "strict": True}}
+    if LLM_RESPONSE_FORMAT == "json_object":
+        return {"type": "json_object"}
+    return None
+
+
 REVIEW_PROMPT = """You are an expert code reviewer. Review this Pull Request thoroughly.
 
 {issue_context}
@@ -92,23 +202,97 @@ Return ONLY valid JSON:
 }}"""
 
 
-class AIClient:
-    """OpenAI client для анализа кода и ревью"""
+def strip_code_fence(response: str) -> str:
+    """Убирает markdown обёртку ```...``` вокруг ответа."""
+    response = response.strip()
+    if response.startswith("```"):
+        response = response.split("\n", 1)[1]
+        response = response.rsplit("```", 1)[0]
+    return response
+
+
+def stop_on_no_issue() -> Callable[[str], bool]:
+    """stop_when для analyze_file: обрывает стрим, как только пришло "issue_found": false.
+    
+    После "issue_found": true стрим дочитывается целиком, а текст больше
+    не разбирается - исправление нужно полностью.
+    """
+    reader = JSONStreamReader()
+    
+    def stop_when(chunk: str) -> bool:
+        if "issue_found" in reader.values:
+            return False
+        return reader.feed(chunk).get("issue_found") is False
+    
+    return stop_when
+
+
+class BaseAIClient(ABC):
+    """Общая часть AIClient и AsyncAIClient.
+    
+    Только синхронные методы без запросов к LLM: промпты, разбор
+    ответов, кэш, rate limiter и квоты. Запросы (_call, _call_json,
+    analyze_file, ...) у подклассов свои: у AIClient блокирующие, у
+    AsyncAIClient - корутины.
+    """
     
     def __init__(self):
-        self.client = OpenAI(
-            api_key=OPENAI_API_KEY,
-            base_url=OPENAI_BASE_URL
-        )
+        self.client = self._create_client()
         self.model = MODEL
+        # Общий бюджет RPM/TPM для server, worker и pr_review_worker
+        self.rate_limiter = RateLimiter()
+        # Расход токенов по installations (дневные квоты, см. quotas.py)
+        self.quota = QuotaTracker()
+        # Ответы на уже отправленные промпты (повторы задач, requeue)
+        self.cache = LLMCache() if LLM_CACHE_MAX_MB else None
+        # Доля ответов, которые не разобрались как JSON (GET /stats/llm-parse)
+        self.parse_metrics = ParseMetrics()
     
-    def _call(self, messages: list, temperature: float = 0.3) -> str:
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            temperature=temperature
-        )
-        return response.choices[0].message.content
+    @abstractmethod
+    def _create_client(self):
+        """OpenAI или AsyncOpenAI клиент - задаёт подкласс."""
+    
+    def forget(self, messages: list, temperature: float = 0.3) -> None:
+        """Убирает ответ из кэша - он не разобрался, повтор должен уйти в LLM."""
+        if self.cache is not None:
+            self.cache.delete(cache_key(self.model, temperature, messages))
+    
+    def _remember(self, messages: list, temperature: float, response: str) -> None:
+        """Кладёт исправленный (repair) ответ в кэш под исходный промпт."""
+        if self.cache is not None:
+            self.cache.put(cache_key(self.model, temperature, messages), response)
+    
+    def _repair_messages(self, messages: list, response: str, error: Exception) -> list:
+        return messages + [
+            {"role": "assistant", "content": response},
+            {"role": "user", "content": REPAIR_PROMPT.format(error=error)},
+        ]
+    
+    def _stream_args(self, stop_when: Callable[[str], bool] = None, response_format: dict = None) -> dict:
+        """Аргументы chat.completions.create: стрим (если есть stop_when) и формат ответа."""
+        stream_args = {"stream": True, "stream_options": {"include_usage": True}} if stop_when else {}
+        if response_format:
+            stream_args["response_format"] = response_format
+        return stream_args
+    
+    def _pause_after_429(self, error: RateLimitError, attempt: int) -> None:
+        """Пауза для всех процессов, а не только для этого запроса."""
+        delay = retry_after_seconds(getattr(error.response, "headers", None), default=2.0 ** attempt)
+        print(f"⏳ LLM rate limited (429), pausing all calls for {delay:.1f}s")
+        self.rate_limiter.block(delay)
+    
+    def _transient_delay(self, error: Exception, attempt: int) -> float:
+        """Пауза перед повтором после 5xx или сетевой ошибки (только этот запрос)."""
+        delay = 2.0 ** attempt
+        print(f"⏳ LLM request failed ({type(error).__name__}), retrying in {delay:.0f}s")
+        return delay
+    
+    def _record_usage(self, estimated_tokens: int, total_tokens: int | None) -> None:
+        """Уточняет rate limiter и списывает токены с квоты installation."""
+        if total_tokens:
+            self.rate_limiter.record_usage(estimated_tokens, total_tokens)
+            # Вне задачи (quota_scope) расход ни на кого не списывается
+            self.quota.record(current_quota_key(), total_tokens)
     
     def _get_language(self, filepath: Path) -> str:
         ext_map = {
@@ -133,50 +317,49 @@ class AIClient:
         }
         return ext_map.get(filepath.suffix, filepath.suffix.lstrip("."))
     
-    def analyze_file(
+    def _analysis_messages(
         self,
         filepath: Path,
         file_content: str,
-        issue_description: str
-    ) -> AnalysisResult:
-        """Анализирует файл на наличие issue."""
-        language = self._get_language(filepath)
-        
-        prompt = ANALYSIS_PROMPT.format(
+        issue_description: str,
+        mode: str = None
+    ) -> list:
+        prompt = (PATCH_PROMPT if (mode or ANALYSIS_RESPONSE_MODE) == "patch" else ANALYSIS_PROMPT).format(
             issue_description=issue_description,
             filepath=str(filepath),
-            language=language,
+            language=self._get_language(filepath),
             file_content=file_content
         )
-        
-        print(f"🔍 Analyzing {filepath.name}...")
-        
+        return [{"role": "user", "content": prompt}]
+    
+    def _analysis_schema(self, mode: str = None) -> dict:
+        return PATCH_SCHEMA if (mode or ANALYSIS_RESPONSE_MODE) == "patch" else ANALYSIS_SCHEMA
+    
+    def _parse_analysis(self, response: str) -> AnalysisResult:
         try:
-            response = self._call([{"role": "user", "content": prompt}], temperature=0.2)
-            response = response.strip()
-            if response.startswith("```"):
-                response = response.split("\n", 1)[1]
-                response = response.rsplit("```", 1)[0]
-            
-            data = json.loads(response)
-            return AnalysisResult(
-                issue_found=data.get("issue_found", False),
-                code_correction=data.get("code_correction", ""),
-                explanation=data.get("explanation", "")
-            )
-        except Exception as e:
-            print(f"❌ Analysis failed: {e}")
-            return AnalysisResult(issue_found=False, code_correction="", explanation=str(e))
+            data = extract_json(response)
+        except ValueError:
+            # Генерация оборвана на "issue_found": false - остальное не нужно
+            data = JSONStreamReader().feed(response)
+            if data.get("issue_found") is not False:
+                raise
+        if not isinstance(data.get("issue_found"), bool):
+            raise ValueError('"issue_found" must be true or false')
+        return AnalysisResult(
+            issue_found=data["issue_found"],
+            code_correction=data.get("code_correction", ""),
+            explanation=data.get("explanation", ""),
+            edits=data.get("edits") or []
+        )
     
-    def review_pr(
+    def _review_messages(
         self,
         diff: str,
         changed_files: list[str],
         issue_context: str = "",
         linter_output: str = "",
         test_output: str = ""
-    ) -> ReviewResult:
-        """Ревью Pull Request."""
+    ) -> list:
         prompt = REVIEW_PROMPT.format(
             issue_context=issue_context or "No linked issue",
             changed_files=", ".join(changed_files),
@@ -184,33 +367,26 @@ class AIClient:
             linter_output=linter_output[:2000],
             test_output=test_output[:2000]
         )
-        
-        try:
-            response = self._call([{"role": "user", "content": prompt}], temperature=0.2)
-            response = response.strip()
-            if response.startswith("```"):
-                response = response.split("\n", 1)[1]
-                response = response.rsplit("```", 1)[0]
-            
-            data = json.loads(response)
-            return ReviewResult(
-                approved=data.get("approved", False),
-                summary=data.get("summary", ""),
-                issues=data.get("issues", []),
-                suggestions=data.get("suggestions", [])
-            )
-        except Exception as e:
-            print(f"❌ Review failed: {e}")
-            return ReviewResult(approved=False, summary=str(e), issues=[], suggestions=[])
+        return [{"role": "user", "content": prompt}]
     
-    def generate_code(
+    def _parse_review(self, response: str) -> ReviewResult:
+        data = extract_json(response)
+        if not isinstance(data.get("approved"), bool):
+            raise ValueError('"approved" must be true or false')
+        return ReviewResult(
+            approved=data["approved"],
+            summary=data.get("summary", ""),
+            issues=data.get("issues", []),
+            suggestions=data.get("suggestions", [])
+        )
+    
+    def _code_messages(
         self,
         file_path: str,
         requirements: str,
         existing_code: str = "",
         issue_context: str = ""
-    ) -> str:
-        """Генерирует или модифицирует код."""
+    ) -> list:
         system_prompt = """You are an expert Python developer. 
 Generate clean, production-ready code.
 Follow PEP8, use type hints, add docstrings.
@@ -227,18 +403,455 @@ Issue context: {issue_context}
 
 Return ONLY the complete Python code."""
         
-        response = self._call([
+        return [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt}
-        ], temperature=0.2)
+        ]
+
+
+class AIClient(BaseAIClient):
+    """OpenAI client для анализа кода и ревью"""
+    
+    def _create_client(self):
+        return OpenAI(
+            api_key=OPENAI_API_KEY,
+            base_url=OPENAI_BASE_URL,
+            timeout=Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+            # Повторы только в _request: каждый проходит через общий rate limiter
+            max_retries=0
+        )
+    
+    def _call(
+        self,
+        messages: list,
+        temperature: float = 0.3,
+        stop_when: Callable[[str], bool] = None,
+        response_format: dict = None
+    ) -> str:
+        """Запрос к LLM (или ответ из кэша).
+        
+        Args:
+            stop_when: Получает каждый кусок стримингового ответа; True -
+                генерация обрывается и возвращается полученный префикс.
+                Без stop_when ответ приходит целиком, без стрима.
+            response_format: JSON mode / structured outputs (json_response_format)
+        """
+        if self.cache is None:
+            return self._request(messages, temperature, stop_when, response_format)
+        
+        key = cache_key(self.model, temperature, messages)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        # Оборванный ответ кэшируется как есть - вызывающий его уже разбирал
+        response = self._request(messages, temperature, stop_when, response_format)
+        if response:
+            self.cache.put(key, response)
+        return response
+    
+    def _call_json(
+        self,
+        messages: list,
+        parse: Callable[[str], object],
+        kind: str,
+        schema: dict,
+        temperature: float = 0.2,
+        stop_when: Callable[[str], bool] = None
+    ):
+        """Запрос, ответ которого - JSON; один repair запрос, если ответ не разобрался.
+        
+        Args:
+            parse: Разбирает текст ответа, ValueError - ответ не годится
+            kind: Вид ответа для метрик и имя схемы (analysis, review, ...)
+            schema: JSON schema ответа для LLM_RESPONSE_FORMAT=json_schema
         
-        response = response.strip()
-        if response.startswith("```"):
-            response = response.split("\n", 1)[1]
-            response = response.rsplit("```", 1)[0]
+        Returns:
+            Результат parse
         
+        Raises:
+            ValueError: ответ не разобрался и после repair запроса
+        """
+        response_format = json_response_format(kind, schema)
+        response = self._call(messages, temperature, stop_when, response_format)
+        try:
+            result = parse(response)
+        except ValueError as e:
+            print(f"⚠️ Unparseable {kind} response ({e}), asking the model to repair it")
+            self.forget(messages, temperature)
+            repair_messages = self._repair_messages(messages, response, e)
+            response = self._call(repair_messages, temperature, response_format=response_format)
+            try:
+                result = parse(response)
+            except ValueError:
+                self.forget(repair_messages, temperature)
+                self.parse_metrics.record(kind, "failed")
+                raise
+            self.parse_metrics.record(kind, "repaired")
+            self._remember(messages, temperature, response)
+            return result
+        self.parse_metrics.record(kind, "ok")
+        return result
+    
+    def _request(
+        self,
+        messages: list,
+        temperature: float,
+        stop_when: Callable[[str], bool] = None,
+        response_format: dict = None
+    ) -> str:
+        estimated_tokens = estimate_tokens(messages)
+        stream_args = self._stream_args(stop_when, response_format)
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            waited = self.rate_limiter.acquire(estimated_tokens)
+            if waited >= 1:
+                print(f"⏳ Rate limit: waited {waited:.1f}s for LLM budget")
+            try:
+                response = self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    temperature=temperature,
+                    **stream_args
+                )
+            except RateLimitError as e:
+                if attempt == RATE_LIMIT_RETRIES:
+                    raise
+                self._pause_after_429(e, attempt)
+                continue
+            except (APIConnectionError, InternalServerError) as e:
+                if attempt == RATE_LIMIT_RETRIES:
+                    raise
+                time.sleep(self._transient_delay(e, attempt))
+                continue
+            
+            if stop_when:
+                content, total_tokens = self._read_stream(response, stop_when)
+                if total_tokens is None:
+                    # Стрим оборван до usage - считаем промпт и полученный префикс
+                    total_tokens = estimate_tokens(messages, completion_tokens=len(content) // 4)
+            else:
+                content = response.choices[0].message.content
+                total_tokens = response.usage.total_tokens if response.usage else None
+            self._record_usage(estimated_tokens, total_tokens)
+            return content
+    
+    def _read_stream(self, stream, stop_when: Callable[[str], bool]) -> tuple[str, int | None]:
+        """Собирает стриминговый ответ, пока stop_when не попросит оборвать.
+        
+        Закрытие стрима разрывает HTTP соединение - провайдер перестаёт
+        генерировать (и тарифицировать) остаток ответа.
+        
+        Returns:
+            (текст, total_tokens из usage или None, если стрим оборван)
+        """
+        parts = []
+        total_tokens = None
+        try:
+            for chunk in stream:
+                if chunk.usage:
+                    total_tokens = chunk.usage.total_tokens
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                delta = chunk.choices[0].delta.content
+                parts.append(delta)
+                if stop_when(delta):
+                    break
+        finally:
+            stream.close()
+        return "".join(parts), total_tokens
+    
+    def analyze_file(
+        self,
+        filepath: Path,
+        file_content: str,
+        issue_description: str,
+        mode: str = None
+    ) -> AnalysisResult:
+        """Анализирует файл на наличие issue.
+        
+        Args:
+            mode: patch - модель возвращает правки (edits), full - файл
+                целиком (code_correction); по умолчанию ANALYSIS_RESPONSE_MODE
+        """
+        messages = self._analysis_messages(filepath, file_content, issue_description, mode)
+        schema = self._analysis_schema(mode)
+        print(f"🔍 Analyzing {filepath.name}...")
+        
+        try:
+            stop_when = stop_on_no_issue() if ANALYSIS_STREAMING else None
+            return self._call_json(messages, self._parse_analysis, "analysis", schema, stop_when=stop_when)
+        except Exception as e:
+            print(f"❌ Analysis failed: {e}")
+            return AnalysisResult(issue_found=False, code_correction="", explanation=str(e), error=True)
+    
+    def review_pr(
+        self,
+        diff: str,
+        changed_files: list[str],
+        issue_context: str = "",
+        linter_output: str = "",
+        test_output: str = ""
+    ) -> ReviewResult:
+        """Ревью Pull Request."""
+        messages = self._review_messages(diff, changed_files, issue_context, linter_output, test_output)
+        try:
+            return self._call_json(messages, self._parse_review, "review", REVIEW_SCHEMA)
+        except Exception as e:
+            print(f"❌ Review failed: {e}")
+            return ReviewResult(approved=False, summary=str(e), issues=[], suggestions=[])
+    
+    def generate_code(
+        self,
+        file_path: str,
+        requirements: str,
+        existing_code: str = "",
+        issue_context: str = ""
+    ) -> str:
+        """Генерирует или модифицирует код."""
+        messages = self._code_messages(file_path, requirements, existing_code, issue_context)
+        return strip_code_fence(self._call(messages, temperature=0.2))
+
+
+class AsyncAIClient(BaseAIClient):
+    """AIClient для asyncio: запросы к LLM не блокируют event loop.
+    
+    Все запросы event loop идут через один AsyncOpenAI - общий пул
+    keep-alive соединений, поэтому экземпляр берётся через
+    get_async_ai_client(). Semaphore и пул привязаны к loop, в котором
+    использованы впервые: в другом loop нужен свой экземпляр. Промпты, разбор ответов, кэш, rate limiter и
+    квоты - общие с AIClient (BaseAIClient); обращения к их SQLite файлам
+    выполняются в потоках, ожидание бюджета - asyncio.sleep. В полёте не
+    больше concurrency запросов.
+    
+    Отмена задачи, ждущей ответа, закрывает HTTP запрос. timeout у
+    методов - предел на весь вызов (ожидание бюджета, повторы после 429
+    и стрим): по его истечении запрос отменяется, а метод возвращает
+    результат с ошибкой, как при любом сбое LLM.
+    """
+    
+    def __init__(self, concurrency: int = LLM_ASYNC_CONCURRENCY):
+        super().__init__()
+        self.semaphore = asyncio.Semaphore(max(1, concurrency))
+    
+    def _create_client(self):
+        return AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            base_url=OPENAI_BASE_URL,
+            timeout=Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+            # Повторы только в _request: каждый проходит через общий rate limiter
+            max_retries=0
+        )
+    
+    async def aclose(self) -> None:
+        """Закрывает пул соединений."""
+        await self.client.close()
+    
+    async def _call(
+        self,
+        messages: list,
+        temperature: float = 0.3,
+        stop_when: Callable[[str], bool] = None,
+        response_format: dict = None,
+        timeout: float = None
+    ) -> str:
+        """Запрос к LLM (или ответ из кэша), см. AIClient._call.
+        
+        Args:
+            timeout: Предел на весь вызов в секундах (None - без предела)
+        """
+        if timeout:
+            return await asyncio.wait_for(self._call(messages, temperature, stop_when, response_format), timeout)
+        if self.cache is None:
+            return await self._request(messages, temperature, stop_when, response_format)
+        
+        key = cache_key(self.model, temperature, messages)
+        cached = await asyncio.to_thread(self.cache.get, key)
+        if cached is not None:
+            return cached
+        response = await self._request(messages, temperature, stop_when, response_format)
+        if response:
+            await asyncio.to_thread(self.cache.put, key, response)
         return response
+    
+    async def _call_json(
+        self,
+        messages: list,
+        parse: Callable[[str], object],
+        kind: str,
+        schema: dict,
+        temperature: float = 0.2,
+        stop_when: Callable[[str], bool] = None,
+        timeout: float = None
+    ):
+        """Запрос с JSON ответом и одним repair запросом, см. AIClient._call_json.
+        
+        Args:
+            timeout: Предел на весь вызов, включая repair запрос
+        """
+        if timeout:
+            return await asyncio.wait_for(
+                self._call_json(messages, parse, kind, schema, temperature, stop_when), timeout
+            )
+        response_format = json_response_format(kind, schema)
+        response = await self._call(messages, temperature, stop_when, response_format)
+        try:
+            result = parse(response)
+        except ValueError as e:
+            print(f"⚠️ Unparseable {kind} response ({e}), asking the model to repair it")
+            await asyncio.to_thread(self.forget, messages, temperature)
+            repair_messages = self._repair_messages(messages, response, e)
+            response = await self._call(repair_messages, temperature, response_format=response_format)
+            try:
+                result = parse(response)
+            except ValueError:
+                await asyncio.to_thread(self.forget, repair_messages, temperature)
+                await asyncio.to_thread(self.parse_metrics.record, kind, "failed")
+                raise
+            await asyncio.to_thread(self.parse_metrics.record, kind, "repaired")
+            await asyncio.to_thread(self._remember, messages, temperature, response)
+            return result
+        await asyncio.to_thread(self.parse_metrics.record, kind, "ok")
+        return result
+    
+    async def _acquire(self, tokens: int) -> float:
+        """Ждёт бюджет rate limiter, не занимая поток: пока бюджета нет - asyncio.sleep.
+        
+        Returns:
+            Сколько секунд пришлось ждать
+        """
+        started = time.monotonic()
+        while True:
+            wait = await asyncio.to_thread(self.rate_limiter.try_acquire, tokens)
+            if not wait:
+                return time.monotonic() - started
+            await asyncio.sleep(min(wait, MAX_SLEEP_SECONDS))
+    
+    async def _request(
+        self,
+        messages: list,
+        temperature: float,
+        stop_when: Callable[[str], bool] = None,
+        response_format: dict = None
+    ) -> str:
+        estimated_tokens = estimate_tokens(messages)
+        stream_args = self._stream_args(stop_when, response_format)
+        async with self.semaphore:
+            for attempt in range(RATE_LIMIT_RETRIES + 1):
+                waited = await self._acquire(estimated_tokens)
+                if waited >= 1:
+                    print(f"⏳ Rate limit: waited {waited:.1f}s for LLM budget")
+                try:
+                    response = await self.client.chat.completions.create(
+                        model=self.model,
+                        messages=messages,
+                        temperature=temperature,
+                        **stream_args
+                    )
+                except RateLimitError as e:
+                    if attempt == RATE_LIMIT_RETRIES:
+                        raise
+                    await asyncio.to_thread(self._pause_after_429, e, attempt)
+                    continue
+                except (APIConnectionError, InternalServerError) as e:
+                    if attempt == RATE_LIMIT_RETRIES:
+                        raise
+                    await asyncio.sleep(self._transient_delay(e, attempt))
+                    continue
+                
+                if stop_when:
+                    content, total_tokens = await self._read_stream(response, stop_when)
+                    if total_tokens is None:
+                        total_tokens = estimate_tokens(messages, completion_tokens=len(content) // 4)
+                else:
+                    content = response.choices[0].message.content
+                    total_tokens = response.usage.total_tokens if response.usage else None
+                await asyncio.to_thread(self._record_usage, estimated_tokens, total_tokens)
+                return content
+    
+    async def _read_stream(self, stream, stop_when: Callable[[str], bool]) -> tuple[str, int | None]:
+        """Асинхронный вариант AIClient._read_stream."""
+        parts = []
+        total_tokens = None
+        try:
+            async for chunk in stream:
+                if chunk.usage:
+                    total_tokens = chunk.usage.total_tokens
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                delta = chunk.choices[0].delta.content
+                parts.append(delta)
+                if stop_when(delta):
+                    break
+        finally:
+            await stream.close()
+        return "".join(parts), total_tokens
+    
+    async def analyze_file(
+        self,
+        filepath: Path,
+        file_content: str,
+        issue_description: str,
+        mode: str = None,
+        timeout: float = None
+    ) -> AnalysisResult:
+        """Анализирует файл на наличие issue (см. AIClient.analyze_file)."""
+        messages = self._analysis_messages(filepath, file_content, issue_description, mode)
+        schema = self._analysis_schema(mode)
+        print(f"🔍 Analyzing {filepath.name}...")
+        
+        try:
+            stop_when = stop_on_no_issue() if ANALYSIS_STREAMING else None
+            return await self._call_json(
+                messages, self._parse_analysis, "analysis", schema, stop_when=stop_when, timeout=timeout
+            )
+        except Exception as e:
+            print(f"❌ Analysis failed: {e!r}")
+            return AnalysisResult(issue_found=False, code_correction="", explanation=repr(e), error=True)
+    
+    async def review_pr(
+        self,
+        diff: str,
+        changed_files: list[str],
+        issue_context: str = "",
+        linter_output: str = "",
+        test_output: str = "",
+        timeout: float = None
+    ) -> ReviewResult:
+        """Ревью Pull Request (см. AIClient.review_pr)."""
+        messages = self._review_messages(diff, changed_files, issue_context, linter_output, test_output)
+        try:
+            return await self._call_json(messages, self._parse_review, "review", REVIEW_SCHEMA, timeout=timeout)
+        except Exception as e:
+            print(f"❌ Review failed: {e!r}")
+            return ReviewResult(approved=False, summary=repr(e), issues=[], suggestions=[])
+    
+    async def generate_code(
+        self,
+        file_path: str,
+        requirements: str,
+        existing_code: str = "",
+        issue_context: str = "",
+        timeout: float = None
+    ) -> str:
+        """Генерирует или модифицирует код (см. AIClient.generate_code)."""
+        messages = self._code_messages(file_path, requirements, existing_code, issue_context)
+        return strip_code_fence(await self._call(messages, temperature=0.2, timeout=timeout))
 
 
 # Singleton instance
 ai_client = AIClient()
+
+# AsyncAIClient на каждый event loop; закрытый loop уходит из словаря вместе с клиентом
+_async_ai_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_ai_client() -> AsyncAIClient:
+    """AsyncAIClient текущего event loop (один пул соединений на loop).
+    
+    Вызывается внутри корутины. Следующий asyncio.run получает новый
+    клиент - semaphore и соединения старого привязаны к закрытому loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_ai_clients.get(loop)
+    if client is None:
+        client = _async_ai_clients[loop] = AsyncAIClient()
+    return client
@@ -0,0 +1,177 @@
+"""Archive - холодное хранилище завершённых задач (сжатые JSONL сегменты)"""
+import fcntl
+import gzip
+import json
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+from storage import _is_many, _plain
+
+# Размер сегмента, после которого начинается следующий ({table}-000002.jsonl.gz)
+ARCHIVE_SEGMENT_BYTES = int(os.getenv("ARCHIVE_SEGMENT_BYTES", str(8 * 1024 * 1024)))
+
+
+class Archive:
+    """Append-only архив записей, вынесенных из горячих таблиц.
+
+    Каждая таблица пишется в свою серию сегментов. Запись - один
+    gzip member на пачку, поэтому дописывание не перечитывает сегмент.
+
+    Для таблиц из index_fields рядом ведётся индекс {table}.index.jsonl:
+    ключ записи (например, repo + номер) -> сегмент. Поиск по ключу
+    распаковывает только сегменты, где запись есть, а промах не
+    распаковывает ничего.
+    """
+
+    def __init__(self, directory: str, index_fields: dict = None):
+        """
+        Args:
+            directory: Каталог архива
+            index_fields: {table: (поле, ...)} - ключ записи в индексе
+        """
+        self.directory = Path(directory)
+        self.index_fields = index_fields or {}
+        # Прочитанная часть индекса: {table: (размер файла, {ключ: [сегменты]})}
+        self._indexes = {}
+        self._index_lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self, mode: int):
+        """Блокировка архива между процессами (LOCK_EX - запись, LOCK_SH - чтение)."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.directory / ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def segments(self, table: str) -> list[Path]:
+        """Сегменты таблицы от старых к новым."""
+        return sorted(self.directory.glob(f"{table}-*.jsonl.gz"))
+
+    def _index_path(self, table: str) -> Path:
+        return self.directory / f"{table}.index.jsonl"
+
+    def _index_entries(self, table: str, docs: list, segment: str) -> list[str]:
+        fields = self.index_fields[table]
+        return [
+            json.dumps({"key": [doc.get(field) for field in fields], "segment": segment}, ensure_ascii=False) + "\n"
+            for doc in docs
+            if all(doc.get(field) is not None for field in fields)
+        ]
+
+    def _write_index(self, table: str, docs: list, segment: str) -> None:
+        """Дописывает ключи записей в индекс (под LOCK_EX)."""
+        with open(self._index_path(table), "a", encoding="utf-8") as f:
+            f.writelines(self._index_entries(table, docs, segment))
+
+    def _build_index(self, table: str) -> None:
+        """Строит индекс архива, записанного до появления индекса (под LOCK_EX)."""
+        if self._index_path(table).exists() or not self.segments(table):
+            return
+        entries = []
+        for path in self.segments(table):
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                docs = [json.loads(line) for line in f]
+            entries.extend(self._index_entries(table, docs, path.name))
+        tmp = self._index_path(table).with_suffix(".tmp")
+        tmp.write_text("".join(entries), encoding="utf-8")
+        tmp.replace(self._index_path(table))
+
+    def _ensure_index(self, table: str) -> None:
+        if not self._index_path(table).exists() and self.segments(table):
+            with self._locked(fcntl.LOCK_EX):
+                self._build_index(table)
+
+    def _load_index(self, table: str) -> dict:
+        """Индекс {ключ: сегменты}; дочитывается только добавленный хвост файла."""
+        path = self._index_path(table)
+        if not path.exists():
+            return {}
+        with self._index_lock:
+            return self._read_index_tail(table, path)
+
+    def _read_index_tail(self, table: str, path: Path) -> dict:
+        size, index = self._indexes.get(table, (0, {}))
+        if path.stat().st_size < size:
+            size, index = 0, {}
+        with open(path, "rb") as f:
+            f.seek(size)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # строка дописывается прямо сейчас
+                entry = json.loads(line)
+                segments = index.setdefault(tuple(entry["key"]), [])
+                if entry["segment"] not in segments:
+                    segments.append(entry["segment"])
+                size += len(line)
+        self._indexes[table] = (size, index)
+        return index
+
+    def append(self, table: str, docs: list) -> Path | None:
+        """Дописывает записи в текущий сегмент (или открывает новый).
+
+        Returns:
+            Путь сегмента, None если записей нет
+        """
+        if not docs:
+            return None
+        with self._locked(fcntl.LOCK_EX):
+            segments = self.segments(table)
+            if segments and segments[-1].stat().st_size < ARCHIVE_SEGMENT_BYTES:
+                path = segments[-1]
+            else:
+                seq = int(segments[-1].name.split("-")[-1].split(".")[0]) + 1 if segments else 1
+                path = self.directory / f"{table}-{seq:06d}.jsonl.gz"
+            # Индекс - до сегмента: после сбоя между записями индекс
+            # укажет на сегмент без записи, но не потеряет её
+            if table in self.index_fields:
+                self._build_index(table)
+                self._write_index(table, docs, path.name)
+            with gzip.open(path, "at", encoding="utf-8") as f:
+                for doc in docs:
+                    f.write(json.dumps(doc, ensure_ascii=False) + "\n")
+            return path
+
+    def find(self, table: str, **filters) -> dict | None:
+        """Самая свежая архивная запись, подходящая под фильтры.
+
+        Если фильтры задают ключ индекса, читаются только сегменты с этим
+        ключом. Сегменты читаются от новых к старым - обычно поиск
+        заканчивается на первом же сегменте.
+        """
+        fields = self.index_fields.get(table, ())
+        key = None
+        if fields and all(field in filters and not _is_many(filters[field]) for field in fields):
+            self._ensure_index(table)
+            key = tuple(_plain(filters[field]) for field in fields)
+
+        with self._locked(fcntl.LOCK_SH):
+            paths = self.segments(table)
+            if key is not None:
+                indexed = set(self._load_index(table).get(key, ()))
+                paths = [path for path in paths if path.name in indexed]
+            for path in reversed(paths):
+                match = None
+                with gzip.open(path, "rt", encoding="utf-8") as f:
+                    for line in f:
+                        doc = json.loads(line)
+                        if self._matches(doc, filters):
+                            match = doc  # в сегменте дальше - новее
+                if match is not None:
+                    match["archived"] = True
+                    return match
+        return None
+
+    def _matches(self, doc: dict, filters: dict) -> bool:
+        for field, value in filters.items():
+            actual = doc.get(field)
+            if _is_many(value):
+                if actual not in [_plain(v) for v in value]:
+                    return False
+            elif actual != _plain(value):
+                return False
+        return True
@@ -0,0 +1,55 @@
+"""Autoscale - размер пула воркеров по глубине очереди (с гистерезисом)"""
+import math
+import os
+
+# Сколько задач (pending + в работе) приходится на один процесс пула
+AUTOSCALE_JOBS_PER_WORKER = int(os.getenv("AUTOSCALE_JOBS_PER_WORKER", "2"))
+# Сколько секунд нагрузка должна быть низкой, прежде чем пул уменьшится
+AUTOSCALE_DOWN_DELAY = int(os.getenv("AUTOSCALE_DOWN_DELAY", "120"))
+# Как часто пул смотрит на очередь (секунды)
+AUTOSCALE_INTERVAL = int(os.getenv("AUTOSCALE_INTERVAL", "5"))
+
+
+class Autoscaler:
+    """Решает, сколько процессов нужно пулу.
+
+    Рост - сразу, как только задач больше, чем jobs_per_worker на
+    процесс: пачка issues после разбора не ждёт. Уменьшение - только
+    если нагрузка оставалась низкой down_delay секунд подряд, иначе
+    пул дёргался бы на каждой паузе между webhooks.
+    """
+
+    def __init__(
+        self,
+        min_workers: int,
+        max_workers: int,
+        jobs_per_worker: int = AUTOSCALE_JOBS_PER_WORKER,
+        down_delay: float = AUTOSCALE_DOWN_DELAY
+    ):
+        self.min_workers = min_workers
+        self.max_workers = max(max_workers, min_workers)
+        self.jobs_per_worker = max(1, jobs_per_worker)
+        self.down_delay = down_delay
+        self._low_since = None
+
+    def desired(self, pending: int, active: int, current: int, now: float) -> int:
+        """Нужный размер пула.
+
+        Args:
+            pending: Задач в очереди
+            active: Задач в работе
+            current: Текущий размер пула
+            now: time.monotonic()
+        """
+        needed = math.ceil((pending + active) / self.jobs_per_worker)
+        target = min(self.max_workers, max(self.min_workers, needed))
+        if target >= current:
+            self._low_since = None
+            return target
+
+        if self._low_since is None:
+            self._low_since = now
+        if now - self._low_since < self.down_delay:
+            return current
+        self._low_since = None
+        return target
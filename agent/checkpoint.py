@@ -0,0 +1,112 @@
+"""Checkpoint - прогресс решения issue, чтобы повтор продолжал с места ошибки"""
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+# Каталог checkpoint файлов ({owner}__{repo}/issue-{N}.json)
+CHECKPOINT_DIR = os.getenv("CHECKPOINT_DIR", str(Path(__file__).parent / "checkpoints"))
+
+
+def _description_hash(issue_description: str) -> str:
+    return hashlib.sha256(issue_description.encode("utf-8")).hexdigest()
+
+
+class Checkpoint:
+    """Проанализированные файлы issue и полученные исправления.
+
+    Действителен, пока не сменились base SHA (HEAD default branch после
+    pull) и текст issue - иначе исправления считались по другому коду.
+    Файл переписывается атомарно (tmp + os.replace) после каждого
+    проанализированного файла, поэтому ошибка на любом шаге (LLM,
+    push, create_pull_request) теряет не больше одного файла.
+    """
+
+    def __init__(self, path: Path, base_sha: str, issue_hash: str, files: dict = None):
+        """
+        Args:
+            path: Файл checkpoint
+            base_sha: Коммит, от которого анализировались файлы
+            issue_hash: sha256 описания issue
+            files: {relative_path: исправленное содержимое или None}
+        """
+        self.path = Path(path)
+        self.base_sha = base_sha
+        self.issue_hash = issue_hash
+        self.files = files or {}
+        self.resumed = len(self.files)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def path_for(repo_full_name: str, issue_number: int, directory: str = CHECKPOINT_DIR) -> Path:
+        return Path(directory) / repo_full_name.replace("/", "__") / f"issue-{issue_number}.json"
+
+    @classmethod
+    def open(
+        cls,
+        repo_full_name: str,
+        issue_number: int,
+        base_sha: str,
+        issue_description: str,
+        directory: str = CHECKPOINT_DIR
+    ) -> "Checkpoint":
+        """Checkpoint прошлой попытки, если он от того же base SHA и текста issue, иначе пустой."""
+        path = cls.path_for(repo_full_name, issue_number, directory)
+        issue_hash = _description_hash(issue_description)
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return cls(path, base_sha, issue_hash)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Ignoring unreadable checkpoint {path}: {e}")
+            return cls(path, base_sha, issue_hash)
+
+        if data.get("base_sha") != base_sha or data.get("issue_hash") != issue_hash:
+            print(f"♻️ Checkpoint for issue #{issue_number} is stale (base SHA or issue text changed)")
+            return cls(path, base_sha, issue_hash)
+        return cls(path, base_sha, issue_hash, data.get("files", {}))
+
+    def get(self, relative_path: str):
+        """Returns: (True, исправление или None) если файл уже проанализирован, иначе (False, None)."""
+        with self._lock:
+            if relative_path in self.files:
+                return True, self.files[relative_path]
+            return False, None
+
+    def record(self, relative_path: str, content: str | None) -> None:
+        """Запоминает результат анализа файла и сохраняет checkpoint."""
+        with self._lock:
+            self.files[relative_path] = content
+            self._save()
+
+    def _save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(f".tmp.{os.getpid()}")
+        data = {"base_sha": self.base_sha, "issue_hash": self.issue_hash, "files": self.files}
+        tmp_path.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp_path, self.path)
+
+    def delete(self) -> None:
+        """Issue решён (или исправлений нет) - продолжать нечего."""
+        with self._lock:
+            self.path.unlink(missing_ok=True)
+
+
+def prune_checkpoints(older_than_days: float, directory: str = CHECKPOINT_DIR) -> int:
+    """Удаляет брошенные checkpoints (issue ушёл в DEAD и больше не повторялся).
+
+    Returns:
+        Сколько файлов удалено
+    """
+    cutoff = time.time() - older_than_days * 86400
+    removed = 0
+    for path in Path(directory).glob("*/issue-*.json"):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
@@ -1,16 +1,55 @@
-"""Database - TinyDB wrapper для хранения Issues"""
-from datetime import datetime
+"""Database - хранилище Issues и PR reviews (TinyDB или SQLite)"""
+from datetime import datetime, timedelta
 from enum import Enum
 from pathlib import Path
-from tinydb import TinyDB, Query
 import os
+import random
+
+from archive import Archive
+from group_commit import GROUP_COMMIT_MS, GroupCommit
+from quotas import QuotaTracker, quota_key
+from storage import open_storage
+from scheduler import DEFAULT_PRIORITY, is_due, mark_served, pick_next, prune_served, schedule_order
+
+# tinydb - db.json (по умолчанию), sqlite - WAL + индексы
+DB_BACKEND = os.getenv("DB_BACKEND", "tinydb")
+DEFAULT_DB_FILES = {
+    "tinydb": "db.json",
+    "sqlite": "db.sqlite3",
+}
+# Каталог БД; имя файла выбирается по DB_BACKEND (DB_PATH задаёт путь целиком)
+DB_DIR = os.getenv("DB_DIR", str(Path(__file__).parent))
+
+# Сколько секунд задача принадлежит воркеру без heartbeat.
+# Воркер продлевает lease каждые HEARTBEAT_SECONDS (см. leases.py)
+LEASE_SECONDS = int(os.getenv("LEASE_SECONDS", "120"))
+
+# Повторы: после MAX_ATTEMPTS попыток задача уходит в DEAD
+MAX_ATTEMPTS = int(os.getenv("MAX_ATTEMPTS", "3"))
+# Экспоненциальная задержка перед повтором: base * 2^(attempt-1), не больше max
+RETRY_BASE_SECONDS = int(os.getenv("RETRY_BASE_SECONDS", "60"))
+RETRY_MAX_SECONDS = int(os.getenv("RETRY_MAX_SECONDS", "3600"))
+
+# Завершённые задачи старше N дней уходят из горячих таблиц в архив
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "7"))
+
+
+def retry_delay(attempts: int) -> float:
+    """Задержка перед следующей попыткой (экспонента с jitter).
+    
+    Jitter в диапазоне [delay/2, delay] разводит повторы задач,
+    упавших одновременно (например, на пачке 429 от OpenAI).
+    """
+    delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** max(attempts - 1, 0))
+    return random.uniform(delay / 2, delay)
 
 
 class IssueStatus(str, Enum):
     PENDING = "pending"       # Ожидает обработки
     PROCESSING = "processing" # В обработке
     COMPLETED = "completed"   # PR создан
-    FAILED = "failed"         # Ошибка
+    FAILED = "failed"         # Ошибка (повтор не поможет)
+    DEAD = "dead"             # Исчерпаны все попытки
 
 
 class PRReviewStatus(str, Enum):
@@ -19,18 +58,69 @@ class PRReviewStatus(str, Enum):
     APPROVED = "approved"     # Все файлы одобрены
     REJECTED = "rejected"     # Есть проблемы
     FAILED = "failed"         # Ошибка review
+    DEAD = "dead"             # Исчерпаны все попытки
+    SUPERSEDED = "superseded" # В PR запушили новый head, review отменён
+
+
+# Статусы, которые архивируются (DEAD остаётся на виду для разбора)
+ARCHIVED_STATUSES = {
+    "issues": (IssueStatus.COMPLETED, IssueStatus.FAILED),
+    "pr_reviews": (
+        PRReviewStatus.APPROVED,
+        PRReviewStatus.REJECTED,
+        PRReviewStatus.FAILED,
+        PRReviewStatus.SUPERSEDED,
+    ),
+}
+
+
+# Поле номера задачи внутри repo (ключ дедупликации активных задач)
+NUMBER_FIELDS = {
+    "issues": "issue_number",
+    "pr_reviews": "pr_number",
+}
+
+ACTIVE_STATUSES = {
+    "issues": (IssueStatus.PENDING, IssueStatus.PROCESSING),
+    "pr_reviews": (PRReviewStatus.PENDING, PRReviewStatus.REVIEWING),
+}
 
 
 class IssueDB:
-    """Wrapper для TinyDB - хранение issues и PR reviews из webhooks"""
+    """Хранение issues и PR reviews из webhooks.
     
-    def __init__(self, db_path: str = None):
+    Бэкенд выбирается через DB_BACKEND (tinydb/sqlite), API одинаковый.
+    """
+    
+    def __init__(
+        self,
+        db_path: str = None,
+        backend: str = None,
+        archive_dir: str = None,
+        group_commit_ms: float = None,
+        quota: QuotaTracker = None
+    ):
+        backend = (backend or DB_BACKEND).lower()
         if db_path is None:
-            base_dir = Path(__file__).parent
-            db_path = os.getenv("DB_PATH", str(base_dir / "db.json"))
-        self.db = TinyDB(db_path)
+            default_file = DEFAULT_DB_FILES.get(backend, "db.json")
+            db_path = os.getenv("DB_PATH") or str(Path(DB_DIR) / default_file)
+        if archive_dir is None:
+            archive_dir = os.getenv("ARCHIVE_DIR", str(Path(db_path).parent / "archive"))
+        self.backend = backend
+        self.db = open_storage(backend, db_path)
+        self.archive = Archive(
+            archive_dir,
+            index_fields={table: ("repo", field) for table, field in NUMBER_FIELDS.items()}
+        )
         self.issues = self.db.table("issues")
         self.pr_reviews = self.db.table("pr_reviews")
+        
+        # Постановка задач в очередь (webhooks) пишется пачками
+        if group_commit_ms is None:
+            group_commit_ms = GROUP_COMMIT_MS
+        self.group_commit = GroupCommit(self._add_jobs, group_commit_ms) if group_commit_ms > 0 else None
+        # Квоты installations проверяются при claim (см. quotas.py)
+        self.quota = quota or QuotaTracker()
     
     def add_issue(
         self,
@@ -38,29 +128,24 @@ class IssueDB:
         issue_number: int,
         title: str,
         body: str,
-        installation_id: int = None
+        installation_id: int = None,
+        priority: int = DEFAULT_PRIORITY
     ) -> int:
         """Добавить issue в очередь.
         
+        Args:
+            priority: Приоритет (чем больше, тем раньше), см. scheduler.py
+        
         Returns:
             doc_id записи
         """
-        Issue = Query()
-        # Проверяем, не существует ли уже активный
-        existing = self.issues.search(
-            (Issue.repo == repo_full_name) & 
-            (Issue.issue_number == issue_number) &
-            (Issue.status.one_of([IssueStatus.PENDING, IssueStatus.PROCESSING]))
-        )
-        if existing:
-            return existing[0].doc_id
-        
-        doc_id = self.issues.insert({
+        return self._add_job(self.issues, {
             "repo": repo_full_name,
             "issue_number": issue_number,
             "title": title,
             "body": body,
             "installation_id": installation_id,
+            "priority": priority,
             "status": IssueStatus.PENDING,
             "attempts": 0,
             "error": None,
@@ -68,114 +153,692 @@ class IssueDB:
             "created_at": datetime.now().isoformat(),
             "updated_at": datetime.now().isoformat()
         })
+    
+    def _add_job(self, table, doc: dict) -> int:
+        """Ставит задачу в очередь (через group commit, если включён)."""
+        if self.group_commit:
+            return self.group_commit.submit((table, doc))
+        return self._add_jobs([(table, doc)])[0]
+    
+    def _add_jobs(self, jobs: list) -> list:
+        """Записывает пачку задач одной транзакцией.
+        
+        Если активная задача с тем же repo/номером уже есть (в БД или
+        раньше в этой же пачке), новая не создаётся - возвращается
+        doc_id существующей, а её приоритет при необходимости поднимается.
+        Исключение - PR review с новым head_sha (см. _supersede_review).
+        
+        Args:
+            jobs: [(table, doc), ...]
+            
+        Returns:
+            doc_id для каждой задачи в том же порядке
+        """
+        doc_ids = []
+        with self.db.transaction():
+            # Активные задачи репозиториев пачки - одним запросом на таблицу
+            active = {}
+            for table in {t.name: t for t, _ in jobs}.values():
+                number_field = NUMBER_FIELDS[table.name]
+                repos = sorted({doc["repo"] for t, doc in jobs if t is table})
+                active[table.name] = {}
+                for existing in table.find(repo=repos, status=list(ACTIVE_STATUSES[table.name])):
+                    key = (existing["repo"], existing[number_field])
+                    active[table.name].setdefault(key, existing)
+            
+            for table, doc in jobs:
+                key = (doc["repo"], doc[NUMBER_FIELDS[table.name]])
+                existing = active[table.name].get(key)
+                if existing and self._is_newer_head(table, existing, doc):
+                    doc_id = self._supersede_review(existing, doc)
+                    if doc_id != existing['doc_id']:
+                        active[table.name][key] = dict(doc, doc_id=doc_id)
+                    doc_ids.append(doc_id)
+                    continue
+                if existing:
+                    self._raise_priority(table, existing, doc["priority"])
+                    existing["priority"] = max(existing.get("priority", DEFAULT_PRIORITY), doc["priority"])
+                    doc_ids.append(existing['doc_id'])
+                    continue
+                doc_id = table.insert(doc)
+                active[table.name][key] = dict(doc, doc_id=doc_id)
+                doc_ids.append(doc_id)
+        return doc_ids
+    
+    def _is_newer_head(self, table, existing: dict, doc: dict) -> bool:
+        """Webhook PR review пришёл для другого head коммита."""
+        return (
+            table.name == "pr_reviews"
+            and bool(doc.get("head_sha"))
+            and doc["head_sha"] != existing.get("head_sha")
+        )
+    
+    def _supersede_review(self, existing: dict, doc: dict) -> int:
+        """Новый push в PR, по которому уже есть активный review.
+        
+        PENDING review ещё не начат - ему просто меняется head_sha.
+        REVIEWING review отменяется (SUPERSEDED, воркер увидит это и
+        бросит работу), а в очередь встаёт новый review нового head.
+        Вызывается внутри транзакции _add_jobs.
+        
+        Returns:
+            doc_id review, который проверит новый head
+        """
+        now = datetime.now().isoformat()
+        priority = max(existing.get("priority", DEFAULT_PRIORITY), doc["priority"])
+        if existing["status"] == PRReviewStatus.PENDING:
+            update = {
+                "head_sha": doc["head_sha"],
+                "changed_files": doc["changed_files"],
+                "priority": priority,
+                "updated_at": now
+            }
+            self.pr_reviews.update(update, existing['doc_id'])
+            existing.update(update)
+            return existing['doc_id']
+        
+        doc_id = self.pr_reviews.insert(dict(doc, priority=priority))
+        self.pr_reviews.update({
+            "status": PRReviewStatus.SUPERSEDED,
+            "superseded_by": doc_id,
+            "lease_owner": None,
+            "lease_expires_at": None,
+            "updated_at": now
+        }, existing['doc_id'])
+        print(f"⏭️ PR review {existing['doc_id']} superseded by {doc_id} (new head {doc['head_sha'][:8]})")
         return doc_id
     
+    @staticmethod
+    def _latest(table, jobs: list) -> dict:
+        """Активная задача из найденных по номеру, иначе самая новая."""
+        active = ACTIVE_STATUSES[table.name]
+        return max(jobs, key=lambda job: (job.get("status") in active, job['doc_id']))
+    
+    def _raise_priority(self, table, job: dict, priority: int) -> None:
+        """Повторный запрос с более высоким приоритетом поднимает задачу."""
+        if priority > job.get("priority", DEFAULT_PRIORITY):
+            table.update({"priority": priority}, job['doc_id'])
+    
+    def _pending_in_order(self, table, pending: str) -> list:
+        """Pending задачи в порядке выдачи, с queue_position (1 - следующая)."""
+        with self.db.transaction():
+            jobs = table.find(status=pending)
+            served = self.db.get_meta(f"scheduler:{table.name}", {})
+        ordered = schedule_order(jobs, served)
+        for position, job in enumerate(ordered, start=1):
+            job["queue_position"] = position
+        return ordered
+    
     def get_pending_issues(self, limit: int = 10) -> list:
-        """Получить issues ожидающие обработки."""
-        Issue = Query()
-        results = self.issues.search(Issue.status == IssueStatus.PENDING)
-        # Добавляем doc_id к каждому результату
-        for r in results:
-            r['doc_id'] = r.doc_id
-        return results[:limit]
+        """Получить issues ожидающие обработки (в порядке выдачи воркерам)."""
+        return self._pending_in_order(self.issues, IssueStatus.PENDING)[:limit]
+    
+    def claim_next_issue(
+        self,
+        owner: str,
+        lease_seconds: int = LEASE_SECONDS,
+        max_attempts: int = MAX_ATTEMPTS
+    ) -> dict | None:
+        """Атомарно забрать следующий pending issue в работу.
+        
+        Issue сразу переходит в PROCESSING с lease (lease_owner,
+        lease_expires_at), поэтому параллельные воркеры его не получат.
+        Issues, у которых next_attempt_at ещё не наступил, пропускаются.
+        
+        Args:
+            owner: Идентификатор воркера (host:pid)
+            lease_seconds: Длительность lease
+            max_attempts: Issues, исчерпавшие попытки, уходят в DEAD
+            
+        Returns:
+            Запись issue с полями lease или None, если очередь пуста
+        """
+        return self._claim_next(
+            self.issues,
+            pending=IssueStatus.PENDING,
+            active=IssueStatus.PROCESSING,
+            dead=IssueStatus.DEAD,
+            owner=owner,
+            lease_seconds=lease_seconds,
+            max_attempts=max_attempts
+        )
+    
+    def claim_issue_batch(
+        self,
+        owner: str,
+        limit: int = 1,
+        lease_seconds: int = LEASE_SECONDS,
+        max_attempts: int = MAX_ATTEMPTS,
+        exclusive_repos: bool = False
+    ) -> list:
+        """Атомарно забрать следующий issue и до limit-1 issues того же repo.
+        
+        Args:
+            owner: Идентификатор воркера (host:pid)
+            limit: Сколько issues одного repo взять за раз (coalescing)
+            lease_seconds: Длительность lease
+            max_attempts: Issues, исчерпавшие попытки, уходят в DEAD
+            exclusive_repos: Не выдавать issues repo, по которому уже
+                идёт обработка (один клон и одна ветка на repo за раз)
+            
+        Returns:
+            Записи issues с полями lease, пустой список если выдавать нечего
+        """
+        return self._claim(
+            self.issues,
+            pending=IssueStatus.PENDING,
+            active=IssueStatus.PROCESSING,
+            dead=IssueStatus.DEAD,
+            owner=owner,
+            lease_seconds=lease_seconds,
+            max_attempts=max_attempts,
+            limit=limit,
+            exclusive_repos=exclusive_repos
+        )
+    
+    def _claim_next(self, table, **kwargs) -> dict | None:
+        """Claim одной задачи (см. _claim)."""
+        jobs = self._claim(table, **kwargs)
+        return jobs[0] if jobs else None
+    
+    def _claim(
+        self,
+        table,
+        pending: str,
+        active: str,
+        dead: str,
+        owner: str,
+        lease_seconds: int,
+        max_attempts: int = MAX_ATTEMPTS,
+        limit: int = 1,
+        exclusive_repos: bool = False
+    ) -> list:
+        """Общая логика claim для issues и pr_reviews.
+        
+        Порядок выдачи - scheduler.pick_next (приоритет, затем
+        round-robin по installation/repo). При limit > 1 вместе с
+        выбранной задачей забираются другие готовые задачи того же repo.
+        """
+        with self.db.transaction():
+            now = datetime.now()
+            busy_repos = set()
+            if exclusive_repos:
+                busy_repos = {job["repo"] for job in table.find(status=active)}
+            candidates = []
+            pending_jobs = table.find(status=pending)
+            for job in pending_jobs:
+                if job["repo"] in busy_repos:
+                    continue
+                
+                # Повтор ещё не наступил (backoff)
+                if not is_due(job, now.isoformat()):
+                    continue
+                
+                if max_attempts is not None and job.get("attempts", 0) >= max_attempts:
+                    table.update({
+                        "status": dead,
+                        "error": f"Max attempts ({max_attempts}) exceeded",
+                        "updated_at": now.isoformat()
+                    }, job['doc_id'])
+                    continue
+                candidates.append(job)
+            
+            slots = self._quota_slots(candidates)
+            if slots is not None:
+                candidates = [c for c in candidates if slots[quota_key(c)] > 0]
+            
+            served_key = f"scheduler:{table.name}"
+            served = self.db.get_meta(served_key, {})
+            job = pick_next(candidates, served)
+            if not job:
+                return []
+            mark_served(job, served)
+            # Группы без pending задач больше не нужны (кроме только что выданной)
+            self.db.set_meta(served_key, prune_served(served, pending_jobs))
+            
+            same_repo = sorted(
+                (c for c in candidates if c["repo"] == job["repo"] and c is not job),
+                key=lambda c: (-c.get("priority", DEFAULT_PRIORITY), c["doc_id"])
+            )
+            extra = max(limit - 1, 0)
+            if slots is not None:
+                extra = min(extra, slots[quota_key(job)] - 1)
+            jobs = [job] + same_repo[:extra]
+            for job in jobs:
+                lease = {
+                    "status": active,
+                    "attempts": job.get("attempts", 0) + 1,
+                    "next_attempt_at": None,
+                    "lease_owner": owner,
+                    "lease_expires_at": (now + timedelta(seconds=lease_seconds)).isoformat(),
+                    "heartbeat_at": now.isoformat(),
+                    "updated_at": now.isoformat()
+                }
+                table.update(lease, job['doc_id'])
+                job.update(lease)
+            return jobs
+    
+    def _active_by_quota_key(self) -> dict:
+        """Задачи в работе (issues и PR reviews) по ключам квот."""
+        active = {}
+        for table, status in ((self.issues, IssueStatus.PROCESSING), (self.pr_reviews, PRReviewStatus.REVIEWING)):
+            for job in table.find(status=status):
+                key = quota_key(job)
+                active[key] = active.get(key, 0) + 1
+        return active
+    
+    def _quota_slots(self, candidates: list) -> dict | None:
+        """Сколько задач ещё можно выдать каждому ключу квоты кандидатов.
+        
+        Задачи installation сверх квоты не выдаются и не помечаются
+        ошибкой - остаются PENDING до освобождения слота или следующих
+        суток (UTC). Вызывается внутри транзакции claim.
+        
+        Returns:
+            {quota_key: свободных слотов}, None если квоты не настроены
+        """
+        if not candidates or not (self.quota.limits_jobs or self.quota.limits_tokens):
+            return None
+        active = self._active_by_quota_key() if self.quota.limits_jobs else {}
+        used = self.quota.used_today() if self.quota.limits_tokens else {}
+        
+        slots = {}
+        for key in {quota_key(c) for c in candidates}:
+            reason = self.quota.blocked(key, active.get(key, 0), used.get(key, 0))
+            if reason:
+                print(f"⏸️ Deferring jobs of {key}: {reason}")
+                slots[key] = 0
+                continue
+            max_jobs = self.quota.limits(key)["max_jobs"]
+            slots[key] = max_jobs - active.get(key, 0) if max_jobs else len(candidates)
+        return slots
+    
+    def get_quotas(self) -> dict:
+        """Расход и остаток квот: {quota_key: {tokens_today, daily_tokens,
+        tokens_remaining, active_jobs, max_jobs, jobs_remaining}}.
+        
+        Показываются installations с расходом сегодня, задачами в работе
+        или своими лимитами; None в лимитах - без ограничения.
+        """
+        with self.db.transaction():
+            active = self._active_by_quota_key()
+        used = self.quota.used_today()
+        keys = set(active) | set(used) | {
+            f"repo:{key}" if "/" in key else f"installation:{key}" for key in self.quota.overrides
+        }
+        
+        quotas = {}
+        for key in sorted(keys):
+            limits = self.quota.limits(key)
+            tokens, jobs = used.get(key, 0), active.get(key, 0)
+            quotas[key] = {
+                "tokens_today": tokens,
+                "daily_tokens": limits["daily_tokens"] or None,
+                "tokens_remaining": max(limits["daily_tokens"] - tokens, 0) if limits["daily_tokens"] else None,
+                "active_jobs": jobs,
+                "max_jobs": limits["max_jobs"] or None,
+                "jobs_remaining": max(limits["max_jobs"] - jobs, 0) if limits["max_jobs"] else None,
+            }
+        return quotas
+    
+    def _heartbeat(self, table, doc_id: int, owner: str, active: str, lease_seconds: int) -> bool:
+        """Продлить lease задачи. False - lease потерян (задача переназначена)."""
+        with self.db.transaction():
+            job = table.get(doc_id)
+            if not job or job.get("status") != active or job.get("lease_owner") != owner:
+                return False
+            now = datetime.now()
+            table.update({
+                "heartbeat_at": now.isoformat(),
+                "lease_expires_at": (now + timedelta(seconds=lease_seconds)).isoformat()
+            }, doc_id)
+            return True
+    
+    def _requeue_expired(
+        self,
+        table,
+        pending: str,
+        active: str,
+        dead: str,
+        lease_seconds: int,
+        max_attempts: int = MAX_ATTEMPTS
+    ) -> list:
+        """Вернуть в очередь задачи, чей воркер перестал слать heartbeat.
+        
+        Записи без lease (созданные до появления heartbeat) считаются
+        просроченными через lease_seconds после updated_at.
+        """
+        now = datetime.now()
+        requeued = []
+        with self.db.transaction():
+            for job in table.find(status=active):
+                expires_at = job.get("lease_expires_at")
+                if not expires_at:
+                    updated_at = datetime.fromisoformat(job["updated_at"])
+                    expires_at = (updated_at + timedelta(seconds=lease_seconds)).isoformat()
+                if expires_at >= now.isoformat():
+                    continue
+                
+                self._schedule_retry(
+                    table,
+                    job['doc_id'],
+                    error=f"Lease of {job.get('lease_owner') or 'unknown worker'} expired",
+                    pending=pending,
+                    dead=dead,
+                    max_attempts=max_attempts
+                )
+                requeued.append(job['doc_id'])
+        return requeued
+    
+    def _schedule_retry(
+        self,
+        table,
+        doc_id: int,
+        error: str,
+        pending: str,
+        dead: str,
+        failed: str = None,
+        retry: bool = True,
+        max_attempts: int = MAX_ATTEMPTS,
+        owner: str = None
+    ) -> str | bool | None:
+        """Неудачная попытка: повтор с backoff, DEAD или FAILED.
+        
+        Args:
+            owner: Воркер, который держит lease (None - без проверки)
+        
+        Returns:
+            Новый статус задачи (None если записи нет, False если lease не наш)
+        """
+        with self.db.transaction():
+            job = table.get(doc_id)
+            if not job:
+                return None
+            if not self._owns(job, owner):
+                # Reaper вернул задачу в очередь, её ведёт другой воркер
+                return False
+            if job.get("status") == PRReviewStatus.SUPERSEDED:
+                # Результат отменённого review уже не нужен
+                return job["status"]
+            
+            now = datetime.now()
+            attempts = job.get("attempts", 0)
+            update = {
+                "error": error,
+                "next_attempt_at": None,
+                "lease_owner": None,
+                "lease_expires_at": None,
+                "updated_at": now.isoformat()
+            }
+            if not retry:
+                update["status"] = failed
+            elif max_attempts is not None and attempts >= max_attempts:
+                update["status"] = dead
+                update["error"] = f"{error} (gave up after {attempts} attempt(s))"
+            else:
+                update["status"] = pending
+                update["next_attempt_at"] = (now + timedelta(seconds=retry_delay(attempts))).isoformat()
+            table.update(update, doc_id)
+            return update["status"]
+    
+    @staticmethod
+    def _owns(job: dict, owner: str = None) -> bool:
+        """Задача всё ещё за воркером owner (None - запись без проверки lease: CLI)."""
+        return owner is None or job.get("lease_owner") == owner
+    
+    def heartbeat_issue(self, doc_id: int, owner: str, lease_seconds: int = LEASE_SECONDS) -> bool:
+        """Продлить lease issue в обработке (вызывается воркером периодически)."""
+        return self._heartbeat(self.issues, doc_id, owner, IssueStatus.PROCESSING, lease_seconds)
+    
+    def release_issue(self, doc_id: int, owner: str) -> bool:
+        """Вернуть в очередь issue, который воркер взял, но не начал.
+        
+        Попытка не засчитывается. Returns: False если lease уже не наш.
+        """
+        with self.db.transaction():
+            issue = self.issues.get(doc_id)
+            if not issue or issue.get("status") != IssueStatus.PROCESSING or issue.get("lease_owner") != owner:
+                return False
+            self.issues.update({
+                "status": IssueStatus.PENDING,
+                "attempts": max(issue.get("attempts", 1) - 1, 0),
+                "lease_owner": None,
+                "lease_expires_at": None,
+                "updated_at": datetime.now().isoformat()
+            }, doc_id)
+            return True
+    
+    def requeue_expired_issues(self, max_attempts: int = MAX_ATTEMPTS, lease_seconds: int = LEASE_SECONDS) -> list:
+        """Вернуть в PENDING (с backoff) зависшие PROCESSING issues (упавший воркер).
+        
+        Returns:
+            doc_id переназначенных issues
+        """
+        return self._requeue_expired(
+            self.issues,
+            pending=IssueStatus.PENDING,
+            active=IssueStatus.PROCESSING,
+            dead=IssueStatus.DEAD,
+            lease_seconds=lease_seconds,
+            max_attempts=max_attempts
+        )
     
     def get_issue_by_id(self, doc_id: int) -> dict | None:
         """Получить issue по ID."""
-        result = self.issues.get(doc_id=doc_id)
-        if result:
-            result['doc_id'] = doc_id
-        return result
+        return self.issues.get(doc_id)
     
     def get_issue_by_number(self, repo: str, issue_number: int) -> dict | None:
-        """Получить issue по номеру."""
-        Issue = Query()
-        results = self.issues.search(
-            (Issue.repo == repo) & (Issue.issue_number == issue_number)
-        )
+        """Получить issue по номеру.
+        
+        Если в горячей таблице нет - ищется в архиве (с пометкой "archived": True).
+        """
+        results = self.issues.find(repo=repo, issue_number=issue_number)
         if results:
-            results[0]['doc_id'] = results[0].doc_id
-            return results[0]
-        return None
+            return self._latest(self.issues, results)
+        return self.archive.find("issues", repo=repo, issue_number=issue_number)
     
     def set_processing(self, doc_id: int) -> None:
         """Отметить issue как в обработке."""
         self.issues.update({
             "status": IssueStatus.PROCESSING,
             "updated_at": datetime.now().isoformat()
-        }, doc_ids=[doc_id])
+        }, doc_id)
     
-    def set_completed(self, doc_id: int, pr_number: int) -> None:
-        """Отметить issue как завершённый."""
-        self.issues.update({
-            "status": IssueStatus.COMPLETED,
-            "pr_number": pr_number,
-            "error": None,
-            "updated_at": datetime.now().isoformat()
-        }, doc_ids=[doc_id])
+    def set_completed(self, doc_id: int, pr_number: int, owner: str = None) -> bool:
+        """Отметить issue как завершённый.
+        
+        Args:
+            owner: Воркер, который держит lease (None - без проверки)
+        
+        Returns:
+            False если lease уже не наш (issue ведёт другой воркер)
+        """
+        with self.db.transaction():
+            issue = self.issues.get(doc_id)
+            if not issue or not self._owns(issue, owner):
+                return False
+            self.issues.update({
+                "status": IssueStatus.COMPLETED,
+                "pr_number": pr_number,
+                "error": None,
+                "lease_owner": None,
+                "lease_expires_at": None,
+                "updated_at": datetime.now().isoformat()
+            }, doc_id)
+            return True
     
-    def set_failed(self, doc_id: int, error: str) -> None:
-        """Отметить issue как неудачный."""
-        issue = self.issues.get(doc_id=doc_id)
-        attempts = (issue.get("attempts", 0) + 1) if issue else 1
-        self.issues.update({
-            "status": IssueStatus.FAILED,
-            "error": error,
-            "attempts": attempts,
-            "updated_at": datetime.now().isoformat()
-        }, doc_ids=[doc_id])
+    def set_failed(
+        self,
+        doc_id: int,
+        error: str,
+        retry: bool = True,
+        max_attempts: int = MAX_ATTEMPTS,
+        owner: str = None
+    ) -> str | bool | None:
+        """Отметить попытку обработки issue как неудачную.
+        
+        Попытки считает claim_next_issue, здесь attempts не меняется.
+        Пока попытки есть, issue возвращается в PENDING с next_attempt_at
+        (экспоненциальный backoff), затем уходит в DEAD.
+        
+        Args:
+            doc_id: ID записи
+            error: Текст ошибки
+            retry: False - ошибка окончательная, сразу FAILED
+            max_attempts: Лимит попыток
+            owner: Воркер, который держит lease (None - без проверки)
+            
+        Returns:
+            Новый статус issue (False если lease уже не наш)
+        """
+        return self._schedule_retry(
+            self.issues,
+            doc_id,
+            error=error,
+            pending=IssueStatus.PENDING,
+            failed=IssueStatus.FAILED,
+            dead=IssueStatus.DEAD,
+            retry=retry,
+            max_attempts=max_attempts,
+            owner=owner
+        )
     
-    def reset_to_pending(self, doc_id: int) -> None:
-        """Сбросить статус на pending (для повторной обработки)."""
-        self.issues.update({
-            "status": IssueStatus.PENDING,
-            "updated_at": datetime.now().isoformat()
-        }, doc_ids=[doc_id])
+    def reset_to_pending(self, doc_id: int, priority: int = None) -> bool:
+        """Сбросить статус на pending (ручной повтор: @coding-agent, /process).
+        
+        Попытки и backoff обнуляются - issue берётся в работу сразу.
+        Issue, который сейчас обрабатывается, не трогаем.
+        
+        Args:
+            doc_id: ID записи
+            priority: Новый приоритет (None - оставить как был)
+        
+        Returns:
+            True если issue поставлен в очередь
+        """
+        with self.db.transaction():
+            issue = self.issues.get(doc_id)
+            if not issue or issue.get("status") == IssueStatus.PROCESSING:
+                return False
+            update = {
+                "status": IssueStatus.PENDING,
+                "attempts": 0,
+                "next_attempt_at": None,
+                "lease_owner": None,
+                "lease_expires_at": None,
+                "updated_at": datetime.now().isoformat()
+            }
+            if priority is not None:
+                update["priority"] = priority
+            self.issues.update(update, doc_id)
+            return True
     
     def increment_attempts(self, doc_id: int) -> int:
         """Увеличить счётчик попыток."""
-        issue = self.issues.get(doc_id=doc_id)
+        issue = self.issues.get(doc_id)
         attempts = (issue.get("attempts", 0) + 1) if issue else 1
         self.issues.update({
             "attempts": attempts,
             "updated_at": datetime.now().isoformat()
-        }, doc_ids=[doc_id])
+        }, doc_id)
         return attempts
     
     def get_all(self) -> list:
         """Получить все issues."""
-        results = self.issues.all()
-        for r in results:
-            r['doc_id'] = r.doc_id
-        return results
+        return self.issues.all()
     
     def get_stats(self) -> dict:
-        """Получить статистику."""
-        Issue = Query()
-        Review = Query()
+        """Получить статистику.
+        
+        Берётся из счётчиков, которые обновляются в той же записи,
+        что и смена статуса - без сканирования таблиц.
+        """
+        with self.db.transaction():
+            issues = self.issues.counters()
+            reviews = self.pr_reviews.counters()
+            archived = self.db.get_meta("archived", {})
         return {
-            "pending": len(self.issues.search(Issue.status == IssueStatus.PENDING)),
-            "processing": len(self.issues.search(Issue.status == IssueStatus.PROCESSING)),
-            "completed": len(self.issues.search(Issue.status == IssueStatus.COMPLETED)),
-            "failed": len(self.issues.search(Issue.status == IssueStatus.FAILED)),
-            "total": len(self.issues.all()),
-            "pr_pending": len(self.pr_reviews.search(Review.status == PRReviewStatus.PENDING)),
-            "pr_reviewing": len(self.pr_reviews.search(Review.status == PRReviewStatus.REVIEWING)),
-            "pr_approved": len(self.pr_reviews.search(Review.status == PRReviewStatus.APPROVED)),
-            "pr_rejected": len(self.pr_reviews.search(Review.status == PRReviewStatus.REJECTED))
+            "pending": issues.get(IssueStatus.PENDING.value, 0),
+            "processing": issues.get(IssueStatus.PROCESSING.value, 0),
+            "completed": issues.get(IssueStatus.COMPLETED.value, 0),
+            "failed": issues.get(IssueStatus.FAILED.value, 0),
+            "dead": issues.get(IssueStatus.DEAD.value, 0),
+            "total": issues.get("total", 0),
+            "pr_pending": reviews.get(PRReviewStatus.PENDING.value, 0),
+            "pr_reviewing": reviews.get(PRReviewStatus.REVIEWING.value, 0),
+            "pr_approved": reviews.get(PRReviewStatus.APPROVED.value, 0),
+            "pr_rejected": reviews.get(PRReviewStatus.REJECTED.value, 0),
+            "pr_failed": reviews.get(PRReviewStatus.FAILED.value, 0),
+            "pr_dead": reviews.get(PRReviewStatus.DEAD.value, 0),
+            "pr_superseded": reviews.get(PRReviewStatus.SUPERSEDED.value, 0),
+            "archived": archived.get("issues", 0),
+            "pr_archived": archived.get("pr_reviews", 0)
         }
+    
+    def archive_finished(self, older_than_days: float = ARCHIVE_AFTER_DAYS) -> dict:
+        """Переносит завершённые задачи старше older_than_days в архив.
+        
+        Запись в архив и удаление из таблицы идут в одной транзакции БД:
+        задачу, которую в это время перезапустили, не заархивируем.
+        При сбое между ними запись попадёт в архив дважды - это безопасно,
+        поиск по архиву возвращает самую свежую копию.
+        
+        Returns:
+            Сколько записей заархивировано {"issues": N, "pr_reviews": M}
+        """
+        cutoff = (datetime.now() - timedelta(days=older_than_days)).isoformat()
+        result = {}
+        for table in (self.issues, self.pr_reviews):
+            with self.db.transaction():
+                old = [
+                    doc for doc in table.find(status=list(ARCHIVED_STATUSES[table.name]))
+                    if (doc.get("updated_at") or "") < cutoff
+                ]
+                if old:
+                    self.archive.append(table.name, old)
+                    table.remove([doc['doc_id'] for doc in old])
+                    archived = self.db.get_meta("archived", {})
+                    archived[table.name] = archived.get(table.name, 0) + len(old)
+                    self.db.set_meta("archived", archived)
+            result[table.name] = len(old)
+        return result
+    
+    def set_pool_status(self, queue: str, status: dict) -> None:
+        """Размер пула воркеров очереди (пишет WorkerPool, читает health endpoint)."""
+        with self.db.transaction():
+            pools = self.db.get_meta("pools", {})
+            pools[queue] = dict(status, updated_at=datetime.now().isoformat())
+            self.db.set_meta("pools", pools)
+    
+    def get_pool_status(self) -> dict:
+        """Пулы воркеров по очередям: {queue: {size, draining, min, max, pid, updated_at}}."""
+        return dict(self.db.get_meta("pools", {}))
+    
+    def get_write_stats(self) -> dict:
+        """Статистика group commit: размеры пачек и задержки записи."""
+        if not self.group_commit:
+            return {"enabled": False}
+        return {"enabled": True, **self.group_commit.stats()}
+    
+    def check_counters(self) -> dict:
+        """Пересчитать счётчики статусов с нуля (проверка консистентности).
+        
+        Returns:
+            Расхождения {"issues:pending": (было, стало), ...}, пусто если всё сходилось
+        """
+        return self.db.rebuild_counters()
 
     def get_pr_by_number(self, repo_full_name: str, pr_number: int) -> dict | None:
-        """Получить PR review по номеру."""
-        Review = Query()
-        results = self.pr_reviews.search(
-            (Review.repo == repo_full_name) & (Review.pr_number == pr_number)
-        )
-        if results:
-            results[0]['doc_id'] = results[0].doc_id
-            return results[0]
-        return None
+        """Получить PR review по номеру (с поиском в архиве)."""
+        return self.get_pr_review_by_number(repo_full_name, pr_number)
 
-    def update_pr_status(self, doc_id: int, status: PRReviewStatus, attempts: int = None):
+    def update_pr_status(
+        self,
+        doc_id: int,
+        status: PRReviewStatus,
+        attempts: int = None,
+        priority: int = None
+    ):
         """Обновить статус PR review."""
         update_data = {
             "status": status,
@@ -183,8 +846,48 @@ class IssueDB:
         }
         if attempts is not None:
             update_data["attempts"] = attempts
+        if status == PRReviewStatus.PENDING:
+            # Ручной повтор - без ожидания backoff
+            update_data["next_attempt_at"] = None
+        if priority is not None:
+            update_data["priority"] = priority
+        
+        self.pr_reviews.update(update_data, doc_id)
+    
+    def requeue_pr_review(self, doc_id: int, priority: int = None) -> bool:
+        """Поставить завершённый PR review в очередь заново (ручной повтор: /review).
         
-        self.pr_reviews.update(update_data, doc_ids=[doc_id])
+        Как reset_to_pending: попытки, backoff и lease сбрасываются.
+        Активный review (PENDING/REVIEWING) не трогаем - у ждущего
+        только поднимается приоритет.
+        
+        Args:
+            doc_id: ID записи
+            priority: Новый приоритет (None - оставить как был)
+        
+        Returns:
+            True если review поставлен в очередь
+        """
+        with self.db.transaction():
+            review = self.pr_reviews.get(doc_id)
+            if not review:
+                return False
+            if review.get("status") in ACTIVE_STATUSES["pr_reviews"]:
+                if priority is not None and review.get("status") == PRReviewStatus.PENDING:
+                    self._raise_priority(self.pr_reviews, dict(review, doc_id=doc_id), priority)
+                return False
+            update = {
+                "status": PRReviewStatus.PENDING,
+                "attempts": 0,
+                "next_attempt_at": None,
+                "lease_owner": None,
+                "lease_expires_at": None,
+                "updated_at": datetime.now().isoformat()
+            }
+            if priority is not None:
+                update["priority"] = priority
+            self.pr_reviews.update(update, doc_id)
+            return True
     
     # ==================== PR Review Methods ====================
     
@@ -193,113 +896,222 @@ class IssueDB:
         repo_full_name: str,
         pr_number: int,
         changed_files: list[str],
-        installation_id: int = None
+        installation_id: int = None,
+        priority: int = DEFAULT_PRIORITY,
+        head_sha: str = None
     ) -> int:
         """Добавить PR в очередь на review.
         
+        Повторный webhook с новым head_sha заменяет активный review
+        этого PR (см. _supersede_review), с тем же - ничего не меняет.
+        
         Args:
             repo_full_name: owner/repo
             pr_number: Номер PR
             changed_files: Список путей изменённых файлов
             installation_id: GitHub App installation ID
+            priority: Приоритет (чем больше, тем раньше), см. scheduler.py
+            head_sha: Head коммит PR из webhook (None - ручной запуск)
             
         Returns:
             doc_id записи
         """
-        Review = Query()
-        # проверяем, не существует ли уже
-        existing = self.pr_reviews.search(
-            (Review.repo == repo_full_name) & 
-            (Review.pr_number == pr_number) &
-            (Review.status.one_of([PRReviewStatus.PENDING, PRReviewStatus.REVIEWING]))
-        )
-        if existing:
-            return existing[0].doc_id
-        
-        doc_id = self.pr_reviews.insert({
+        return self._add_job(self.pr_reviews, {
             "repo": repo_full_name,
             "pr_number": pr_number,
+            "head_sha": head_sha,
             "changed_files": changed_files,
             "installation_id": installation_id,
+            "priority": priority,
             "status": PRReviewStatus.PENDING,
-            "at": 0,
+            "attempts": 0,
             "error": None,
             "review_results": [],  # [{file, issue_solved, notes}]
             "created_at": datetime.now().isoformat(),
             "updated_at": datetime.now().isoformat()
         })
-        return doc_id
     
     def get_pending_pr_reviews(self, limit: int = 10) -> list:
-        """Получить PR reviews ожидающие обработки."""
-        Review = Query()
-        results = self.pr_reviews.search(Review.status == PRReviewStatus.PENDING)
-        for r in results:
-            r['doc_id'] = r.doc
-        return results[:limit]
+        """Получить PR reviews ожидающие обработки (в порядке выдачи воркерам)."""
+        return self._pending_in_order(self.pr_reviews, PRReviewStatus.PENDING)[:limit]
+    
+    def claim_next_pr_review(
+        self,
+        owner: str,
+        lease_seconds: int = LEASE_SECONDS,
+        max_attempts: int = MAX_ATTEMPTS
+    ) -> dict | None:
+        """Атомарно забрать следующий pending PR review (PENDING -> REVIEWING).
+        
+        См. claim_next_issue.
+        """
+        return self._claim_next(
+            self.pr_reviews,
+            pending=PRReviewStatus.PENDING,
+            active=PRReviewStatus.REVIEWING,
+            dead=PRReviewStatus.DEAD,
+            owner=owner,
+            lease_seconds=lease_seconds,
+            max_attempts=max_attempts
+        )
+    
+    def heartbeat_pr_review(self, doc_id: int, owner: str, lease_seconds: int = LEASE_SECONDS) -> bool:
+        """Продлить lease PR review в обработке."""
+        return self._heartbeat(self.pr_reviews, doc_id, owner, PRReviewStatus.REVIEWING, lease_seconds)
+    
+    def requeue_expired_pr_reviews(self, max_attempts: int = MAX_ATTEMPTS, lease_seconds: int = LEASE_SECONDS) -> list:
+        """Вернуть в PENDING (с backoff) зависшие REVIEWING PR reviews (упавший воркер)."""
+        return self._requeue_expired(
+            self.pr_reviews,
+            pending=PRReviewStatus.PENDING,
+            active=PRReviewStatus.REVIEWING,
+            dead=PRReviewStatus.DEAD,
+            lease_seconds=lease_seconds,
+            max_attempts=max_attempts
+        )
     
     def get_pr_review_by_id(self, doc_id: int) -> dict | None:
         """Получить PR review по ID."""
-        result = self.pr_reviews.get(doc_id=doc_id)
+        result = self.pr_reviews.get(doc_id)
         if result:
             result['doc_id'] = doc_id
         return result
     
     def get_pr_review_by_number(self, repo: str, pr_number: int) -> dict | None:
-        """Получить PR review по номеру."""
-        Review = Query()
-        results = self.pr_reviews.search(
-            (Review.repo == repo) & (Review.pr_number == pr_number)
-        )
+        """Получить PR review по номеру.
+        
+        Если в горячей таблице нет - ищется в архиве (с пометкой "archived": True).
+        """
+        results = self.pr_reviews.find(repo=repo, pr_number=pr_number)
         if results:
-            results[0]['doc_id'] = results[0].doc_id
-            return results[0]
-        return None
+            # Старые записи PR - отменённые новым push (SUPERSEDED) review
+            return self._latest(self.pr_reviews, results)
+        return self.archive.find("pr_reviews", repo=repo, pr_number=pr_number)
     
     def set_pr_reviewing(self, doc_id: int) -> None:
         """Отметить PR review как в обработке."""
         self.pr_reviews.update({
             "status": PRReviewStatus.REVIEWING,
             "updated_at": datetime.now().isoformat()
-        }, doc_ids=[doc_id])
+        }, doc_id)
     
-    def set_pr_review_completed(self, doc_id: int, review_results: list, all_passed: bool) -> None:
+    def set_pr_review_completed(
+        self,
+        doc_id: int,
+        review_results: list,
+        all_passed: bool,
+        head_sha: str = None,
+        owner: str = None
+    ) -> bool:
         """Отметить PR review как завершённый.
         
         Args:
             doc_id: ID записи
             review_results: [{file, issue_solved, notes}]
             all_passed: True если все файлы прошли review
+            head_sha: Коммит, который реально проверен
+            owner: Воркер, который держит lease (None - без проверки)
+            
+        Returns:
+            False если review тем временем отменён новым push (SUPERSEDED)
+            или lease уже не наш
         """
         status = PRReviewStatus.APPROVED if all_passed else PRReviewStatus.REJECTED
-        self.pr_reviews.update({
+        update = {
             "status": status,
             "review_results": review_results,
             "error": None,
+            "lease_owner": None,
+            "lease_expires_at": None,
             "updated_at": datetime.now().isoformat()
-        }, doc_ids=[doc_id])
+        }
+        if head_sha:
+            update["head_sha"] = head_sha
+        with self.db.transaction():
+            review = self.pr_reviews.get(doc_id)
+            if not review or review.get("status") == PRReviewStatus.SUPERSEDED or not self._owns(review, owner):
+                return False
+            self.pr_reviews.update(update, doc_id)
+            return True
     
-    def set_pr_review_failed(self, doc_id: int, error: str) -> None:
-        """Отметить PR review как неудачный."""
-        review = self.pr_reviews.get(doc_id=doc_id)
-        attempts = (review.get("attempts", 0) + 1) if review else 1
-        self.pr_reviews.update({
-            "status": PRReviewStatus.FAILED,
-            "error": error,
-            "attempts": attempts,
-            "updated_at": datetime.now().isoformat()
-        }, doc_ids=[doc_id])
+    def is_pr_review_superseded(self, doc_id: int) -> bool:
+        """Review отменён новым push в PR - воркеру пора бросить работу."""
+        review = self.pr_reviews.get(doc_id)
+        return bool(review) and review.get("status") == PRReviewStatus.SUPERSEDED
+    
+    def set_pr_review_failed(
+        self,
+        doc_id: int,
+        error: str,
+        retry: bool = True,
+        max_attempts: int = MAX_ATTEMPTS,
+        owner: str = None
+    ) -> str | bool | None:
+        """Отметить попытку PR review как неудачную.
+        
+        Повтор с backoff, после max_attempts - DEAD (см. set_failed).
+        False - lease уже не наш, запись не тронута.
+        """
+        return self._schedule_retry(
+            self.pr_reviews,
+            doc_id,
+            error=error,
+            pending=PRReviewStatus.PENDING,
+            failed=PRReviewStatus.FAILED,
+            dead=PRReviewStatus.DEAD,
+            retry=retry,
+            max_attempts=max_attempts,
+            owner=owner
+        )
     
     def increment_pr_review_attempts(self, doc_id: int) -> int:
         """Увеличить счётчик попыток PR review."""
-        review = self.pr_reviews.get(doc_id=doc_id)
+        review = self.pr_reviews.get(doc_id)
         attempts = (review.get("attempts", 0) + 1) if review else 1
         self.pr_reviews.update({
             "attempts": attempts,
             "updated_at": datetime.now().isoformat()
-        }, doc_ids=[doc_id])
+        }, doc_id)
         return attempts
 
 
 # Singleton instance
 db = IssueDB()
+
+
+def main():
+    """CLI для обслуживания БД"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="IssueDB maintenance")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("stats", help="Print queue statistics")
+    subparsers.add_parser("check-counters", help="Rebuild status counters from scratch and report drift")
+    archive_parser = subparsers.add_parser("archive", help="Move finished jobs to the cold archive")
+    archive_parser.add_argument(
+        "--days",
+        type=float,
+        default=ARCHIVE_AFTER_DAYS,
+        help=f"Archive jobs finished more than N days ago (default: {ARCHIVE_AFTER_DAYS:g})"
+    )
+    
+    args = parser.parse_args()
+    
+    if args.command == "stats":
+        for key, value in db.get_stats().items():
+            print(f"{key}: {value}")
+    elif args.command == "check-counters":
+        drift = db.check_counters()
+        if not drift:
+            print("✅ Counters are consistent")
+        else:
+            print(f"⚠️ Fixed {len(drift)} counter(s):")
+            for key, (old, new) in sorted(drift.items()):
+                print(f"   {key}: {old} -> {new}")
+    elif args.command == "archive":
+        archived = db.archive_finished(older_than_days=args.days)
+        print(f"📦 Archived {archived['issues']} issue(s), {archived['pr_reviews']} PR review(s)")
+
+
+if __name__ == "__main__":
+    main()
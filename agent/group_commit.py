@@ -0,0 +1,132 @@
+"""Group commit - запись пачки параллельных запросов одной транзакцией"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable
+
+# Сколько ждать попутных запросов после первого (миллисекунды), 0 - выключено
+GROUP_COMMIT_MS = float(os.getenv("GROUP_COMMIT_MS", "5"))
+# Максимум запросов в одной транзакции
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "200"))
+
+
+class GroupCommit:
+    """Собирает запросы на запись от разных потоков в пачки.
+
+    Первый запрос открывает окно window_ms, все запросы, пришедшие за
+    это время, записываются одним вызовом flush (одна транзакция, одна
+    запись файла). submit возвращает результат только после того, как
+    пачка записана - webhook подтверждается уже сохранённым.
+
+    Нельзя вызывать submit внутри открытой транзакции БД: flush идёт
+    из отдельного потока и будет ждать ту же блокировку.
+    """
+
+    def __init__(
+        self,
+        flush: Callable[[list], list],
+        window_ms: float = GROUP_COMMIT_MS,
+        max_batch: int = GROUP_COMMIT_MAX_BATCH
+    ):
+        """
+        Args:
+            flush: Записывает пачку запросов, возвращает результаты в том же порядке
+            window_ms: Окно сбора пачки в миллисекундах
+            max_batch: Максимальный размер пачки
+        """
+        self.flush = flush
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "flushes": 0,
+            "writes": 0,
+            "max_batch": 0,
+            "flush_ms_total": 0.0,
+            "flush_ms_max": 0.0,
+            "wait_ms_total": 0.0,
+            "wait_ms_max": 0.0,
+        }
+
+    def submit(self, request):
+        """Ставит запрос в пачку и ждёт её записи.
+
+        Returns:
+            Результат flush для этого запроса (ошибка flush пробрасывается)
+        """
+        future = Future()
+        self._ensure_thread()
+        self._queue.put((request, future, time.monotonic()))
+        return future.result()
+
+    def _ensure_thread(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+                self._thread.start()
+
+    def _collect(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    # Окно закрыто - забираем только то, что уже в очереди
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.monotonic()
+            try:
+                results = self.flush([request for request, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+            else:
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+            finished = time.monotonic()
+            self._record(len(batch), finished - started, [finished - queued for _, _, queued in batch])
+
+    def _record(self, size: int, flush_seconds: float, waits: list) -> None:
+        flush_ms = flush_seconds * 1000
+        with self._stats_lock:
+            stats = self._stats
+            stats["flushes"] += 1
+            stats["writes"] += size
+            stats["max_batch"] = max(stats["max_batch"], size)
+            stats["flush_ms_total"] += flush_ms
+            stats["flush_ms_max"] = max(stats["flush_ms_max"], flush_ms)
+            stats["wait_ms_total"] += sum(waits) * 1000
+            stats["wait_ms_max"] = max(stats["wait_ms_max"], max(waits) * 1000)
+        if size > 1:
+            print(f"📝 Group commit: {size} writes in {flush_ms:.1f} ms")
+
+    def stats(self) -> dict:
+        """Размеры пачек и задержки (с момента запуска процесса)."""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        flushes = stats["flushes"] or 1
+        writes = stats["writes"] or 1
+        return {
+            "flushes": stats["flushes"],
+            "writes": stats["writes"],
+            "avg_batch": round(stats["writes"] / flushes, 2),
+            "max_batch": stats["max_batch"],
+            "avg_flush_ms": round(stats["flush_ms_total"] / flushes, 2),
+            "max_flush_ms": round(stats["flush_ms_max"], 2),
+            "avg_wait_ms": round(stats["wait_ms_total"] / writes, 2),
+            "max_wait_ms": round(stats["wait_ms_max"], 2),
+        }
@@ -1,25 +1,49 @@
 """Issue Solver - основной модуль для решения GitHub Issues"""
+import contextvars
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional, List
+from typing import Callable, Optional, List
 from dotenv import load_dotenv
 
 from repo_manager import RepoManager
 from ai_client import ai_client
+from checkpoint import Checkpoint
+from leases import LeaseLost
+from patches import PatchError, apply_edits, validate
+from quotas import quota_scope
 from database import db, IssueStatus
 
 load_dotenv()
 
 MAX_FIX_ITERATIONS = int(os.getenv("MAX_FIX_ITERATIONS", "3"))
+# Сколько файлов анализируется одновременно (параллельные запросы к LLM)
+ANALYSIS_CONCURRENCY = int(os.getenv("ANALYSIS_CONCURRENCY", "4"))
+
+
+class AnalysisError(Exception):
+    """Анализ файла не завершён из-за ошибки LLM - файл нужно проанализировать заново.
+    
+    partial - содержимое с уже применёнными (но не проверенными) исправлениями или None.
+    """
+    
+    def __init__(self, message: str, partial: Optional[str] = None):
+        super().__init__(message)
+        self.partial = partial
 
 
 class IssueSolver:
     """Решает issues - клонирует репо, анализирует файлы, создаёт PR"""
     
-    def __init__(self, repo_full_name: str):
+    def __init__(self, repo_full_name: str, repo_manager: RepoManager = None):
+        """
+        Args:
+            repo_full_name: owner/repo
+            repo_manager: Общий клон для нескольких issues одного repo (coalescing)
+        """
         self.repo_full_name = repo_full_name
-        self.repo = RepoManager(repo_full_name)
+        self.repo = repo_manager or RepoManager(repo_full_name)
     
     def extract_mentioned_files(self, issue_text: str) -> List[str]:
         """Извлекает упоминания файлов из текста Issue.
@@ -96,12 +120,156 @@ class IssueSolver:
         
         return priority_files + other_files
     
-    def solve_issue(self, issue_number: int, doc_id: int = None) -> Optional[int]:
+    def fix_file(self, filepath: Path, repo_path: Path, issue_description: str) -> Optional[str]:
+        """Цикл анализ-фикс для одного файла (до MAX_FIX_ITERATIONS раз).
+        
+        Итерации внутри файла последовательные - каждая проверяет
+        результат предыдущей. Разные файлы можно обрабатывать параллельно.
+        
+        Returns:
+            Исправленное содержимое или None, если файл не менялся
+        
+        Raises:
+            AnalysisError: запрос к LLM не удался - результат файла неизвестен
+        """
+        content = self.repo.read_file(filepath)
+        if not content:
+            return None
+        
+        relative_path = filepath.relative_to(repo_path)
+        
+        # Пропускаем слишком большие файлы
+        if len(content) > 50000:
+            print(f"⏭️ Skipping {relative_path} (too large)")
+            return None
+        
+        print(f"\n📄 Analyzing: {relative_path}")
+        
+        current_content = content
+        file_changed = False
+        
+        for iteration in range(MAX_FIX_ITERATIONS):
+            result = ai_client.analyze_file(
+                filepath=filepath,
+                file_content=current_content,
+                issue_description=issue_description
+            )
+            
+            fixed_content = None
+            if result.issue_found and result.edits:
+                try:
+                    fixed_content = apply_edits(current_content, result.edits)
+                    validate(filepath, fixed_content)
+                except PatchError as e:
+                    # Правки не легли на файл - просим исправление целым файлом
+                    print(f"  ⚠️ {relative_path}: patch rejected ({e}), requesting full file")
+                    result = ai_client.analyze_file(
+                        filepath=filepath,
+                        file_content=current_content,
+                        issue_description=issue_description,
+                        mode="full"
+                    )
+                    fixed_content = None
+            if result.error:
+                partial = current_content if file_changed and current_content != content else None
+                raise AnalysisError(f"{relative_path}: {result.explanation}", partial)
+            if fixed_content is None and result.issue_found and result.code_correction:
+                fixed_content = result.code_correction
+            
+            if fixed_content is not None:
+                print(f"  [{iteration + 1}/{MAX_FIX_ITERATIONS}] 🔧 {relative_path}: issue found, applying fix...")
+                print(f"  💡 {result.explanation[:100]}...")
+                current_content = fixed_content
+                file_changed = True
+            else:
+                if iteration > 0:
+                    print(f"  ✅ {relative_path}: fix verified after {iteration} iteration(s)")
+                else:
+                    print(f"  ✓ {relative_path}: no issues")
+                break
+        
+        if file_changed and current_content != content:
+            return current_content
+        return None
+    
+    def analyze_files(
+        self,
+        files: List[Path],
+        repo_path: Path,
+        issue_description: str,
+        checkpoint: Checkpoint = None
+    ) -> List[Optional[str]]:
+        """Параллельный анализ файлов (не больше ANALYSIS_CONCURRENCY одновременно).
+        
+        Файлы отдаются в пул в порядке приоритета, так что упомянутые
+        в issue начинают анализироваться первыми.
+        
+        Args:
+            checkpoint: Файлы из checkpoint не отправляются в LLM повторно,
+                результат каждого нового файла сразу сохраняется в него.
+                Файлы, анализ которых упал, в checkpoint не попадают
+        
+        Returns:
+            Исправленное содержимое (или None) для каждого файла, в порядке files
+        
+        Raises:
+            AnalysisError: ни одного исправления, а анализ части файлов
+                упал - "исправлений нет" утверждать нельзя, нужен повтор
+        """
+        failed = []
+        
+        def analyze(filepath: Path) -> Optional[str]:
+            relative_path = str(filepath.relative_to(repo_path))
+            if checkpoint is not None:
+                done, fixed_content = checkpoint.get(relative_path)
+                if done:
+                    return fixed_content
+            try:
+                fixed_content = self.fix_file(filepath, repo_path, issue_description)
+            except AnalysisError as e:
+                # Не записываем в checkpoint - повтор отправит файл в LLM снова
+                print(f"  ⚠️ {e}")
+                failed.append(relative_path)
+                return e.partial
+            if checkpoint is not None:
+                checkpoint.record(relative_path, fixed_content)
+            return fixed_content
+        
+        workers = max(1, min(ANALYSIS_CONCURRENCY, len(files)))
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="analyze")
+        try:
+            # Потоки пула получают контекст задачи (квота installation)
+            futures = [pool.submit(contextvars.copy_context().run, analyze, filepath) for filepath in files]
+            results = [future.result() for future in futures]
+        except BaseException:
+            # Ошибка в одном файле валит issue - остальные файлы не ждём
+            pool.shutdown(wait=True, cancel_futures=True)
+            raise
+        pool.shutdown(wait=True)
+        
+        if failed:
+            print(f"⚠️ Analysis failed for {len(failed)} file(s): {', '.join(sorted(failed))}")
+            if all(fixed is None for fixed in results):
+                raise AnalysisError(f"analysis failed for {len(failed)} file(s), no fixes found in the rest")
+        return results
+    
+    def solve_issue(
+        self,
+        issue_number: int,
+        doc_id: int = None,
+        cleanup: bool = True,
+        owner: str = None,
+        lease_lost: Callable[[], bool] = None
+    ) -> Optional[int]:
         """Обрабатывает один issue.
         
         Args:
             issue_number: Номер issue
             doc_id: ID записи в БД (опционально)
+            cleanup: Удалить клон после работы (False - клон нужен следующему issue)
+            owner: Воркер, держащий lease (записи в БД только пока lease его)
+            lease_lost: True - lease перешёл к другому воркеру; тогда перед
+                push, PR и комментарием работа бросается (LeaseLost)
             
         Returns:
             Номер созданного PR или None
@@ -127,6 +295,13 @@ class IssueSolver:
             # 1. Клонируем/обновляем репо
             repo_path = self.repo.clone_or_pull()
             
+            # Прогресс прошлой попытки годится, только если код и issue не менялись
+            checkpoint = Checkpoint.open(
+                self.repo_full_name, issue_number, self.repo.head_sha(), issue_description
+            )
+            if checkpoint.resumed:
+                print(f"⏩ Resuming from checkpoint: {checkpoint.resumed} file(s) already analyzed")
+            
             # 2. Создаём ветку
             branch_name = f"fix/issue-{issue_number}"
             self.repo.create_branch(branch_name)
@@ -139,49 +314,19 @@ class IssueSolver:
             mentioned_files = self.extract_mentioned_files(issue_description)
             files = self.prioritize_files(files, mentioned_files, repo_path)
             
-            # 4. Анализируем каждый файл с циклом анализ-фикс
-            files_fixed = []
+            # 4. Анализируем файлы параллельно, каждый - с циклом анализ-фикс
+            fixes = self.analyze_files(files, repo_path, issue_description, checkpoint)
             
-            for filepath in files:
-                content = self.repo.read_file(filepath)
-                if not content:
-                    continue
-                
-                # Пропускаем слишком большие файлы
-                if len(content) > 50000:
-                    print(f"⏭️ Skipping {filepath.name} (too large)")
-                    continue
-                
-                relative_path = filepath.relative_to(repo_path)
-                print(f"\n📄 Analyzing: {relative_path}")
-                
-                # Цикл анализ-фикс (до MAX_FIX_ITERATIONS раз)
-                current_content = content
-                file_changed = False
-                
-                for iteration in range(MAX_FIX_ITERATIONS):
-                    result = ai_client.analyze_file(
-                        filepath=filepath,
-                        file_content=current_content,
-                        issue_description=issue_description
-                    )
-                    
-                    if result.issue_found and result.code_correction:
-                        print(f"  [{iteration + 1}/{MAX_FIX_ITERATIONS}] 🔧 Issue found, applying fix...")
-                        print(f"  💡 {result.explanation[:100]}...")
-                        current_content = result.code_correction
-                        file_changed = True
-                    else:
-                        if iteration > 0:
-                            print(f"  ✅ Fix verified after {iteration} iteration(s)")
-                        else:
-                            print(f"  ✓ No issues in this file")
-                        break
-                
-                # Если контент изменился, записываем
-                if file_changed and current_content != content:
-                    self.repo.write_file(filepath, current_content)
-                    files_fixed.append(str(relative_path))
+            # Анализ долгий: за это время reaper мог отдать issue другому воркеру
+            if lease_lost and lease_lost():
+                raise LeaseLost(f"lease of issue #{issue_number} was lost, not publishing results")
+            
+            # Записываем исправления в порядке приоритета
+            files_fixed = []
+            for filepath, fixed_content in zip(files, fixes):
+                if fixed_content is not None:
+                    self.repo.write_file(filepath, fixed_content)
+                    files_fixed.append(str(filepath.relative_to(repo_path)))
             
             # 5. Если есть изменения, коммитим и создаём PR
             if files_fixed:
@@ -194,7 +339,9 @@ class IssueSolver:
                 commit_msg = f"fix: resolve issue #{issue_number}\n\n{title}"
                 self.repo.commit(commit_msg)
                 
-                # Push
+                # Push (lease проверяем ещё раз - коммит мог занять время)
+                if lease_lost and lease_lost():
+                    raise LeaseLost(f"lease of issue #{issue_number} was lost, not pushing {branch_name}")
                 self.repo.push(branch_name)
                 
                 # Создаём PR
@@ -229,15 +376,17 @@ This PR automatically fixes the issue described in #{issue_number}.
                     print(f"⚠️ Failed to add comment: {e}")
                 
                 # Отмечаем успех в БД
-                if doc_id:
-                    db.set_completed(doc_id, pr_number)
+                if doc_id and not db.set_completed(doc_id, pr_number, owner=owner):
+                    print(f"⚠️ Lease of issue #{issue_number} lost, status left to the new owner")
+                checkpoint.delete()
                 
                 print("=" * 60)
                 print(f"✅ Created PR #{pr_number} for issue #{issue_number}")
                 print("=" * 60)
                 
                 # Cleanup local repo
-                self.repo.cleanup()
+                if cleanup:
+                    self.repo.cleanup()
                 
                 return pr_number
             else:
@@ -257,22 +406,26 @@ This PR automatically fixes the issue described in #{issue_number}.
                     print(f"⚠️ Failed to add comment: {e}")
                 
                 if doc_id:
-                    db.set_failed(doc_id, "No fixes found")
+                    # Повтор с тем же описанием даст тот же результат
+                    db.set_failed(doc_id, "No fixes found", retry=False, owner=owner)
+                checkpoint.delete()
                 
                 # Cleanup local repo
-                self.repo.cleanup()
+                if cleanup:
+                    self.repo.cleanup()
                 
                 return None
                 
         except Exception as e:
             print(f"❌ Error processing issue: {e}")
             if doc_id:
-                db.set_failed(doc_id, str(e))
+                db.set_failed(doc_id, str(e), owner=owner)
             # Cleanup on error too
-            try:
-                self.repo.cleanup()
-            except:
-                pass
+            if cleanup:
+                try:
+                    self.repo.cleanup()
+                except:
+                    pass
             raise
     
     def fix_from_review(self, pr_number: int, review_comments: str) -> bool:
@@ -289,11 +442,19 @@ This PR automatically fixes the issue described in #{issue_number}.
         return False
 
 
-def process_issue_from_db(issue_data: dict) -> Optional[int]:
+def process_issue_from_db(
+    issue_data: dict,
+    repo_manager: RepoManager = None,
+    owner: str = None,
+    lease_lost: Callable[[], bool] = None
+) -> Optional[int]:
     """Обрабатывает issue из БД.
     
     Args:
         issue_data: Данные issue из БД
+        repo_manager: Общий клон сессии (клон тогда не удаляется)
+        owner: Воркер, взявший issue (lease_owner)
+        lease_lost: См. IssueSolver.solve_issue
         
     Returns:
         Номер PR или None
@@ -302,8 +463,12 @@ def process_issue_from_db(issue_data: dict) -> Optional[int]:
     repo = issue_data.get('repo')
     issue_number = issue_data.get('issue_number')
     
-    solver = IssueSolver(repo)
-    return solver.solve_issue(issue_number, doc_id)
+    solver = IssueSolver(repo, repo_manager)
+    # Токены LLM списываются с квоты installation этого issue
+    with quota_scope(issue_data):
+        return solver.solve_issue(
+            issue_number, doc_id, cleanup=repo_manager is None, owner=owner, lease_lost=lease_lost
+        )
 
 
 def main():
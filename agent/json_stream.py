@@ -0,0 +1,91 @@
+"""JSON Stream - разбор JSON из ответов LLM: целиком, с мусором вокруг и по мере прихода"""
+import json
+
+# strict=False: модели иногда ставят в строки настоящие переводы строк
+_decoder = json.JSONDecoder(strict=False)
+_WHITESPACE = " \t\r\n"
+
+
+def extract_json(text: str) -> dict:
+    """Первый JSON объект в ответе модели.
+
+    Допускает markdown обёртку, пояснения до и после объекта и
+    неэкранированные управляющие символы внутри строк.
+
+    Raises:
+        ValueError: в тексте нет целого JSON объекта
+    """
+    start = text.find("{")
+    while start >= 0:
+        try:
+            value, _ = _decoder.raw_decode(text, start)
+        except json.JSONDecodeError:
+            value = None
+        if isinstance(value, dict):
+            return value
+        start = text.find("{", start + 1)
+    raise ValueError(f"no JSON object in response: {text[:80]!r}")
+
+
+class JSONStreamReader:
+    """Разбирает верхний уровень JSON объекта из неполного текста.
+
+    feed() дописывает очередной кусок стрима; поля, значение которых уже
+    пришло целиком, появляются в values. Разобранный префикс повторно
+    не читается. Markdown обёртка (```json) перед объектом пропускается.
+    Вложенные объекты и длинные строки ждут конца значения - читатель
+    нужен для ранних полей вроде issue_found, а не для всего ответа.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.values = {}
+        self._pos = None  # позиция после "{" или после последнего разобранного поля
+        self._done = False
+
+    def feed(self, chunk: str) -> dict:
+        """Добавляет кусок текста и возвращает уже разобранные поля."""
+        self.text += chunk
+        if self._pos is None:
+            start = self.text.find("{")
+            if start < 0:
+                return self.values
+            self._pos = start + 1
+
+        while not self._done and self._read_field():
+            pass
+        return self.values
+
+    def _skip(self, pos: int, separators: str = _WHITESPACE) -> int:
+        while pos < len(self.text) and self.text[pos] in separators:
+            pos += 1
+        return pos
+
+    def _read_field(self) -> bool:
+        """Читает одно поле "key": value. False - поле пришло не полностью."""
+        pos = self._skip(self._pos, _WHITESPACE + ",")
+        if pos >= len(self.text):
+            return False
+        if self.text[pos] == "}":
+            self._done = True
+            return False
+        try:
+            key, pos = _decoder.raw_decode(self.text, pos)
+        except json.JSONDecodeError:
+            return False
+
+        pos = self._skip(pos)
+        if pos >= len(self.text) or self.text[pos] != ":":
+            return False
+        pos = self._skip(pos + 1)
+        try:
+            value, end = _decoder.raw_decode(self.text, pos)
+        except json.JSONDecodeError:
+            return False
+        # Число могло оборваться на середине ("12" из "125") - ждём разделитель
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and end >= len(self.text):
+            return False
+
+        self.values[key] = value
+        self._pos = end
+        return True
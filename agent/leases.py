@@ -0,0 +1,90 @@
+"""Leases - heartbeat для задач, которые воркер держит в работе"""
+import os
+import threading
+import time
+from typing import Callable
+
+# Как часто воркер продлевает lease (должно быть заметно меньше LEASE_SECONDS)
+HEARTBEAT_SECONDS = int(os.getenv("HEARTBEAT_SECONDS", "30"))
+# Как часто воркер ищет задачи с просроченным lease
+REAPER_INTERVAL = int(os.getenv("REAPER_INTERVAL", "60"))
+# Как часто review спрашивает БД, не отменён ли он новым push (секунды)
+SUPERSEDED_CHECK_SECONDS = float(os.getenv("SUPERSEDED_CHECK_SECONDS", "5"))
+
+
+class LeaseLost(Exception):
+    """Lease задачи перешёл к другому воркеру - результат публиковать нельзя."""
+
+
+class ThrottledCheck:
+    """Проверка отмены задачи не чаще раза в interval секунд.
+
+    Её вызывает каждый поток пула перед каждым файлом, а на TinyDB
+    обращение к БД - чтение db.json под общей блокировкой. Между
+    запросами (и пока другой поток ждёт ответа БД) возвращается прошлый
+    ответ; True запоминается - отменённая задача не оживает.
+    """
+
+    def __init__(self, check: Callable[[], bool], interval: float = SUPERSEDED_CHECK_SECONDS):
+        self.check = check
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._result = False
+        self._checked_at = None
+
+    def __call__(self) -> bool:
+        if self._result or not self._lock.acquire(blocking=False):
+            return self._result
+        try:
+            now = time.monotonic()
+            if self._checked_at is None or now - self._checked_at >= self.interval:
+                self._checked_at = now
+                self._result = bool(self.check())
+            return self._result
+        finally:
+            self._lock.release()
+
+
+class Heartbeat:
+    """Фоновый поток, продлевающий lease, пока задача обрабатывается.
+
+    Использование:
+        with Heartbeat(lambda: db.heartbeat_issue(doc_id, worker_id)) as heartbeat:
+            process(..., lease_lost=lambda: heartbeat.lost)
+
+    После потери lease (lost) задачу уже ведёт другой воркер: push, PR и
+    комментарии делать нельзя, а запись в БД не обновится (owner не наш).
+    """
+
+    def __init__(self, renew: Callable[[], bool], interval: int = HEARTBEAT_SECONDS):
+        """
+        Args:
+            renew: Продлевает lease, возвращает False если lease потерян
+            interval: Интервал heartbeat в секундах
+        """
+        self.renew = renew
+        self.interval = interval
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                if not self.renew():
+                    self.lost = True
+                    print("⚠️ Lease lost - job was requeued by the reaper")
+                    return
+            except Exception as e:
+                # Временная ошибка БД - пробуем на следующем тике
+                print(f"⚠️ Heartbeat failed: {e}")
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name="lease-heartbeat", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        return False
@@ -0,0 +1,161 @@
+"""LLM Cache - общий для всех процессов кэш ответов LLM на диске (LRU + TTL)"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+# Файл кэша - один на server, worker и pr_review_worker
+LLM_CACHE_DB = os.getenv("LLM_CACHE_DB", str(Path(__file__).parent / "llm_cache.sqlite3"))
+# Максимальный размер ответов в кэше (МБ), 0 - кэш выключен
+LLM_CACHE_MAX_MB = int(os.getenv("LLM_CACHE_MAX_MB", "256"))
+# Сколько часов ответ считается актуальным
+LLM_CACHE_TTL_HOURS = int(os.getenv("LLM_CACHE_TTL_HOURS", "72"))
+
+
+def cache_key(model: str, temperature: float, messages: list) -> str:
+    """Ключ кэша: sha256 от модели, температуры и всех сообщений промпта."""
+    payload = json.dumps(
+        {"model": model, "temperature": temperature, "messages": messages},
+        ensure_ascii=False,
+        sort_keys=True
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """Ответы LLM по ключу cache_key в SQLite.
+
+    Повтор задачи после ошибки, requeue и повторный @coding-agent
+    отправляют те же промпты - ответ берётся с диска без запроса к LLM,
+    rate limiter и квоты не тратятся. Файл открывают все процессы;
+    запись и вытеснение идут в транзакции BEGIN IMMEDIATE. Когда размер
+    ответов превышает max_bytes, удаляются давно не читанные записи.
+    Счётчики hit/miss общие для всех процессов.
+    """
+
+    def __init__(
+        self,
+        path: str = LLM_CACHE_DB,
+        max_bytes: int = LLM_CACHE_MAX_MB * 1024 * 1024,
+        ttl: float = LLM_CACHE_TTL_HOURS * 3600
+    ):
+        """
+        Args:
+            path: SQLite файл кэша
+            max_bytes: Предел суммарного размера ответов
+            ttl: Время жизни ответа (секунды)
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+            )
+        return self._conn
+
+    def _transaction(self, fn):
+        """Выполняет fn(conn, now) в эксклюзивной транзакции."""
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(conn, time.time())
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return result
+
+    @staticmethod
+    def _count(conn, name: str) -> None:
+        conn.execute(
+            "INSERT INTO counters (name, value) VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+            (name,)
+        )
+
+    def get(self, key: str) -> str | None:
+        """Ответ из кэша или None (нет записи или истёк TTL)."""
+        def lookup(conn, now):
+            row = conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] < self.ttl:
+                conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+                self._count(conn, "hits")
+                return row[0]
+            if row:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._count(conn, "misses")
+            return None
+
+        return self._transaction(lookup)
+
+    def put(self, key: str, response: str) -> None:
+        """Сохраняет ответ и вытесняет старые записи сверх max_bytes."""
+        size = len(response.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+
+        def store(conn, now):
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, response, size, now, now)
+            )
+            conn.execute("DELETE FROM responses WHERE created_at <= ?", (now - self.ttl,))
+            excess = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0] - self.max_bytes
+            if excess <= 0:
+                return
+            evicted = []
+            for old_key, old_size in conn.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+                if excess <= 0:
+                    break
+                evicted.append((old_key,))
+                excess -= old_size
+            conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+            conn.execute(
+                "INSERT INTO counters (name, value) VALUES ('evictions', ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                (len(evicted),)
+            )
+
+        self._transaction(store)
+
+    def delete(self, key: str) -> None:
+        """Удаляет ответ (например, если его не удалось разобрать)."""
+        self._transaction(lambda conn, now: conn.execute("DELETE FROM responses WHERE key = ?", (key,)))
+
+    def get_stats(self) -> dict:
+        """Размер кэша и счётчики hit/miss всех процессов."""
+        def read(conn, now):
+            counters = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+            entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            return counters, entries, size
+
+        counters, entries, size = self._transaction(read)
+        hits = counters.get("hits", 0)
+        misses = counters.get("misses", 0)
+        return {
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "hits": hits,
+            "misses": misses,
+            "evictions": counters.get("evictions", 0),
+            "hit_rate": round(hits / (hits + misses), 3) if hits + misses else 0.0,
+        }
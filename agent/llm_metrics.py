@@ -0,0 +1,54 @@
+"""LLM Metrics - общие для всех процессов счётчики разбора ответов LLM"""
+import sqlite3
+import threading
+
+from rate_limiter import RATE_LIMIT_DB
+
+# Исходы разбора ответа: с первого раза, после repair запроса, не разобран
+PARSE_OUTCOMES = ("ok", "repaired", "failed")
+
+
+class ParseMetrics:
+    """Сколько ответов каждого вида (analysis, review, ...) не разобралось.
+
+    Счётчики лежат в SQLite файле rate limiter - server показывает
+    статистику worker и pr_review_worker.
+    """
+
+    def __init__(self, path: str = RATE_LIMIT_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_parse_stats ("
+                "kind TEXT NOT NULL, outcome TEXT NOT NULL, count INTEGER NOT NULL, "
+                "PRIMARY KEY (kind, outcome))"
+            )
+        return self._conn
+
+    def record(self, kind: str, outcome: str) -> None:
+        """Учитывает один ответ: outcome - один из PARSE_OUTCOMES."""
+        with self._lock:
+            self._connection().execute(
+                "INSERT INTO llm_parse_stats (kind, outcome, count) VALUES (?, ?, 1) "
+                "ON CONFLICT(kind, outcome) DO UPDATE SET count = count + 1",
+                (kind, outcome)
+            )
+
+    def get_stats(self) -> dict:
+        """По видам ответов: счётчики исходов и доля ответов, не разобранных с первого раза."""
+        with self._lock:
+            rows = self._connection().execute("SELECT kind, outcome, count FROM llm_parse_stats").fetchall()
+
+        stats = {}
+        for kind, outcome, count in rows:
+            stats.setdefault(kind, dict.fromkeys(PARSE_OUTCOMES, 0))[outcome] = count
+        for counts in stats.values():
+            total = sum(counts[outcome] for outcome in PARSE_OUTCOMES)
+            counts["parse_failure_rate"] = round((counts["repaired"] + counts["failed"]) / total, 3) if total else 0.0
+        return stats
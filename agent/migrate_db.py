@@ -0,0 +1,296 @@
+"""Migrate DB - перенос очереди между db.json (TinyDB) и SQLite без загрузки файла целиком"""
+import json
+import os
+import sys
+from pathlib import Path
+
+from storage import COUNTED_TABLES, SQLiteStorage, _plain
+
+# Сколько записей загружается одной транзакцией
+CHUNK_SIZE = 500
+# Сколько байт читается из db.json за раз
+READ_BYTES = 1024 * 1024
+
+
+class TinyDBStreamReader:
+    """Потоковый разбор db.json: {"table": {"doc_id": {...}, ...}, ...}.
+
+    В памяти держится только текущая запись и буфер чтения - размер
+    файла значения не имеет. Сами записи разбираются json.raw_decode.
+    """
+
+    def __init__(self, f, read_bytes: int = READ_BYTES):
+        self.f = f
+        self.read_bytes = read_bytes
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        """Дочитывает следующий кусок файла. Returns: False если файл кончился."""
+        if self.eof:
+            return False
+        chunk = self.f.read(self.read_bytes)
+        if not chunk:
+            self.eof = True
+            return False
+        # Прочитанное уже не нужно - держим только хвост буфера
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _peek(self) -> str:
+        """Следующий значимый символ (пробелы пропускаются), "" в конце файла."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def _expect(self, char: str) -> None:
+        actual = self._peek()
+        if actual != char:
+            raise ValueError(f"Invalid TinyDB file: expected '{char}', got '{actual or 'EOF'}'")
+        self.pos += 1
+
+    def _value(self):
+        """Разбирает одно JSON значение, дочитывая файл, пока оно не закончится."""
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # Число у края буфера могло оборваться на середине
+            if end == len(self.buf) and not isinstance(value, (dict, list, str)) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def _members(self):
+        """Пары (ключ, значение) объекта, на начале которого стоит reader."""
+        self._expect("{")
+        if self._peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(":")
+            yield key
+
+            separator = self._peek()
+            self.pos += 1
+            if separator == "}":
+                return
+            if separator != ",":
+                raise ValueError(f"Invalid TinyDB file: expected ',' or '}}', got '{separator or 'EOF'}'")
+
+    def records(self):
+        """Записи файла: (table, doc_id, doc)."""
+        if self._peek() == "":
+            return  # пустой файл - пустая БД
+        for table in self._members():
+            for doc_id in self._members():
+                yield table, doc_id, self._value()
+
+
+def iter_tinydb(path: str):
+    """Потоковое чтение записей db.json: (table, doc_id, doc)."""
+    with open(path, "r", encoding="utf-8") as f:
+        yield from TinyDBStreamReader(f).records()
+
+
+def _chunks(records, size: int):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _expected_stats(status_counts: dict, archived: dict) -> dict:
+    """Статистика в формате IssueDB.get_stats по подсчёту записей."""
+    issues = status_counts.get("issues", {})
+    reviews = status_counts.get("pr_reviews", {})
+    stats = {status: issues.get(status, 0) for status in ("pending", "processing", "completed", "failed", "dead")}
+    stats["total"] = sum(issues.values())
+    for status in ("pending", "reviewing", "approved", "rejected", "failed", "dead", "superseded"):
+        stats[f"pr_{status}"] = reviews.get(status, 0)
+    stats["archived"] = archived.get("issues", 0)
+    stats["pr_archived"] = archived.get("pr_reviews", 0)
+    return stats
+
+
+def _count_status(status_counts: dict, table: str, doc: dict) -> None:
+    if table in COUNTED_TABLES:
+        counts = status_counts.setdefault(table, {})
+        status = _plain(doc.get("status"))
+        counts[status] = counts.get(status, 0) + 1
+
+
+def _stats_mismatch(expected: dict, actual: dict) -> dict:
+    return {
+        key: (value, actual.get(key, 0))
+        for key, value in expected.items()
+        if value != actual.get(key, 0)
+    }
+
+
+def import_tinydb(source: str, target: str, chunk_size: int = CHUNK_SIZE) -> dict:
+    """db.json -> SQLite, чанками по chunk_size записей с сохранением doc_id.
+
+    Returns:
+        Расхождения со статистикой {key: (в db.json, в SQLite)}, пусто если всё сошлось
+    """
+    from database import IssueDB
+
+    if Path(target).exists():
+        raise FileExistsError(f"{target} already exists, refusing to overwrite")
+
+    storage = SQLiteStorage(target)
+    status_counts = {}
+    meta = {}
+    loaded = 0
+    try:
+        for chunk in _chunks(iter_tinydb(source), chunk_size):
+            with storage.transaction():
+                by_table = {}
+                for table, doc_id, doc in chunk:
+                    if table in COUNTED_TABLES:
+                        by_table.setdefault(table, []).append(dict(doc, doc_id=int(doc_id)))
+                        _count_status(status_counts, table, doc)
+                    elif table == "meta":
+                        meta.update(doc)
+                    # counters не переносим - пересчитываются по данным
+                for table, docs in by_table.items():
+                    storage.table(table).load(docs)
+                    loaded += len(docs)
+            print(f"   Loaded {loaded} records")
+
+        with storage.transaction() as conn:
+            for key, value in meta.items():
+                storage.set_meta(key, value)
+            # ID заархивированных записей не должны выдаваться повторно
+            for table in COUNTED_TABLES:
+                last_id = meta.get(f"last_id:{table}", 0)
+                conn.execute("DELETE FROM sqlite_sequence WHERE name = ? AND seq < ?", (table, last_id))
+                conn.execute(
+                    "INSERT INTO sqlite_sequence (name, seq) SELECT ?, ? "
+                    "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = ?)",
+                    (table, last_id, table)
+                )
+            storage.rebuild_counters()
+    finally:
+        storage.close()
+
+    stats = IssueDB(target, backend="sqlite", group_commit_ms=0).get_stats()
+    return _stats_mismatch(_expected_stats(status_counts, meta.get("archived", {})), stats)
+
+
+def export_tinydb(source: str, target: str, chunk_size: int = CHUNK_SIZE) -> dict:
+    """SQLite -> db.json (откат), файл пишется потоково.
+
+    Returns:
+        Расхождения со статистикой {key: (в SQLite, в db.json)}, пусто если всё сошлось
+    """
+    from database import IssueDB
+
+    if Path(target).exists():
+        raise FileExistsError(f"{target} already exists, refusing to overwrite")
+
+    source_db = IssueDB(source, backend="sqlite", group_commit_ms=0)
+    storage = source_db.db
+    tmp_path = f"{target}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("{")
+            for table_index, table in enumerate(COUNTED_TABLES):
+                f.write(f"{', ' if table_index else ''}{json.dumps(table)}: {{")
+                exported = 0
+                for chunk in storage.table(table).scan(chunk_size):
+                    for doc in chunk:
+                        doc_id = doc.pop("doc_id")
+                        f.write(f"{', ' if exported else ''}{json.dumps(str(doc_id))}: {json.dumps(doc)}")
+                        exported += 1
+                f.write("}")
+                print(f"   Exported {exported} {table}")
+
+            # Последние выданные ID - чтобы TinyDB не выдал ID архивных записей повторно
+            meta = dict(storage.query("SELECT key, value FROM meta"))
+            meta = {key: json.loads(value) for key, value in meta.items()}
+            for table in COUNTED_TABLES:
+                rows = storage.query("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,))
+                if rows:
+                    meta[f"last_id:{table}"] = rows[0][0]
+            f.write(f", \"meta\": {{\"1\": {json.dumps(meta)}}}}}")
+        os.replace(tmp_path, target)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    # Проверка - повторным потоковым чтением получившегося файла
+    status_counts = {}
+    exported_meta = {}
+    for table, _, doc in iter_tinydb(target):
+        if table == "meta":
+            exported_meta.update(doc)
+        _count_status(status_counts, table, doc)
+    exported_stats = _expected_stats(status_counts, exported_meta.get("archived", {}))
+    return _stats_mismatch(source_db.get_stats(), exported_stats)
+
+
+def main():
+    """CLI entry point"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Migrate the queue between db.json and SQLite")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="db.json -> SQLite")
+    import_parser.add_argument("source", help="TinyDB file (db.json)")
+    import_parser.add_argument("target", help="New SQLite file")
+    export_parser = subparsers.add_parser("export", help="SQLite -> db.json (rollback)")
+    export_parser.add_argument("source", help="SQLite file")
+    export_parser.add_argument("target", help="New TinyDB file")
+    for sub in (import_parser, export_parser):
+        sub.add_argument(
+            "--chunk-size",
+            type=int,
+            default=CHUNK_SIZE,
+            help=f"Records per transaction (default: {CHUNK_SIZE})"
+        )
+
+    args = parser.parse_args()
+
+    # Синглтон database.db открывается при импорте модуля - направляем
+    # его в пустую SQLite БД в памяти, иначе он прочитает весь db.json
+    os.environ["DB_BACKEND"] = "sqlite"
+    os.environ["DB_PATH"] = ":memory:"
+
+    print(f"🚚 {args.command}: {args.source} -> {args.target}")
+    try:
+        if args.command == "import":
+            mismatch = import_tinydb(args.source, args.target, args.chunk_size)
+        else:
+            mismatch = export_tinydb(args.source, args.target, args.chunk_size)
+    except (OSError, ValueError) as e:
+        print(f"❌ Migration failed: {e}")
+        sys.exit(1)
+
+    if mismatch:
+        print(f"❌ Record counts differ for {len(mismatch)} stat(s):")
+        for key, (expected, actual) in sorted(mismatch.items()):
+            print(f"   {key}: {expected} -> {actual}")
+        sys.exit(1)
+    print("✅ Migration complete, record counts match")
+
+
+if __name__ == "__main__":
+    main()
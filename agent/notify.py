@@ -0,0 +1,104 @@
+"""Notify - мгновенное пробуждение воркеров через UNIX datagram сокеты"""
+import os
+import select
+import socket
+import threading
+from pathlib import Path
+from typing import Callable
+
+# Каталог сокетов воркеров: {channel}-{pid}.sock
+NOTIFY_DIR = Path(os.getenv("NOTIFY_DIR", "/tmp/coding-agent-notify"))
+
+ISSUES_CHANNEL = "issues"
+PR_REVIEWS_CHANNEL = "pr_reviews"
+
+# Воркеры в том же процессе (runtime.py): channel -> [callback]
+_local_subscribers = {}
+_local_lock = threading.Lock()
+
+
+def subscribe(channel: str, callback: Callable[[], None]) -> None:
+    """Подписывает воркер этого процесса на уведомления канала (без сокетов)."""
+    with _local_lock:
+        _local_subscribers.setdefault(channel, []).append(callback)
+
+
+def unsubscribe(channel: str, callback: Callable[[], None]) -> None:
+    with _local_lock:
+        callbacks = _local_subscribers.get(channel, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+
+
+def notify_workers(channel: str) -> int:
+    """Будит всех воркеров канала (после постановки задачи в очередь).
+
+    Воркеры этого же процесса (runtime.py) будятся напрямую, остальные -
+    через сокеты. Ошибки не пробрасываются - если уведомление не дошло,
+    воркер всё равно найдёт задачу при следующем опросе БД.
+
+    Returns:
+        Сколько воркеров получили уведомление
+    """
+    with _local_lock:
+        callbacks = list(_local_subscribers.get(channel, []))
+    for callback in callbacks:
+        callback()
+    notified = len(callbacks)
+
+    try:
+        sockets = list(NOTIFY_DIR.glob(f"{channel}-*.sock"))
+    except OSError:
+        return notified
+    if not sockets:
+        return notified
+
+    sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sender.setblocking(False)
+    try:
+        for path in sockets:
+            try:
+                sender.sendto(b"1", str(path))
+                notified += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Сокет остался от упавшего воркера
+                path.unlink(missing_ok=True)
+            except BlockingIOError:
+                # Очередь сокета полна - воркер и так проснётся
+                notified += 1
+            except OSError as e:
+                print(f"⚠️ Failed to notify {path.name}: {e}")
+    finally:
+        sender.close()
+    return notified
+
+
+class WakeupListener:
+    """Сокет воркера, на который server.py шлёт уведомления о новых задачах"""
+
+    def __init__(self, channel: str):
+        NOTIFY_DIR.mkdir(parents=True, exist_ok=True)
+        self.path = NOTIFY_DIR / f"{channel}-{os.getpid()}.sock"
+        self.path.unlink(missing_ok=True)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(str(self.path))
+        self.sock.setblocking(False)
+
+    def wait(self, timeout: float) -> bool:
+        """Ждёт уведомления не дольше timeout секунд.
+
+        Returns:
+            True если пришло уведомление (все накопленные вычитываются)
+        """
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        if not readable:
+            return False
+        while True:
+            try:
+                self.sock.recv(64)
+            except (BlockingIOError, InterruptedError):
+                return True
+
+    def close(self) -> None:
+        self.sock.close()
+        self.path.unlink(missing_ok=True)
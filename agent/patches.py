@@ -0,0 +1,74 @@
+"""Patches - применение search/replace правок из ответа LLM к файлу"""
+import ast
+from pathlib import Path
+
+
+class PatchError(ValueError):
+    """Правку нельзя применить однозначно - нужен ответ целым файлом."""
+
+
+def apply_edits(content: str, edits: list[dict]) -> str:
+    """Применяет правки [{search, replace}] по очереди.
+
+    Каждый search должен встречаться в текущем содержимом ровно один
+    раз: иначе неясно, что именно модель хотела заменить.
+
+    Raises:
+        PatchError: правка пустая, не найдена или неоднозначна
+    """
+    if not edits:
+        raise PatchError("no edits")
+
+    for number, edit in enumerate(edits, 1):
+        if not isinstance(edit, dict):
+            raise PatchError(f"edit {number}: expected object, got {type(edit).__name__}")
+        search = edit.get("search") or ""
+        replace = edit.get("replace") or ""
+        if not search:
+            raise PatchError(f"edit {number}: empty search block")
+
+        count = content.count(search)
+        if count == 1:
+            content = content.replace(search, replace, 1)
+            continue
+        if count == 0:
+            # Модель часто теряет хвостовые пробелы строк - сравниваем без них
+            patched = _replace_lines(content, search, replace)
+            if patched is not None:
+                content = patched
+                continue
+        reason = "not found" if count == 0 else f"matches {count} places"
+        raise PatchError(f"edit {number}: search block {reason}")
+
+    return content
+
+
+def validate(filepath: Path, content: str) -> None:
+    """Проверяет, что файл после правок остался синтаксически корректным.
+
+    Проверяется только Python - для других языков парсера под рукой нет.
+
+    Raises:
+        PatchError: синтаксическая ошибка
+    """
+    if filepath.suffix != ".py":
+        return
+    try:
+        ast.parse(content, filename=str(filepath))
+    except SyntaxError as e:
+        raise PatchError(f"patched file does not parse: {e.msg} (line {e.lineno})") from e
+
+
+def _replace_lines(content: str, search: str, replace: str) -> str | None:
+    """Замена целых строк без учёта хвостовых пробелов; None - нет единственного совпадения."""
+    lines = content.split("\n")
+    wanted = [line.rstrip() for line in search.rstrip("\n").split("\n")]
+    starts = [
+        i for i in range(len(lines) - len(wanted) + 1)
+        if all(lines[i + j].rstrip() == wanted[j] for j in range(len(wanted)))
+    ]
+    if len(starts) != 1:
+        return None
+    start = starts[0]
+    replacement = replace.rstrip("\n").split("\n") if replace.strip("\n") else []
+    return "\n".join(lines[:start] + replacement + lines[start + len(wanted):])
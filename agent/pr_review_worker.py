@@ -2,25 +2,41 @@
 import os
 import time
 import signal
+import socket
 import sys
 from dotenv import load_dotenv
 
 from database import db, PRReviewStatus
 from pr_reviewer import review_pr_files
+from leases import Heartbeat, ThrottledCheck, REAPER_INTERVAL
+from quotas import quota_scope
+from notify import WakeupListener, PR_REVIEWS_CHANNEL
 
 load_dotenv()
 
-WORKER_INTERVAL = int(os.getenv("WORKER_INTERVAL", "5"))  # секунды
+# Запасной опрос БД (секунды) - обычно воркера будит server.py через notify
+WORKER_INTERVAL = int(os.getenv("WORKER_INTERVAL", "30"))
 MAX_ATTEMPTS = int(os.getenv("MAX_ATTEMPTS", "3"))
+# Сколько PR reviews обрабатывается параллельно (процессов в пуле / потоков в runtime.py)
+REVIEW_WORKER_CONCURRENCY = int(os.getenv("REVIEW_WORKER_CONCURRENCY", "1"))
+# Больше REVIEW_WORKER_CONCURRENCY - пул растёт до этого размера при длинной очереди
+REVIEW_WORKER_MAX_CONCURRENCY = int(os.getenv("REVIEW_WORKER_MAX_CONCURRENCY", "0"))
 
 
 class PRReviewWorker:
     """Фоновый воркер для review PR"""
     
-    def __init__(self):
+    def __init__(self, worker_id: str = None):
+        """
+        Args:
+            worker_id: Владелец lease (несколько воркеров в одном процессе - runtime.py)
+        """
         self.running = False
         self.processed_count = 0
         self.failed_count = 0
+        # Владелец lease в БД - несколько воркеров не возьмут один PR
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self._last_reap = 0.0
     
     def start(self):
         """Запускает воркер"""
@@ -30,64 +46,109 @@ class PRReviewWorker:
         signal.signal(signal.SIGINT, self._handle_shutdown)
         signal.signal(signal.SIGTERM, self._handle_shutdown)
         
-        print(f"PR Review Worker started (interval: {WORKER_INTERVAL}s)")
+        print(f"PR Review Worker started (fallback poll: {WORKER_INTERVAL}s)")
         print(f"   Max attempts per PR: {MAX_ATTEMPTS}")
         print("   Ctrl+C to stop gracefully\n")
         
+        wakeup = WakeupListener(PR_REVIEWS_CHANNEL)
         try:
             while self.running:
-                self._process_batch()
-                time.sleep(WORKER_INTERVAL)
+                if self.run_iteration():
+                    # Порция выбрана целиком - в очереди может быть ещё
+                    continue
+                # Ждём уведомления от server.py (или таймаута запасного опроса)
+                for _ in range(WORKER_INTERVAL):
+                    if not self.running or wakeup.wait(1):
+                        break
         except KeyboardInterrupt:
             print("\n⚠️ Received interrupt signal")
         finally:
+            wakeup.close()
             self._cleanup()
     
-    def _process_batch(self):
-        """Обрабатывает одну порцию PR reviews"""
-        pending = db.get_pending_pr_reviews(limit=5)
+    def run_iteration(self) -> bool:
+        """Один проход цикла: reaper и порция PR reviews.
         
-        if not pending:
-            # Молча ждём
+        Returns:
+            True если порция выбрана целиком и стоит проверить очередь снова
+        """
+        try:
+            self._reap_expired()
+            return self._process_batch()
+        except Exception as e:
+            # Сбой БД или сети не должен останавливать воркер
+            print(f"❌ Worker error: {e}")
+            return False
+    
+    def _reap_expired(self):
+        """Возвращает в очередь PR reviews упавших воркеров (раз в REAPER_INTERVAL)"""
+        if time.time() - self._last_reap < REAPER_INTERVAL:
             return
+        self._last_reap = time.time()
         
-        print(f"\n📊 Found {len(pending)} PR(s) pending review")
+        try:
+            requeued = db.requeue_expired_pr_reviews(max_attempts=MAX_ATTEMPTS)
+        except Exception as e:
+            print(f"❌ Reaper error: {e}")
+            return
+        if requeued:
+            print(f"♻️ Requeued {len(requeued)} PR review(s) with expired lease: {requeued}")
+    
+    def _process_batch(self) -> bool:
+        """Обрабатывает одну порцию PR reviews (до 5).
         
-        for pr_review in pending:
+        Returns:
+            True если порция выбрана целиком и стоит проверить очередь снова
+        """
+        for _ in range(5):
             if not self.running:
-                break
+                return False
+            
+            # Атомарно забираем PR (PENDING -> REVIEWING, attempts + 1).
+            # PR, исчерпавшие MAX_ATTEMPTS, claim сам переводит в DEAD
+            pr_review = db.claim_next_pr_review(self.worker_id, max_attempts=MAX_ATTEMPTS)
+            if not pr_review:
+                # Молча ждём
+                return False
             
             doc_id = pr_review['doc_id']
             repo = pr_review['repo']
             pr_number = pr_review['pr_number']
-            attempts = pr_review.get('attempts', 0)
-            
-            # Проверяем лимит попыток
-            if attempts >= MAX_ATTEMPTS:
-                print(f"❌ PR {repo}#{pr_number} exceeded max attempts ({MAX_ATTEMPTS})")
-                db.set_pr_review_failed(doc_id, f"Max attempts ({MAX_ATTEMPTS}) exceeded")
-                self.failed_count += 1
-                continue
+            attempts = pr_review.get('attempts', 1)
             
-            print(f"🔍 Reviewing PR: {repo}#{pr_number} (attempt {attempts + 1}/{MAX_ATTEMPTS})")
-            
-            # Обновляем статус
-            db.set_pr_reviewing(doc_id)
-            db.increment_pr_review_attempts(doc_id)
+            print(f"🔍 Reviewing PR: {repo}#{pr_number} (attempt {attempts}/{MAX_ATTEMPTS})")
             
             try:
-                # Запускаем review
-                result = review_pr_files(
-                    pr_number=pr_number,
-                    repo_name=repo,
-                    changed_files=pr_review.get('changed_files', [])
-                )
+                # Запускаем review (heartbeat продлевает lease)
+                superseded = ThrottledCheck(lambda: db.is_pr_review_superseded(doc_id))
+                with Heartbeat(lambda: db.heartbeat_pr_review(doc_id, self.worker_id)) as heartbeat, \
+                        quota_scope(pr_review):
+                    result = review_pr_files(
+                        pr_number=pr_number,
+                        repo_name=repo,
+                        changed_files=pr_review.get('changed_files', []),
+                        # Новый push в PR отменяет этот review (см. add_pr_review),
+                        # потерянный lease - тоже: review уже у другого воркера
+                        superseded=lambda: heartbeat.lost or superseded()
+                    )
+                
+                if result.get("superseded"):
+                    # Не ошибка: review доделает другой воркер или новый review в очереди
+                    if heartbeat.lost:
+                        print(f"⏭️ Abandoned review of {repo}#{pr_number}: lease lost")
+                    else:
+                        print(f"⏭️ Review of {repo}#{pr_number} superseded by a newer push")
+                    continue
                 
                 if result.get("success"):
                     review_results = result.get("review_results", [])
                     all_passed = result.get("all_passed", False)
                     
-                    db.set_pr_review_completed(doc_id, review_results, all_passed)
+                    if not db.set_pr_review_completed(
+                        doc_id, review_results, all_passed, result.get("head_sha"), owner=self.worker_id
+                    ):
+                        print(f"⏭️ Review of {repo}#{pr_number} superseded or taken by another worker")
+                        continue
                     
                     status_emoji = "✅" if all_passed else "⚠️"
                     print(f"{status_emoji} Review completed: {len(review_results)} file(s) reviewed")
@@ -97,14 +158,16 @@ class PRReviewWorker:
                 else:
                     error = result.get("error", "Unknown error")
                     print(f"❌ Review failed: {error}")
-                    db.set_pr_review_failed(doc_id, error)
+                    db.set_pr_review_failed(doc_id, error, owner=self.worker_id)
                     self.failed_count += 1
                 
             except Exception as e:
                 error_msg = str(e)
                 print(f"❌ Exception during review: {error_msg}")
-                db.set_pr_review_failed(doc_id, error_msg)
+                db.set_pr_review_failed(doc_id, error_msg, owner=self.worker_id)
                 self.failed_count += 1
+        
+        return True
     
     def _handle_shutdown(self, signum, frame):
         """Обработка сигналов остановки"""
@@ -121,11 +184,44 @@ class PRReviewWorker:
         print("✅ Worker stopped gracefully")
 
 
+def _run_pool_child(interval: int):
+    """Точка входа процесса пула"""
+    global WORKER_INTERVAL
+    WORKER_INTERVAL = interval
+    PRReviewWorker().start()
+
+
 def main():
     """Основная функция"""
-    worker = PRReviewWorker()
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="PR Review Worker")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=REVIEW_WORKER_CONCURRENCY,
+        help=f"PR reviews processed in parallel, one process each (default: {REVIEW_WORKER_CONCURRENCY})"
+    )
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=REVIEW_WORKER_MAX_CONCURRENCY,
+        help="Autoscale the pool between --concurrency and this many processes by queue depth"
+    )
+    args = parser.parse_args()
+    
     try:
-        worker.start()
+        if args.concurrency > 1 or args.max_concurrency > args.concurrency:
+            # Пул процессов - тот же, что у worker.py
+            from worker import WorkerPool
+            WorkerPool(
+                args.concurrency,
+                max_concurrency=args.max_concurrency,
+                target=_run_pool_child,
+                queue=PR_REVIEWS_CHANNEL
+            ).start()
+        else:
+            PRReviewWorker().start()
     except Exception as e:
         print(f"❌ Fatal error: {e}")
         sys.exit(1)
@@ -1,14 +1,25 @@
 """PR Reviewer - автоматический ревью Pull Requests"""
+import contextvars
 import os
 import sys
-import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
 from github import Github
 from dotenv import load_dotenv
 
-from ai_client import ai_client
+from ai_client import ai_client, object_schema
+from json_stream import extract_json
 
 load_dotenv()
 
+# Сколько файлов PR ревьюится одновременно (параллельные запросы к LLM)
+PR_REVIEW_CONCURRENCY = int(os.getenv("PR_REVIEW_CONCURRENCY", "4"))
+
+FILE_REVIEW_SCHEMA = object_schema(
+    issue_solved={"type": "boolean"},
+    notes={"type": "string"},
+)
+
 
 def review_file_for_issue(file_content: str, file_path: str, issue_description: str) -> dict:
     """Review одного файла на соответствие решению issue.
@@ -43,32 +54,11 @@ def review_file_for_issue(file_content: str, file_path: str, issue_description:
 }}
 """
     
+    messages = [{"role": "user", "content": prompt}]
     try:
-        response = ai_client._call([{"role": "user", "content": prompt}], temperature=0.2)
-        response = response.strip()
-        if response.startswith("```"):
-            response = response.split("\n", 1)[1]
-            response = response.rsplit("```", 1)[0]
-        
-        # Парсим JSON ответ
-        if isinstance(response, str):
-            result = json.loads(response)
-        else:
-            result = response
-        
-        # Проверяем наличие обязательных полей
-        if "issue_solved" not in result or "notes" not in result:
-            return {
-                "issue_solved": False,
-                "notes": f"AI response format error. Got: {result}"
-            }
-        
-        return {
-            "issue_solved": bool(result["issue_solved"]),
-            "notes": str(result["notes"])
-        }
-    
-    except json.JSONDecodeError as e:
+        return ai_client._call_json(messages, _parse_file_review, "file_review", FILE_REVIEW_SCHEMA)
+    except ValueError as e:
+        # Ответ не разобрался и после repair запроса
         return {
             "issue_solved": False,
             "notes": f"Failed to parse AI response: {e}"
@@ -80,22 +70,83 @@ def review_file_for_issue(file_content: str, file_path: str, issue_description:
         }
 
 
-def review_pr_files(pr_number: int, repo_name: str = None, changed_files: list = None) -> dict:
+def _parse_file_review(response: str) -> dict:
+    """Разбирает ответ review файла. ValueError - нет обязательных полей."""
+    result = extract_json(response)
+    if not isinstance(result.get("issue_solved"), bool) or "notes" not in result:
+        raise ValueError(f"expected issue_solved (bool) and notes, got keys {sorted(result)}")
+    return {
+        "issue_solved": result["issue_solved"],
+        "notes": str(result["notes"])
+    }
+
+
+def review_pr_file(repo, ref: str, file_path: str, issue_description: str) -> dict:
+    """Получает файл из PR и ревьюит его. Ошибки не пробрасываются.
+    
+    Args:
+        repo: PyGithub Repository
+        ref: SHA head коммита PR
+        file_path: Путь к файлу
+        issue_description: Описание исходного issue
+        
+    Returns:
+        {file, issue_solved, notes}
+    """
+    print(f"   📄 Reviewing {file_path}...")
+    
+    try:
+        # Получаем содержимое файла из PR branch
+        file_content = repo.get_contents(file_path, ref=ref).decoded_content.decode('utf-8')
+    except Exception as e:
+        # Если не можем получить (удалён, бинарный и т.д.)
+        return {
+            "file": file_path,
+            "issue_solved": False,
+            "notes": f"Could not fetch file content: {e}"
+        }
+    
+    # Reviewим файл
+    file_review = review_file_for_issue(file_content, file_path, issue_description)
+    
+    status = "✅" if file_review["issue_solved"] else "❌"
+    print(f"      {status} {file_path}")
+    
+    return {
+        "file": file_path,
+        "issue_solved": file_review["issue_solved"],
+        "notes": file_review["notes"]
+    }
+
+
+def review_pr_files(
+    pr_number: int,
+    repo_name: str = None,
+    changed_files: list = None,
+    superseded: Callable[[], bool] = None
+) -> dict:
     """Выполняет ревью файлов из PR.
     
+    Ревьюится текущий head PR на момент запуска, а не коммит из webhook.
+    
     Args:
         pr_number: Номер PR
         repo_name: owner/repo (опционально, берётся из env)
         changed_files: Список файлов для review (если пустой - получим из GitHub)
+        superseded: Возвращает True, если в PR запушили новый коммит - тогда
+            оставшиеся файлы не отправляются в LLM и комментарий не публикуется
         
     Returns:
         {
             success: bool,
             review_results: [{file, issue_solved, notes}],
             all_passed: bool,
-            comment: str
+            comment: str,
+            head_sha: str,
+            superseded: bool  # только если review отменён
         }
     """
+    superseded = superseded or (lambda: False)
     token = os.getenv("GITHUB_TOKEN")
     repo_name = repo_name or os.getenv("GITHUB_REPO")
     
@@ -123,40 +174,31 @@ def review_pr_files(pr_number: int, repo_name: str = None, changed_files: list =
         
         print(f"   Files to review: {len(changed_files)}")
         
-        review_results = []
-        all_passed = True
-        
-        # Reviewим каждый изменённый файл
-        for file_path in changed_files:
-            print(f"   📄 Reviewing {file_path}...")
-            
-            try:
-                # Получаем содержимое файла из PR branch
-                file_content = repo.get_contents(file_path, ref=pr.head.sha).decoded_content.decode('utf-8')
-            except Exception as e:
-                # Если не можем получить (удалён, бинарный и т.д.)
-                review_results.append({
-                    "file": file_path,
-                    "issue_solved": False,
-                    "notes": f"Could not fetch file content: {e}"
-                })
-                all_passed = False
-                continue
-            
-            # Reviewим файл
-            file_review = review_file_for_issue(file_content, file_path, issue_description)
-            
-            review_results.append({
-                "file": file_path,
-                "issue_solved": file_review["issue_solved"],
-                "notes": file_review["notes"]
-            })
-            
-            if not file_review["issue_solved"]:
-                all_passed = False
-            
-            status = "✅" if file_review["issue_solved"] else "❌"
-            print(f"      {status} {file_path}")
+        # Reviewим изменённые файлы параллельно - время review ~ самый
+        # медленный файл, а не сумма. map сохраняет порядок changed_files
+        head_sha = pr.head.sha
+        
+        def review(file_path: str) -> dict | None:
+            if superseded():
+                return None
+            return review_pr_file(repo, head_sha, file_path, issue_description)
+        
+        workers = max(1, min(PR_REVIEW_CONCURRENCY, len(changed_files)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pr-review") as pool:
+            # Потоки пула получают контекст задачи (квота installation)
+            futures = [pool.submit(contextvars.copy_context().run, review, path) for path in changed_files]
+            review_results = [future.result() for future in futures]
+        
+        if superseded():
+            print(f"⏭️ PR #{pr_number} got a new push, dropping review of {head_sha[:8]}")
+            return {
+                "success": False,
+                "superseded": True,
+                "head_sha": head_sha,
+                "error": f"Superseded by a newer push (reviewed {head_sha[:8]})"
+            }
+        
+        all_passed = all(result["issue_solved"] for result in review_results)
         
         # Формируем комментарий для GitHub
         status_emoji = "✅" if all_passed else "⚠️"
@@ -189,7 +231,8 @@ def review_pr_files(pr_number: int, repo_name: str = None, changed_files: list =
             "success": True,
             "review_results": review_results,
             "all_passed": all_passed,
-            "comment": comment
+            "comment": comment,
+            "head_sha": head_sha
         }
     
     except Exception as e:
@@ -0,0 +1,141 @@
+"""Quotas - дневной бюджет токенов LLM и лимит параллельных задач на installation"""
+import contextvars
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+from rate_limiter import RATE_LIMIT_DB
+from scheduler import fairness_keys
+
+# Лимиты по умолчанию для каждой installation (0 - без ограничения)
+INSTALLATION_DAILY_TOKENS = int(os.getenv("INSTALLATION_DAILY_TOKENS", "0"))
+INSTALLATION_MAX_JOBS = int(os.getenv("INSTALLATION_MAX_JOBS", "0"))
+# Свои лимиты отдельных installations / repo (ручной запуск):
+# {"12345": {"daily_tokens": 2000000, "max_jobs": 2}, "owner/repo": {...}}
+INSTALLATION_QUOTAS = os.getenv("INSTALLATION_QUOTAS", "")
+
+# Сколько дней хранится история расхода
+USAGE_KEEP_DAYS = 7
+
+# Installation задачи, которую сейчас обрабатывает поток (см. quota_scope)
+_current_key = contextvars.ContextVar("quota_key", default=None)
+
+
+def quota_key(job: dict) -> str:
+    """Ключ квоты задачи: installation, для ручного запуска - repo (как в scheduler)."""
+    return fairness_keys(job)[0]
+
+
+@contextmanager
+def quota_scope(job: dict):
+    """Токены LLM внутри блока списываются с installation задачи.
+
+    Пулы потоков контекст не наследуют - задачи в них отправляются
+    через contextvars.copy_context().run.
+    """
+    token = _current_key.set(quota_key(job))
+    try:
+        yield
+    finally:
+        _current_key.reset(token)
+
+
+def current_quota_key() -> str | None:
+    return _current_key.get()
+
+
+def _today() -> str:
+    return datetime.now(timezone.utc).date().isoformat()
+
+
+class QuotaTracker:
+    """Расход токенов по installations за сутки (UTC) и проверка лимитов.
+
+    Расход пишется в тот же SQLite файл, что и rate limiter, - его видят
+    все процессы. Активные задачи считает IssueDB по своим таблицам.
+    """
+
+    def __init__(
+        self,
+        path: str = RATE_LIMIT_DB,
+        daily_tokens: int = INSTALLATION_DAILY_TOKENS,
+        max_jobs: int = INSTALLATION_MAX_JOBS,
+        overrides: dict = None
+    ):
+        """
+        Args:
+            path: SQLite файл расхода
+            daily_tokens: Токенов в сутки на installation (0 - без лимита)
+            max_jobs: Параллельных задач на installation (0 - без лимита)
+            overrides: Лимиты отдельных installations (см. INSTALLATION_QUOTAS)
+        """
+        self.path = path
+        self.daily_tokens = daily_tokens
+        self.max_jobs = max_jobs
+        if overrides is None:
+            overrides = json.loads(INSTALLATION_QUOTAS) if INSTALLATION_QUOTAS else {}
+        self.overrides = {str(key): value for key, value in overrides.items()}
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS installation_usage ("
+                "quota_key TEXT NOT NULL, day TEXT NOT NULL, tokens INTEGER NOT NULL, "
+                "PRIMARY KEY (quota_key, day))"
+            )
+        return self._conn
+
+    def limits(self, key: str) -> dict:
+        """Лимиты ключа квоты: {daily_tokens, max_jobs}, 0 - без ограничения."""
+        override = self.overrides.get(key.split(":", 1)[-1], {})
+        return {
+            "daily_tokens": override.get("daily_tokens", self.daily_tokens),
+            "max_jobs": override.get("max_jobs", self.max_jobs),
+        }
+
+    @property
+    def limits_tokens(self) -> bool:
+        return bool(self.daily_tokens) or any(o.get("daily_tokens") for o in self.overrides.values())
+
+    @property
+    def limits_jobs(self) -> bool:
+        return bool(self.max_jobs) or any(o.get("max_jobs") for o in self.overrides.values())
+
+    def record(self, key: str, tokens: int) -> None:
+        """Добавляет токены к сегодняшнему расходу ключа."""
+        if not key or not tokens:
+            return
+        today = _today()
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT INTO installation_usage (quota_key, day, tokens) VALUES (?, ?, ?) "
+                "ON CONFLICT(quota_key, day) DO UPDATE SET tokens = tokens + excluded.tokens",
+                (key, today, tokens)
+            )
+            oldest = (datetime.now(timezone.utc) - timedelta(days=USAGE_KEEP_DAYS)).date().isoformat()
+            conn.execute("DELETE FROM installation_usage WHERE day < ?", (oldest,))
+
+    def used_today(self) -> dict:
+        """Расход за сегодня: {quota_key: tokens}."""
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT quota_key, tokens FROM installation_usage WHERE day = ?", (_today(),)
+            ).fetchall()
+        return dict(rows)
+
+    def blocked(self, key: str, active_jobs: int, used_tokens: int) -> str | None:
+        """Причина, по которой новую задачу ключа брать нельзя, или None."""
+        limits = self.limits(key)
+        if limits["daily_tokens"] and used_tokens >= limits["daily_tokens"]:
+            return "daily token budget exhausted"
+        if limits["max_jobs"] and active_jobs >= limits["max_jobs"]:
+            return "concurrent job limit reached"
+        return None
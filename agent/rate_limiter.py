@@ -0,0 +1,161 @@
+"""Rate Limiter - общий для всех процессов token bucket для запросов к LLM"""
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+# Бюджет провайдера: запросов и токенов в минуту (0 - без ограничения)
+LLM_RPM = int(os.getenv("LLM_RPM", "0"))
+LLM_TPM = int(os.getenv("LLM_TPM", "0"))
+# Состояние бакетов - одно на server, worker и pr_review_worker
+RATE_LIMIT_DB = os.getenv("RATE_LIMIT_DB", str(Path(__file__).parent / "rate_limit.sqlite3"))
+
+# Дольше не спим за раз - другие процессы могли вернуть бюджет (usage < оценки)
+MAX_SLEEP_SECONDS = 5.0
+
+
+class RateLimiter:
+    """Два token bucket (запросы и токены) в SQLite + общий стоп по Retry-After.
+
+    Каждый процесс открывает тот же файл; списание идёт в транзакции
+    BEGIN IMMEDIATE, поэтому бюджет делится между всеми процессами.
+    Токены списываются по оценке до запроса и уточняются по usage после.
+    """
+
+    def __init__(self, path: str = RATE_LIMIT_DB, rpm: int = LLM_RPM, tpm: int = LLM_TPM):
+        self.path = path
+        self.limits = {"requests": rpm, "tokens": tpm}
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "name TEXT PRIMARY KEY, level REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS blocks (name TEXT PRIMARY KEY, until REAL NOT NULL)"
+            )
+        return self._conn
+
+    def _transaction(self, fn):
+        """Выполняет fn(conn, now) в эксклюзивной транзакции."""
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(conn, time.time())
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            return result
+
+    def _level(self, conn, name: str, now: float) -> float:
+        """Текущий запас бакета с учётом пополнения (capacity = лимит в минуту)."""
+        capacity = self.limits[name]
+        row = conn.execute("SELECT level, updated_at FROM buckets WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return capacity
+        level, updated_at = row
+        return min(capacity, level + (now - updated_at) * capacity / 60)
+
+    def _try_acquire(self, conn, now: float, costs: dict) -> float:
+        """Списывает бюджет. Returns: 0 если списано, иначе сколько секунд ждать."""
+        row = conn.execute("SELECT until FROM blocks WHERE name = 'retry_after'").fetchone()
+        if row and row[0] > now:
+            return row[0] - now
+
+        levels = {}
+        wait = 0.0
+        for name, cost in costs.items():
+            capacity = self.limits[name]
+            if not capacity:
+                continue
+            # Запрос больше всей минутной квоты ждёт полного бакета
+            cost = min(cost, capacity)
+            levels[name] = self._level(conn, name, now)
+            if levels[name] < cost:
+                wait = max(wait, (cost - levels[name]) * 60 / capacity)
+        if wait:
+            return wait
+
+        for name, level in levels.items():
+            self._set_level(conn, name, level - min(costs[name], self.limits[name]), now)
+        return 0.0
+
+    def _set_level(self, conn, name: str, level: float, now: float) -> None:
+        conn.execute(
+            "INSERT INTO buckets (name, level, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET level = excluded.level, updated_at = excluded.updated_at",
+            (name, level, now)
+        )
+
+    def try_acquire(self, tokens: int) -> float:
+        """Списывает 1 запрос и tokens токенов, если бюджет есть, не ожидая.
+
+        Returns:
+            0 если списано, иначе сколько секунд подождать до следующей попытки
+        """
+        costs = {"requests": 1, "tokens": tokens}
+        return self._transaction(lambda conn, now: self._try_acquire(conn, now, costs))
+
+    def acquire(self, tokens: int) -> float:
+        """Ждёт, пока в бюджете есть 1 запрос и tokens токенов, и списывает их.
+
+        Returns:
+            Сколько секунд пришлось ждать
+        """
+        started = time.monotonic()
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return time.monotonic() - started
+            time.sleep(min(wait, MAX_SLEEP_SECONDS))
+
+    def record_usage(self, estimated: int, actual: int) -> None:
+        """Уточняет списание токенов по usage из ответа (может уйти в минус)."""
+        if not self.limits["tokens"] or actual == estimated:
+            return
+
+        def adjust(conn, now):
+            level = self._level(conn, "tokens", now)
+            self._set_level(conn, "tokens", level + min(estimated, self.limits["tokens"]) - actual, now)
+
+        self._transaction(adjust)
+
+    def block(self, seconds: float) -> None:
+        """Останавливает запросы всех процессов на seconds (ответ 429 + Retry-After)."""
+        def extend(conn, now):
+            conn.execute(
+                "INSERT INTO blocks (name, until) VALUES ('retry_after', ?) "
+                "ON CONFLICT(name) DO UPDATE SET until = MAX(until, excluded.until)",
+                (now + seconds,)
+            )
+
+        self._transaction(extend)
+
+
+def estimate_tokens(messages: list, completion_tokens: int = 1024) -> int:
+    """Грубая оценка токенов запроса: ~4 символа на токен + запас на ответ."""
+    prompt_chars = sum(len(str(message.get("content", ""))) for message in messages)
+    return prompt_chars // 4 + completion_tokens
+
+
+def retry_after_seconds(headers, default: float = 1.0) -> float:
+    """Задержка из заголовков 429 ответа (retry-after-ms / retry-after)."""
+    if headers is None:
+        return default
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        # Retry-After в формате HTTP-date - берём значение по умолчанию
+        pass
+    return default
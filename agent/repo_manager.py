@@ -63,6 +63,12 @@ class RepoManager:
         
         return self.repo_path
     
+    def head_sha(self) -> str:
+        """SHA текущего HEAD клона"""
+        if self.repo is None:
+            self.repo = Repo(self.repo_path)
+        return self.repo.head.commit.hexsha
+    
     def _get_default_branch(self) -> str:
         """Определяет default branch (main или master)"""
         try:
@@ -0,0 +1,177 @@
+"""Runtime - webhook сервер и оба воркера в одном процессе (один event loop)"""
+import asyncio
+import os
+import signal
+import socket
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import uvicorn
+from dotenv import load_dotenv
+
+from notify import ISSUES_CHANNEL, PR_REVIEWS_CHANNEL, notify_workers, subscribe, unsubscribe
+from pr_review_worker import REVIEW_WORKER_CONCURRENCY, PRReviewWorker
+from server import SERVER_PORT, app
+from worker import WORKER_CONCURRENCY, WORKER_INTERVAL, Worker
+
+load_dotenv()
+
+
+class AgentRuntime:
+    """FastAPI и воркеры как задачи одного asyncio event loop.
+
+    Вместо трёх процессов supervisord (у каждого свои openai, PyGithub,
+    GitPython и подключение к БД) - один процесс. Задачи по-прежнему
+    забираются через claim + lease, так что runtime можно запускать
+    рядом с обычными worker.py. Server будит воркеров этого процесса
+    напрямую (notify.subscribe), без UNIX сокетов.
+
+    Решение issue и review - блокирующий код (git, GitHub API, LLM),
+    он выполняется в ThreadPoolExecutor по потоку на воркер; в event
+    loop остаются только HTTP и ожидание уведомлений.
+    """
+
+    def __init__(
+        self,
+        port: int = SERVER_PORT,
+        issue_workers: int = WORKER_CONCURRENCY,
+        review_workers: int = REVIEW_WORKER_CONCURRENCY,
+        interval: int = WORKER_INTERVAL
+    ):
+        """
+        Args:
+            port: Порт webhook сервера
+            issue_workers: Сколько issues решается параллельно
+            review_workers: Сколько PR reviews идёт параллельно
+            interval: Запасной интервал опроса БД (секунды)
+        """
+        self.port = port
+        self.interval = interval
+        base_id = f"{socket.gethostname()}:{os.getpid()}"
+        # У каждого воркера свой владелец lease - иначе heartbeat одного
+        # продлевал бы задачи другого
+        self.workers = [
+            (ISSUES_CHANNEL, Worker(worker_id=f"{base_id}:issues-{i}"))
+            for i in range(issue_workers)
+        ] + [
+            (PR_REVIEWS_CHANNEL, PRReviewWorker(worker_id=f"{base_id}:reviews-{i}"))
+            for i in range(review_workers)
+        ]
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(self.workers)), thread_name_prefix="job")
+        self.server = None
+        self._stopping = None
+
+    async def _run_worker(self, channel: str, worker) -> None:
+        """Цикл воркера: проход в executor, затем ожидание уведомления или таймаута."""
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+
+        def on_notify():
+            # notify_workers вызывается из event loop или из потока threadpool
+            loop.call_soon_threadsafe(wakeup.set)
+
+        subscribe(channel, on_notify)
+        try:
+            while worker.running:
+                wakeup.clear()
+                try:
+                    if await loop.run_in_executor(self.executor, worker.run_iteration):
+                        continue
+                except Exception as e:
+                    # Задача воркера не должна умирать от ошибки прохода -
+                    # ждём интервал и пробуем снова
+                    print(f"❌ Worker error: {e}")
+                if not worker.running:
+                    break
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout=self.interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            unsubscribe(channel, on_notify)
+
+    def stop(self) -> None:
+        """Останавливает сервер и воркеров; начатые задачи доделываются."""
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        print("\n⚠️ Shutdown signal received, finishing current jobs...")
+        for _, worker in self.workers:
+            worker.running = False
+        if self.server:
+            self.server.should_exit = True
+        # Будим воркеров, ждущих уведомления
+        for channel in {channel for channel, _ in self.workers}:
+            notify_workers(channel)
+
+    async def serve(self) -> None:
+        """Запускает воркеров и сервер, после остановки сервера ждёт воркеров."""
+        self._stopping = asyncio.Event()
+        # Пока работает сервер, SIGINT/SIGTERM перехватывает uvicorn (и
+        # выходит из serve), после - runtime: повторный сигнал во время
+        # ожидания воркеров не должен обрывать начатые задачи
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+
+        self.server = uvicorn.Server(uvicorn.Config(app, host="0.0.0.0", port=self.port))
+
+        for _, worker in self.workers:
+            worker.running = True
+        tasks = [asyncio.create_task(self._run_worker(channel, worker)) for channel, worker in self.workers]
+
+        print("=" * 60)
+        print(f"🚀 All-in-one runtime on :{self.port}")
+        print(f"   Issue workers: {sum(1 for c, _ in self.workers if c == ISSUES_CHANNEL)}")
+        print(f"   PR review workers: {sum(1 for c, _ in self.workers if c == PR_REVIEWS_CHANNEL)}")
+        print("=" * 60)
+
+        try:
+            await self.server.serve()
+        finally:
+            # Сервер остановлен (сигнал или ошибка) - воркеры доделывают задачи
+            self.stop()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.executor.shutdown(wait=True)
+            print("👋 Runtime stopped")
+
+    def run(self) -> None:
+        """Блокирующий запуск (до сигнала завершения)."""
+        asyncio.run(self.serve())
+
+
+def main():
+    """CLI entry point"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Webhook server and workers in one process")
+    parser.add_argument("--port", type=int, default=SERVER_PORT, help=f"Server port (default: {SERVER_PORT})")
+    parser.add_argument(
+        "--issue-workers",
+        type=int,
+        default=WORKER_CONCURRENCY,
+        help=f"Issues processed in parallel (default: {WORKER_CONCURRENCY})"
+    )
+    parser.add_argument(
+        "--review-workers",
+        type=int,
+        default=REVIEW_WORKER_CONCURRENCY,
+        help=f"PR reviews processed in parallel (default: {REVIEW_WORKER_CONCURRENCY})"
+    )
+    parser.add_argument(
+        "--interval",
+        type=int,
+        default=WORKER_INTERVAL,
+        help=f"Fallback poll interval in seconds (default: {WORKER_INTERVAL})"
+    )
+    args = parser.parse_args()
+
+    try:
+        AgentRuntime(args.port, args.issue_workers, args.review_workers, args.interval).run()
+    except Exception as e:
+        print(f"❌ Fatal error: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""Scheduler - порядок выдачи задач: приоритет, затем честная очередь по installation/repo"""
+from datetime import datetime
+
+# Приоритеты задач (чем больше, тем раньше)
+DEFAULT_PRIORITY = 0
+MANUAL_PRIORITY = 50  # /process, /review, @coding-agent
+
+# Метки issue/PR -> приоритет
+LABEL_PRIORITIES = {
+    "priority: critical": 40,
+    "priority: high": 20,
+    "priority: low": -10,
+    "p0": 40,
+    "p1": 20,
+    "p3": -10,
+}
+
+
+def priority_from_labels(labels: list) -> int:
+    """Приоритет по меткам GitHub (берётся максимальный).
+
+    Args:
+        labels: Метки из webhook payload ([{"name": ...}]) или строки
+    """
+    priority = None
+    for label in labels or []:
+        name = label.get("name", "") if isinstance(label, dict) else str(label)
+        # "priority:high", "Priority: High" -> "priority: high"
+        name = name.strip().lower().replace(":", ": ").replace(":  ", ": ")
+        if name in LABEL_PRIORITIES:
+            value = LABEL_PRIORITIES[name]
+            priority = value if priority is None else max(priority, value)
+    return DEFAULT_PRIORITY if priority is None else priority
+
+
+def fairness_keys(job: dict) -> tuple[str, str]:
+    """Ключи честной очереди: (installation, repo внутри installation).
+
+    Задачи без installation_id (ручной запуск) группируются по repo.
+    Ключ repo включает installation, чтобы группы не пересекались.
+    """
+    repo_key = f"repo:{job.get('repo')}"
+    installation_id = job.get("installation_id")
+    if not installation_id:
+        return repo_key, repo_key
+    # repo внутри installation: задачи repo без installation_id - отдельная группа
+    return f"installation:{installation_id}", f"installation:{installation_id}/{repo_key}"
+
+
+def is_due(job: dict, now: str) -> bool:
+    """Наступило ли время попытки (next_attempt_at, см. backoff)."""
+    next_attempt_at = job.get("next_attempt_at")
+    return not next_attempt_at or next_attempt_at <= now
+
+
+def pick_next(jobs: list, served: dict) -> dict | None:
+    """Выбирает следующую задачу.
+
+    1. Максимальный приоритет - строго раньше остальных
+    2. Внутри приоритета - installation, которую обслуживали давнее всех
+    3. Внутри installation - repo, который обслуживали давнее всех
+    4. Внутри repo - самая старая задача
+
+    Args:
+        jobs: Кандидаты (pending и уже due)
+        served: {ключ группы: номер последней выдачи}, 0 - не обслуживалась
+    """
+    if not jobs:
+        return None
+    top = max(job.get("priority", DEFAULT_PRIORITY) for job in jobs)
+    tier = [job for job in jobs if job.get("priority", DEFAULT_PRIORITY) == top]
+
+    def rank(job):
+        installation_key, repo_key = fairness_keys(job)
+        return served.get(installation_key, 0), served.get(repo_key, 0), job["doc_id"]
+
+    return min(tier, key=rank)
+
+
+def mark_served(job: dict, served: dict) -> None:
+    """Отмечает выдачу задачи в состоянии честной очереди."""
+    seq = served.get("_seq", 0) + 1
+    served["_seq"] = seq
+    for key in fairness_keys(job):
+        served[key] = seq
+
+
+def prune_served(served: dict, jobs: list) -> dict:
+    """Состояние честной очереди без групп, у которых нет задач.
+
+    Без этого в served копились бы ключи всех installations и repos,
+    когда-либо стоявших в очереди.
+
+    Args:
+        jobs: Задачи, группы которых нужно сохранить (pending и только что выданные)
+    """
+    keep = {key for job in jobs for key in fairness_keys(job)}
+    return {key: seq for key, seq in served.items() if key == "_seq" or key in keep}
+
+
+def fair_order(jobs: list, served: dict) -> list:
+    """Порядок задач одного приоритета - тот же, что дают повторные pick_next.
+
+    Installations обслуживаются по кругу (давно обслуженная - первой),
+    внутри installation по кругу идут её repos, внутри repo - задачи по
+    возрасту. Поэтому номер круга задачи и ранг её группы известны
+    заранее, и порядок получается одной сортировкой, а не n вызовами
+    pick_next.
+    """
+    # Задачи каждого repo - от старой к новой
+    by_repo = {}
+    for job in sorted(jobs, key=lambda job: job["doc_id"]):
+        by_repo.setdefault(fairness_keys(job), []).append(job)
+
+    # Внутри installation: круг = номер задачи в своём repo, затем ранг repo
+    by_installation = {}
+    for (installation_key, repo_key), repo_jobs in by_repo.items():
+        repo_rank = (served.get(repo_key, 0), repo_jobs[0]["doc_id"])
+        for turn, job in enumerate(repo_jobs):
+            by_installation.setdefault(installation_key, []).append(((turn, repo_rank), job))
+
+    # Между installations: круг = номер задачи в своей installation, затем ранг installation
+    keyed = []
+    for installation_key, installation_jobs in by_installation.items():
+        installation_jobs.sort(key=lambda item: item[0])
+        first = installation_jobs[0][1]
+        rank = (served.get(installation_key, 0), served.get(fairness_keys(first)[1], 0), first["doc_id"])
+        for turn, (_, job) in enumerate(installation_jobs):
+            keyed.append(((turn, rank), job))
+    keyed.sort(key=lambda item: item[0])
+    return [job for _, job in keyed]
+
+
+def schedule_order(jobs: list, served: dict, now: str = None) -> list:
+    """Полный порядок выдачи pending задач (для позиции в очереди).
+
+    Задачи, ожидающие backoff, идут после готовых - по next_attempt_at.
+    """
+    now = now or datetime.now().isoformat()
+    served = dict(served)
+    tiers = {}
+    waiting = []
+    for job in jobs:
+        if is_due(job, now):
+            tiers.setdefault(job.get("priority", DEFAULT_PRIORITY), []).append(job)
+        else:
+            waiting.append(job)
+    waiting.sort(key=lambda job: (job["next_attempt_at"], job["doc_id"]))
+
+    order = []
+    for priority in sorted(tiers, reverse=True):
+        tier = fair_order(tiers[priority], served)
+        # Выдачи старшего приоритета сдвигают очередь младшего
+        for job in tier:
+            mark_served(job, served)
+        order.extend(tier)
+    return order + waiting
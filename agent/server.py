@@ -3,11 +3,17 @@ import hmac
 import hashlib
 import os
 from fastapi import FastAPI, Request, HTTPException, Header
+# Обращения к db блокируют (flock и разбор db.json, group commit) - выполняем их вне event loop
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import Optional
 from dotenv import load_dotenv
 
-from database import db, IssueStatus, PRReviewStatus
+from database import db, IssueStatus
+from llm_cache import LLM_CACHE_MAX_MB, LLMCache
+from llm_metrics import ParseMetrics
+from notify import notify_workers, ISSUES_CHANNEL, PR_REVIEWS_CHANNEL
+from scheduler import MANUAL_PRIORITY, priority_from_labels
 
 load_dotenv()
 
@@ -15,6 +21,10 @@ load_dotenv()
 GITHUB_WEBHOOK_SECRET = os.getenv("GITHUB_WEBHOOK_SECRET")
 SERVER_PORT = int(os.getenv("SERVER_PORT", "8000"))
 
+# Тот же файл кэша, что у воркеров, - только для статистики
+llm_cache = LLMCache() if LLM_CACHE_MAX_MB else None
+parse_metrics = ParseMetrics()
+
 
 def verify_signature(payload: bytes, signature: str) -> bool:
     """Проверяет подпись webhook от GitHub."""
@@ -45,6 +55,7 @@ class HealthResponse(BaseModel):
     status: str
     pending_issues: int
     stats: dict
+    pools: dict = {}
 
 
 class IssueResponse(BaseModel):
@@ -56,27 +67,55 @@ class IssueResponse(BaseModel):
 @app.get("/", response_model=HealthResponse)
 async def health():
     """Health check endpoint"""
-    stats = db.get_stats()
+    stats = await run_in_threadpool(db.get_stats)
     return HealthResponse(
         status="ok",
         pending_issues=stats["pending"],
-        stats=stats
+        stats=stats,
+        # Размер пулов воркеров (worker.py / pr_review_worker.py с --concurrency)
+        pools=await run_in_threadpool(db.get_pool_status)
     )
 
 
+@app.get("/stats/writes")
+async def write_stats():
+    """Group commit: сколько записей в пачке и сколько ждали webhooks"""
+    return db.get_write_stats()
+
+
+@app.get("/stats/llm-cache")
+async def llm_cache_stats():
+    """Кэш ответов LLM: размер, hit/miss по всем процессам"""
+    if llm_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **await run_in_threadpool(llm_cache.get_stats)}
+
+
+@app.get("/stats/llm-parse")
+async def llm_parse_stats():
+    """Разбор JSON ответов LLM по видам: ok / repaired / failed и доля сбоев"""
+    return await run_in_threadpool(parse_metrics.get_stats)
+
+
+@app.get("/quotas")
+async def quotas():
+    """Квоты installations: расход токенов за сутки (UTC), задачи в работе и остаток"""
+    return await run_in_threadpool(db.get_quotas)
+
+
 @app.get("/issues")
 async def list_issues():
     """Список всех issues в базе"""
     return {
-        "issues": db.get_all(),
-        "stats": db.get_stats()
+        "issues": await run_in_threadpool(db.get_all),
+        "stats": await run_in_threadpool(db.get_stats)
     }
 
 
 @app.get("/issues/pending")
 async def list_pending():
-    """Список pending issues"""
-    return db.get_pending_issues()
+    """Список pending issues (в порядке выдачи, с queue_position)"""
+    return await run_in_threadpool(db.get_pending_issues)
 
 
 @app.post("/webhook")
@@ -125,13 +164,16 @@ async def github_webhook(
             
             print(f"📋 New issue: {repo_full_name}#{issue_number} - {title}")
             
-            doc_id = db.add_issue(
+            doc_id = await run_in_threadpool(
+                db.add_issue,
                 repo_full_name=repo_full_name,
                 issue_number=issue_number,
                 title=title,
                 body=body_text,
-                installation_id=installation_id
+                installation_id=installation_id,
+                priority=priority_from_labels(issue.get("labels"))
             )
+            notify_workers(ISSUES_CHANNEL)
             
             return IssueResponse(
                 status="queued",
@@ -159,21 +201,31 @@ async def github_webhook(
                 print(f"🔄 Re-processing: {repo_full_name}#{issue_number}")
                 
                 # Проверяем существующий issue в БД
-                existing = db.get_issue_by_number(repo_full_name, issue_number)
-                if existing:
-                    db.reset_to_pending(existing['doc_id'])
+                existing = await run_in_threadpool(db.get_issue_by_number, repo_full_name, issue_number)
+                # Архивная запись - только история, ставим issue заново
+                if existing and not existing.get("archived"):
+                    if not await run_in_threadpool(db.reset_to_pending, existing['doc_id'], priority=MANUAL_PRIORITY):
+                        return IssueResponse(
+                            status="processing",
+                            doc_id=existing['doc_id'],
+                            message=f"Issue #{issue_number} is already being processed"
+                        )
+                    notify_workers(ISSUES_CHANNEL)
                     return IssueResponse(
                         status="requeued",
                         doc_id=existing['doc_id'],
                         message=f"Issue #{issue_number} requeued for processing"
                     )
                 else:
-                    doc_id = db.add_issue(
+                    doc_id = await run_in_threadpool(
+                        db.add_issue,
                         repo_full_name=repo_full_name,
                         issue_number=issue_number,
                         title=title,
-                        body=body_text
+                        body=body_text,
+                        priority=MANUAL_PRIORITY
                     )
+                    notify_workers(ISSUES_CHANNEL)
                     return IssueResponse(
                         status="queued",
                         doc_id=doc_id,
@@ -202,12 +254,17 @@ async def github_webhook(
             print(f"🔍 New PR for review: {repo_full_name}#{pr_number}")
             print(f"   Changed files: {len(changed_files) if changed_files else 'will fetch'}")
             
-            doc_id = db.add_pr_review(
+            doc_id = await run_in_threadpool(
+                db.add_pr_review,
                 repo_full_name=repo_full_name,
                 pr_number=pr_number,
                 changed_files=changed_files,  # Может быть пустым - worker получит из GitHub
-                installation_id=installation_id
+                installation_id=installation_id,
+                priority=priority_from_labels(pr.get("labels")),
+                # Новый head отменяет review предыдущего push
+                head_sha=pr.get("head", {}).get("sha")
             )
+            notify_workers(PR_REVIEWS_CHANNEL)
             
             return IssueResponse(
                 status="queued",
@@ -224,9 +281,15 @@ async def manual_process(repo_owner: str, repo_name: str, issue_number: int):
     repo_full_name = f"{repo_owner}/{repo_name}"
     
     # Проверяем существующий
-    existing = db.get_issue_by_number(repo_full_name, issue_number)
-    if existing:
-        db.reset_to_pending(existing['doc_id'])
+    existing = await run_in_threadpool(db.get_issue_by_number, repo_full_name, issue_number)
+    if existing and not existing.get("archived"):
+        if not await run_in_threadpool(db.reset_to_pending, existing['doc_id'], priority=MANUAL_PRIORITY):
+            return IssueResponse(
+                status="processing",
+                doc_id=existing['doc_id'],
+                message=f"Issue #{issue_number} is already being processed"
+            )
+        notify_workers(ISSUES_CHANNEL)
         return IssueResponse(
             status="requeued",
             doc_id=existing['doc_id'],
@@ -234,13 +297,16 @@ async def manual_process(repo_owner: str, repo_name: str, issue_number: int):
         )
     
     # Добавляем новый (без body - worker получит из GitHub)
-    doc_id = db.add_issue(
+    doc_id = await run_in_threadpool(
+        db.add_issue,
         repo_full_name=repo_full_name,
         issue_number=issue_number,
         title=f"Manual trigger #{issue_number}",
         body="",
-        installation_id=None # Worker должен будет сам найти
+        installation_id=None, # Worker должен будет сам найти
+        priority=MANUAL_PRIORITY
     )
+    notify_workers(ISSUES_CHANNEL)
     
     return IssueResponse(
         status="queued",
@@ -255,10 +321,16 @@ async def manual_review(repo_owner: str, repo_name: str, pr_number: int):
     repo_full_name = f"{repo_owner}/{repo_name}"
     
     # Проверяем существующий PR
-    existing = db.get_pr_by_number(repo_full_name, pr_number)
-    if existing:
+    existing = await run_in_threadpool(db.get_pr_by_number, repo_full_name, pr_number)
+    if existing and not existing.get("archived"):
         # Сбрасываем в pending для повторного review
-        db.update_pr_status(existing['doc_id'], PRReviewStatus.PENDING, attempts=0)
+        if not await run_in_threadpool(db.requeue_pr_review, existing['doc_id'], priority=MANUAL_PRIORITY):
+            return IssueResponse(
+                status=existing['status'],
+                doc_id=existing['doc_id'],
+                message=f"PR #{pr_number} is already queued or being reviewed"
+            )
+        notify_workers(PR_REVIEWS_CHANNEL)
         return IssueResponse(
             status="requeued",
             doc_id=existing['doc_id'],
@@ -266,12 +338,15 @@ async def manual_review(repo_owner: str, repo_name: str, pr_number: int):
         )
     
     # Добавляем новый PR для review
-    doc_id = db.add_pr_review(
+    doc_id = await run_in_threadpool(
+        db.add_pr_review,
         repo_full_name=repo_full_name,
         pr_number=pr_number,
         changed_files=[],  # Worker получит из GitHub API
-        installation_id=None
+        installation_id=None,
+        priority=MANUAL_PRIORITY
     )
+    notify_workers(PR_REVIEWS_CHANNEL)
     
     return IssueResponse(
         status="queued",
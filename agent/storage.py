@@ -0,0 +1,513 @@
+"""Storage - бэкенды хранения для IssueDB (TinyDB и SQLite)"""
+import fcntl
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from enum import Enum
+from tinydb import TinyDB
+
+
+# Колонки, которые SQLite хранит отдельно от JSON (для индексов)
+INDEXED_FIELDS = {
+    "issues": ("repo", "issue_number", "status"),
+    "pr_reviews": ("repo", "pr_number", "status"),
+}
+
+INDEXES = {
+    "issues": [("repo", "issue_number"), ("status",)],
+    "pr_reviews": [("repo", "pr_number"), ("status",)],
+}
+
+
+def _plain(value):
+    """Приводит Enum к обычному значению (для SQL параметров)."""
+    if isinstance(value, Enum):
+        return value.value
+    return value
+
+
+def _is_many(value) -> bool:
+    return isinstance(value, (list, tuple, set, frozenset))
+
+
+# ==================== Счётчики ====================
+
+# Счётчики статусов ведутся для этих таблиц ("issues:pending", "issues:total")
+COUNTED_TABLES = tuple(INDEXED_FIELDS)
+
+
+def _counter_deltas(table: str, old_status, new_status) -> dict:
+    """Изменения счётчиков при переходе статуса (None = записи не было/нет)."""
+    deltas = {}
+    if old_status is not None:
+        deltas[f"{table}:{_plain(old_status)}"] = -1
+        deltas[f"{table}:total"] = -1
+    if new_status is not None:
+        key = f"{table}:{_plain(new_status)}"
+        deltas[key] = deltas.get(key, 0) + 1
+        deltas[f"{table}:total"] = deltas.get(f"{table}:total", 0) + 1
+    return {k: v for k, v in deltas.items() if v}
+
+
+def _table_counters(counters: dict, table: str) -> dict:
+    """{status: count, "total": count} для одной таблицы."""
+    prefix = f"{table}:"
+    return {k[len(prefix):]: v for k, v in counters.items() if k.startswith(prefix)}
+
+
+# ==================== TinyDB ====================
+
+class TinyDBTable:
+    """Таблица в формате TinyDB с минимальным API, общим для всех бэкендов"""
+
+    def __init__(self, storage: "TinyDBStorage", name: str):
+        self.storage = storage
+        self.name = name
+
+    def _docs(self) -> dict:
+        return self.storage.data.setdefault(self.name, {})
+
+    def _matches(self, doc: dict, filters: dict) -> bool:
+        for field, value in filters.items():
+            actual = _plain(doc.get(field))
+            if _is_many(value):
+                if actual not in [_plain(v) for v in value]:
+                    return False
+            elif actual != _plain(value):
+                return False
+        return True
+
+    def _with_id(self, doc_id: str, doc: dict) -> dict:
+        result = dict(doc)
+        result['doc_id'] = int(doc_id)
+        return result
+
+    def insert(self, doc: dict) -> int:
+        with self.storage.transaction():
+            docs = self._docs()
+            # Последний выданный ID храним отдельно: после архивации
+            # max(doc_id) уменьшается, а ID не должны повторяться
+            last_id_key = f"last_id:{self.name}"
+            last_id = max(
+                max((int(k) for k in docs), default=0),
+                self.storage.get_meta(last_id_key, 0)
+            )
+            doc_id = last_id + 1
+            docs[str(doc_id)] = {k: v for k, v in doc.items() if k != 'doc_id'}
+            self.storage.set_meta(last_id_key, doc_id)
+            self.storage.add_counters(_counter_deltas(self.name, None, doc.get("status")))
+            self.storage.dirty = True
+            return doc_id
+
+    def get(self, doc_id: int) -> dict | None:
+        with self.storage.transaction():
+            doc = self._docs().get(str(doc_id))
+            return self._with_id(doc_id, doc) if doc is not None else None
+
+    def update(self, fields: dict, doc_id: int) -> None:
+        with self.storage.transaction():
+            doc = self._docs().get(str(doc_id))
+            if doc is None:
+                return
+            old_status = doc.get("status")
+            doc.update(fields)
+            if "status" in fields and _plain(old_status) != _plain(fields["status"]):
+                self.storage.add_counters(_counter_deltas(self.name, old_status, fields["status"]))
+            self.storage.dirty = True
+
+    def load(self, docs: list) -> None:
+        """Массовая загрузка записей с заданными doc_id (миграция)."""
+        with self.storage.transaction():
+            table_docs = self._docs()
+            last_id_key = f"last_id:{self.name}"
+            last_id = self.storage.get_meta(last_id_key, 0)
+            for doc in docs:
+                doc_id = int(doc['doc_id'])
+                table_docs[str(doc_id)] = {k: v for k, v in doc.items() if k != 'doc_id'}
+                self.storage.add_counters(_counter_deltas(self.name, None, doc.get("status")))
+                last_id = max(last_id, doc_id)
+            self.storage.set_meta(last_id_key, last_id)
+            self.storage.dirty = True
+
+    def remove(self, doc_ids: list) -> None:
+        """Удаляет записи (счётчики статусов уменьшаются)."""
+        with self.storage.transaction():
+            docs = self._docs()
+            for doc_id in doc_ids:
+                doc = docs.pop(str(doc_id), None)
+                if doc is not None:
+                    self.storage.add_counters(_counter_deltas(self.name, doc.get("status"), None))
+                    self.storage.dirty = True
+
+    def find(self, **filters) -> list:
+        """Записи, у которых поля равны значениям (список значений = IN)."""
+        with self.storage.transaction():
+            return [
+                self._with_id(doc_id, doc)
+                for doc_id, doc in self._docs().items()
+                if self._matches(doc, filters)
+            ]
+
+    def count(self, **filters) -> int:
+        with self.storage.transaction():
+            return sum(1 for doc in self._docs().values() if self._matches(doc, filters))
+
+    def counters(self) -> dict:
+        """Поддерживаемые счётчики статусов (без сканирования таблицы)."""
+        with self.storage.transaction():
+            return _table_counters(self.storage.get_counters(), self.name)
+
+    def all(self) -> list:
+        return self.find()
+
+
+class TinyDBStorage:
+    """JSON файл в формате TinyDB.
+    
+    Транзакция = эксклюзивная блокировка файла + одно чтение и не более
+    одной записи всего документа, сколько бы операций в ней ни было.
+    """
+
+    COUNTERS_TABLE = "counters"
+    META_TABLE = "meta"
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = TinyDB(path)
+        self._lock = threading.RLock()
+        self._lock_file = open(f"{path}.lock", "a")
+        self._depth = 0
+        self.data = None
+        self.dirty = False
+
+        with self.transaction():
+            if self.COUNTERS_TABLE not in self.data:
+                self.rebuild_counters()
+
+    @contextmanager
+    def transaction(self):
+        """Эксклюзивная блокировка файла (между процессами и потоками).
+        
+        Без блокировки параллельные read-modify-write от server/worker
+        теряют записи друг друга.
+        """
+        with self._lock:
+            if self._depth == 0:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+                self.data = self.db.storage.read() or {}
+                self.dirty = False
+            self._depth += 1
+            try:
+                yield self
+                if self._depth == 1 and self.dirty:
+                    self.db.storage.write(self.data)
+            finally:
+                self._depth -= 1
+                if self._depth == 0:
+                    self.data = None
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def get_counters(self) -> dict:
+        with self.transaction():
+            return dict(self.data.get(self.COUNTERS_TABLE, {}).get("1", {}))
+
+    def add_counters(self, deltas: dict) -> None:
+        with self.transaction():
+            counters = self.data.setdefault(self.COUNTERS_TABLE, {}).setdefault("1", {})
+            for key, delta in deltas.items():
+                counters[key] = counters.get(key, 0) + delta
+            self.dirty = True
+
+    def get_meta(self, key: str, default=None):
+        """Служебное значение (состояние планировщика и т.п.)."""
+        with self.transaction():
+            return self.data.get(self.META_TABLE, {}).get("1", {}).get(key, default)
+
+    def set_meta(self, key: str, value) -> None:
+        with self.transaction():
+            self.data.setdefault(self.META_TABLE, {}).setdefault("1", {})[key] = value
+            self.dirty = True
+
+    def rebuild_counters(self) -> dict:
+        """Пересчитать счётчики по данным. Returns: расхождения {key: (было, стало)}."""
+        with self.transaction():
+            counters = {}
+            for name in COUNTED_TABLES:
+                docs = self.data.get(name, {})
+                counters[f"{name}:total"] = len(docs)
+                for doc in docs.values():
+                    key = f"{name}:{_plain(doc.get('status'))}"
+                    counters[key] = counters.get(key, 0) + 1
+            old = self.get_counters()
+            self.data[self.COUNTERS_TABLE] = {"1": counters}
+            self.dirty = True
+            return _counter_drift(old, counters)
+
+    def table(self, name: str) -> TinyDBTable:
+        return TinyDBTable(self, name)
+
+    def close(self) -> None:
+        self.db.close()
+        self._lock_file.close()
+
+
+def _counter_drift(old: dict, new: dict) -> dict:
+    return {
+        key: (old.get(key, 0), new.get(key, 0))
+        for key in set(old) | set(new)
+        if old.get(key, 0) != new.get(key, 0)
+    }
+
+
+# ==================== SQLite ====================
+
+class SQLiteTable:
+    """Таблица SQLite: индексируемые поля в колонках, весь документ в JSON"""
+
+    def __init__(self, storage: "SQLiteStorage", name: str):
+        self.storage = storage
+        self.name = name
+        self.columns = INDEXED_FIELDS.get(name, ())
+
+    def _row_to_doc(self, row) -> dict:
+        doc = json.loads(row[1])
+        doc['doc_id'] = row[0]
+        return doc
+
+    def _where(self, filters: dict) -> tuple[str, list]:
+        clauses = []
+        params = []
+        for field, value in filters.items():
+            if field in self.columns:
+                column = field
+            else:
+                column = f"json_extract(data, '$.{field}')"
+            if _is_many(value):
+                values = [_plain(v) for v in value]
+                if not values:
+                    clauses.append("0")
+                    continue
+                clauses.append(f"{column} IN ({', '.join('?' * len(values))})")
+                params.extend(values)
+            elif value is None:
+                clauses.append(f"{column} IS NULL")
+            else:
+                clauses.append(f"{column} = ?")
+                params.append(_plain(value))
+        where = " WHERE " + " AND ".join(clauses) if clauses else ""
+        return where, params
+
+    def insert(self, doc: dict) -> int:
+        doc = {k: v for k, v in doc.items() if k != 'doc_id'}
+        columns = ", ".join(("data",) + self.columns)
+        placeholders = ", ".join("?" * (len(self.columns) + 1))
+        values = [json.dumps(doc)] + [_plain(doc.get(c)) for c in self.columns]
+        with self.storage.transaction() as conn:
+            cursor = conn.execute(
+                f"INSERT INTO {self.name} ({columns}) VALUES ({placeholders})", values
+            )
+            self.storage.add_counters(_counter_deltas(self.name, None, doc.get("status")))
+            return cursor.lastrowid
+
+    def get(self, doc_id: int) -> dict | None:
+        rows = self.storage.query(
+            f"SELECT doc_id, data FROM {self.name} WHERE doc_id = ?", (doc_id,)
+        )
+        return self._row_to_doc(rows[0]) if rows else None
+
+    def update(self, fields: dict, doc_id: int) -> None:
+        with self.storage.transaction() as conn:
+            row = conn.execute(
+                f"SELECT data FROM {self.name} WHERE doc_id = ?", (doc_id,)
+            ).fetchone()
+            if row is None:
+                return
+            doc = json.loads(row[0])
+            old_status = doc.get("status")
+            doc.update(fields)
+            assignments = ", ".join(["data = ?"] + [f"{c} = ?" for c in self.columns])
+            values = [json.dumps(doc)] + [_plain(doc.get(c)) for c in self.columns]
+            conn.execute(
+                f"UPDATE {self.name} SET {assignments} WHERE doc_id = ?", values + [doc_id]
+            )
+            if "status" in fields and old_status != _plain(fields["status"]):
+                self.storage.add_counters(_counter_deltas(self.name, old_status, fields["status"]))
+
+    def load(self, docs: list) -> None:
+        """Массовая загрузка записей с заданными doc_id (миграция)."""
+        columns = ", ".join(("doc_id", "data") + self.columns)
+        placeholders = ", ".join("?" * (len(self.columns) + 2))
+        rows = []
+        deltas = {}
+        for doc in docs:
+            data = {k: v for k, v in doc.items() if k != 'doc_id'}
+            rows.append([int(doc['doc_id']), json.dumps(data)] + [_plain(data.get(c)) for c in self.columns])
+            for key, delta in _counter_deltas(self.name, None, data.get("status")).items():
+                deltas[key] = deltas.get(key, 0) + delta
+        with self.storage.transaction() as conn:
+            conn.executemany(f"INSERT INTO {self.name} ({columns}) VALUES ({placeholders})", rows)
+            self.storage.add_counters(deltas)
+
+    def scan(self, chunk_size: int):
+        """Все записи по порядку doc_id, пачками (без загрузки таблицы целиком)."""
+        last_id = 0
+        while True:
+            rows = self.storage.query(
+                f"SELECT doc_id, data FROM {self.name} WHERE doc_id > ? ORDER BY doc_id LIMIT ?",
+                (last_id, chunk_size)
+            )
+            if not rows:
+                return
+            yield [self._row_to_doc(r) for r in rows]
+            last_id = rows[-1][0]
+
+    def remove(self, doc_ids: list) -> None:
+        """Удаляет записи (счётчики статусов уменьшаются)."""
+        with self.storage.transaction() as conn:
+            for doc_id in doc_ids:
+                row = conn.execute(
+                    f"SELECT status FROM {self.name} WHERE doc_id = ?", (doc_id,)
+                ).fetchone()
+                if row is not None:
+                    conn.execute(f"DELETE FROM {self.name} WHERE doc_id = ?", (doc_id,))
+                    self.storage.add_counters(_counter_deltas(self.name, row[0], None))
+
+    def find(self, **filters) -> list:
+        """Записи, у которых поля равны значениям (список значений = IN)."""
+        where, params = self._where(filters)
+        rows = self.storage.query(
+            f"SELECT doc_id, data FROM {self.name}{where} ORDER BY doc_id", params
+        )
+        return [self._row_to_doc(r) for r in rows]
+
+    def count(self, **filters) -> int:
+        where, params = self._where(filters)
+        return self.storage.query(f"SELECT COUNT(*) FROM {self.name}{where}", params)[0][0]
+
+    def counters(self) -> dict:
+        """Поддерживаемые счётчики статусов (без сканирования таблицы)."""
+        return _table_counters(self.storage.get_counters(), self.name)
+
+    def all(self) -> list:
+        return self.find()
+
+
+class SQLiteStorage:
+    """SQLite в режиме WAL - точечные записи и индексы вместо полного скана"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(
+            path,
+            timeout=30,
+            isolation_level=None,       # транзакции открываем сами
+            check_same_thread=False     # доступ сериализуется через _lock
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # FULL: fsync на каждый commit. С NORMAL WAL теряет последние
+        # транзакции при отключении питания, а group commit уже ответил
+        # webhook (и GitHub) 200 - задача пропала бы молча
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self._create_schema()
+
+    def _create_schema(self) -> None:
+        with self.transaction() as conn:
+            for name, columns in INDEXED_FIELDS.items():
+                column_defs = ", ".join(columns)
+                conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {name} ("
+                    f"doc_id INTEGER PRIMARY KEY AUTOINCREMENT, data TEXT NOT NULL, {column_defs})"
+                )
+                for index in INDEXES[name]:
+                    index_name = f"idx_{name}_{'_'.join(index)}"
+                    conn.execute(
+                        f"CREATE INDEX IF NOT EXISTS {index_name} ON {name} ({', '.join(index)})"
+                    )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+            if not conn.execute("SELECT 1 FROM counters LIMIT 1").fetchone():
+                self.rebuild_counters()
+
+    @contextmanager
+    def transaction(self):
+        """Транзакция на запись (BEGIN IMMEDIATE), вложенные вызовы переиспользуют внешнюю."""
+        with self._lock:
+            if self.conn.in_transaction:
+                yield self.conn
+                return
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def get_counters(self) -> dict:
+        return dict(self.query("SELECT name, value FROM counters"))
+
+    def add_counters(self, deltas: dict) -> None:
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO counters (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                list(deltas.items())
+            )
+
+    def get_meta(self, key: str, default=None):
+        """Служебное значение (состояние планировщика и т.п.)."""
+        rows = self.query("SELECT value FROM meta WHERE key = ?", (key,))
+        return json.loads(rows[0][0]) if rows else default
+
+    def set_meta(self, key: str, value) -> None:
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (key, json.dumps(value))
+            )
+
+    def rebuild_counters(self) -> dict:
+        """Пересчитать счётчики по данным. Returns: расхождения {key: (было, стало)}."""
+        with self.transaction() as conn:
+            counters = {}
+            for name in COUNTED_TABLES:
+                counters[f"{name}:total"] = conn.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
+                for status, count in conn.execute(f"SELECT status, COUNT(*) FROM {name} GROUP BY status"):
+                    counters[f"{name}:{status}"] = count
+            old = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+            conn.execute("DELETE FROM counters")
+            conn.executemany("INSERT INTO counters (name, value) VALUES (?, ?)", list(counters.items()))
+            return _counter_drift(old, counters)
+
+    def query(self, sql: str, params=()) -> list:
+        """SELECT под общей блокировкой соединения."""
+        with self._lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def table(self, name: str) -> SQLiteTable:
+        return SQLiteTable(self, name)
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+BACKENDS = {
+    "tinydb": TinyDBStorage,
+    "sqlite": SQLiteStorage,
+}
+
+
+def open_storage(backend: str, path: str):
+    """Открывает хранилище по имени бэкенда (DB_BACKEND)."""
+    try:
+        storage_cls = BACKENDS[backend.lower()]
+    except KeyError:
+        raise ValueError(f"Unknown DB_BACKEND '{backend}', expected one of: {', '.join(BACKENDS)}")
+    return storage_cls(path)
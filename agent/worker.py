@@ -1,26 +1,56 @@
 """Worker - фоновый процесс для обработки issues из очереди"""
+import multiprocessing
 import os
 import time
 import signal
+import socket
 import sys
+from typing import Callable
 from dotenv import load_dotenv
 
-from database import db, IssueStatus
+from database import db, IssueStatus, ARCHIVE_AFTER_DAYS
+from checkpoint import prune_checkpoints
 from issue_solver import process_issue_from_db
+from repo_manager import RepoManager
+from leases import Heartbeat, LeaseLost, REAPER_INTERVAL
+from notify import WakeupListener, ISSUES_CHANNEL
+from autoscale import Autoscaler, AUTOSCALE_INTERVAL
 
 load_dotenv()
 
-WORKER_INTERVAL = int(os.getenv("WORKER_INTERVAL", "5"))  # секунды
+# Запасной опрос БД (секунды) - обычно воркера будит server.py через notify
+WORKER_INTERVAL = int(os.getenv("WORKER_INTERVAL", "30"))
 MAX_ATTEMPTS = int(os.getenv("MAX_ATTEMPTS", "3"))
+# Как часто переносить завершённые задачи в архив (секунды)
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL", "3600"))
+# Сколько issues обрабатывается параллельно (процессов в пуле)
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "1"))
+# Больше WORKER_CONCURRENCY - пул растёт до этого размера при длинной очереди
+WORKER_MAX_CONCURRENCY = int(os.getenv("WORKER_MAX_CONCURRENCY", "0"))
+# Несколько pending issues одного repo - один клон на всю пачку
+COALESCE_REPO_JOBS = os.getenv("COALESCE_REPO_JOBS", "false").lower() == "true"
+COALESCE_MAX_JOBS = int(os.getenv("COALESCE_MAX_JOBS", "5"))
+# Процесс пула, падающий сразу после старта, перезапускается с растущей паузой (до максимума, секунды)
+RESPAWN_BACKOFF_MAX = int(os.getenv("RESPAWN_BACKOFF_MAX", "60"))
+# Процесс, проработавший столько секунд, считается поднявшимся - счётчик падений сбрасывается
+RESPAWN_STABLE_SECONDS = 60
 
 
 class Worker:
     """Фоновый воркер для обработки issues"""
     
-    def __init__(self):
+    def __init__(self, worker_id: str = None):
+        """
+        Args:
+            worker_id: Владелец lease (несколько воркеров в одном процессе - runtime.py)
+        """
         self.running = False
         self.processed_count = 0
         self.failed_count = 0
+        # Владелец lease в БД - несколько воркеров не возьмут один issue
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self._last_reap = 0.0
+        self._last_archive = 0.0
     
     def start(self):
         """Запускает воркер"""
@@ -32,22 +62,24 @@ class Worker:
         
         print("=" * 60)
         print("🚀 Worker started")
-        print(f"   Checking for issues every {WORKER_INTERVAL} seconds")
+        print(f"   Woken up on new issues, fallback poll every {WORKER_INTERVAL} seconds")
         print(f"   Max attempts per issue: {MAX_ATTEMPTS}")
         print("   Press Ctrl+C to stop")
         print("=" * 60)
         
-        while self.running:
-            try:
-                self._process_pending()
-            except Exception as e:
-                print(f"❌ Worker error: {e}")
-            
-            # Ждём перед следующей проверкой
-            for _ in range(WORKER_INTERVAL):
-                if not self.running:
-                    break
-                time.sleep(1)
+        wakeup = WakeupListener(ISSUES_CHANNEL)
+        try:
+            while self.running:
+                # Только что обработали issue - сразу проверяем следующий
+                if self.run_iteration():
+                    continue
+                
+                # Ждём уведомления от server.py (или таймаута запасного опроса)
+                for _ in range(WORKER_INTERVAL):
+                    if not self.running or wakeup.wait(1):
+                        break
+        finally:
+            wakeup.close()
         
         print("\n" + "=" * 60)
         print("👋 Worker stopped")
@@ -55,39 +87,148 @@ class Worker:
         print(f"   Failed: {self.failed_count}")
         print("=" * 60)
     
+    def run_iteration(self) -> bool:
+        """Один проход цикла: reaper, архивация, обработка pending issue.
+        
+        Returns:
+            True если issue был взят в работу
+        """
+        try:
+            self._reap_expired()
+            self._archive_finished()
+            return self._process_pending()
+        except Exception as e:
+            print(f"❌ Worker error: {e}")
+            return False
+    
     def _handle_shutdown(self, signum, frame):
         """Обрабатывает сигнал завершения"""
         print("\n⚠️ Shutdown signal received, finishing current task...")
         self.running = False
     
-    def _process_pending(self):
-        """Обрабатывает pending issues"""
-        pending = db.get_pending_issues(limit=1)
+    def _reap_expired(self):
+        """Возвращает в очередь issues упавших воркеров (раз в REAPER_INTERVAL)"""
+        if time.time() - self._last_reap < REAPER_INTERVAL:
+            return
+        self._last_reap = time.time()
         
-        if not pending:
+        requeued = db.requeue_expired_issues(max_attempts=MAX_ATTEMPTS)
+        if requeued:
+            print(f"♻️ Requeued {len(requeued)} issue(s) with expired lease: {requeued}")
+    
+    def _archive_finished(self):
+        """Выносит старые завершённые issues и PR reviews в архив, чистит брошенные checkpoints (раз в ARCHIVE_INTERVAL)"""
+        if time.time() - self._last_archive < ARCHIVE_INTERVAL:
             return
+        self._last_archive = time.time()
+        
+        archived = db.archive_finished()
+        if archived["issues"] or archived["pr_reviews"]:
+            print(f"📦 Archived {archived['issues']} issue(s), {archived['pr_reviews']} PR review(s)")
+        
+        # Checkpoints issues, которые так и не были решены (DEAD), живут столько же
+        pruned = prune_checkpoints(ARCHIVE_AFTER_DAYS)
+        if pruned:
+            print(f"🧹 Removed {pruned} stale checkpoint(s)")
+    
+    def _claim(self, limit: int = 1) -> list:
+        """Атомарно забирает issues (PENDING -> PROCESSING, attempts + 1).
+        
+        Issues repo, который уже обрабатывает другой воркер, не выдаются:
+        два клона и две ветки одного repo гонялись бы за create_pull_request.
+        Issues, исчерпавшие MAX_ATTEMPTS, claim сам переводит в DEAD.
+        """
+        return db.claim_issue_batch(
+            self.worker_id,
+            limit=limit,
+            max_attempts=MAX_ATTEMPTS,
+            exclusive_repos=True
+        )
+    
+    def _process_pending(self) -> bool:
+        """Обрабатывает pending issue (или пачку issues одного repo).
+        
+        Returns:
+            True если issue был взят в работу
+        """
+        issues = self._claim(COALESCE_MAX_JOBS if COALESCE_REPO_JOBS else 1)
+        
+        if not issues:
+            return False
+        
+        if len(issues) > 1:
+            self._process_session(issues)
+        else:
+            self._process_issue(issues[0])
+        return True
+    
+    def _process_session(self, issues: list):
+        """Обрабатывает issues одного repo в одном клоне.
         
-        issue_data = pending[0]
+        Перед каждым issue clone_or_pull сбрасывает клон на default branch,
+        дальше у каждого issue своя ветка fix/issue-N.
+        """
+        repo = issues[0]['repo']
+        print(f"\n📦 Coalescing {len(issues)} issues of {repo} into one clone session")
+        
+        remaining = [issue['doc_id'] for issue in issues]
+        # Issues сессии, чей lease reaper отдал другому воркеру
+        lost = set()
+        
+        def renew() -> bool:
+            # Продлеваем lease всех ещё не обработанных issues сессии
+            renewed = {doc_id: db.heartbeat_issue(doc_id, self.worker_id) for doc_id in list(remaining)}
+            lost.update(doc_id for doc_id, ok in renewed.items() if not ok)
+            return not renewed or any(renewed.values())
+        
+        repo_manager = RepoManager(repo)
+        try:
+            with Heartbeat(renew):
+                for issue_data in issues:
+                    if not self.running:
+                        # Остановка - не начатые issues возвращаем в очередь
+                        for doc_id in list(remaining):
+                            db.release_issue(doc_id, self.worker_id)
+                        print(f"↩️ Released {len(remaining)} issue(s) of {repo} back to the queue")
+                        break
+                    doc_id = issue_data['doc_id']
+                    self._process_issue(issue_data, repo_manager, lease_lost=lambda: doc_id in lost)
+                    remaining.remove(issue_data['doc_id'])
+        finally:
+            repo_manager.cleanup()
+    
+    def _process_issue(
+        self,
+        issue_data: dict,
+        repo_manager: RepoManager = None,
+        lease_lost: Callable[[], bool] = None
+    ):
+        """Обрабатывает один взятый в работу issue (в общем клоне сессии, если передан).
+        
+        Args:
+            lease_lost: Потеря lease в сессии (без сессии - свой Heartbeat)
+        """
         doc_id = issue_data.get('doc_id')
         repo = issue_data.get('repo')
         issue_number = issue_data.get('issue_number')
-        attempts = issue_data.get('attempts', 0)
-        
-        # Проверяем лимит попыток
-        if attempts >= MAX_ATTEMPTS:
-            print(f"⚠️ Issue #{issue_number} exceeded max attempts ({MAX_ATTEMPTS})")
-            db.set_failed(doc_id, f"Max attempts ({MAX_ATTEMPTS}) exceeded")
-            return
+        attempts = issue_data.get('attempts', 1)
         
         print(f"\n{'='*60}")
-        print(f"📋 Processing: {repo}#{issue_number} (attempt {attempts + 1}/{MAX_ATTEMPTS})")
+        print(f"📋 Processing: {repo}#{issue_number} (attempt {attempts}/{MAX_ATTEMPTS})")
         print(f"{'='*60}")
         
-        # Увеличиваем счётчик попыток
-        db.increment_attempts(doc_id)
-        
         try:
-            pr_number = process_issue_from_db(issue_data)
+            if repo_manager is None:
+                # Heartbeat продлевает lease, пока идёт обработка
+                with Heartbeat(lambda: db.heartbeat_issue(doc_id, self.worker_id)) as heartbeat:
+                    pr_number = process_issue_from_db(
+                        issue_data, owner=self.worker_id, lease_lost=lambda: heartbeat.lost
+                    )
+            else:
+                # Lease продлевает heartbeat сессии
+                pr_number = process_issue_from_db(
+                    issue_data, repo_manager, owner=self.worker_id, lease_lost=lease_lost
+                )
             
             if pr_number:
                 self.processed_count += 1
@@ -96,30 +237,216 @@ class Worker:
                 self.failed_count += 1
                 print(f"⚠️ No changes made for issue #{issue_number}")
                 
+        except LeaseLost as e:
+            # Issue уже у другого воркера - его статус не трогаем
+            print(f"⏭️ Abandoned issue #{issue_number}: {e}")
         except Exception as e:
             self.failed_count += 1
             print(f"❌ Failed to process issue #{issue_number}: {e}")
-            db.set_failed(doc_id, str(e))
+            db.set_failed(doc_id, str(e), owner=self.worker_id)
     
     def process_one(self):
         """Обрабатывает один pending issue и завершается"""
-        pending = db.get_pending_issues(limit=1)
+        issues = self._claim()
         
-        if not pending:
+        if not issues:
             print("ℹ️ No pending issues")
             return None
         
-        issue_data = pending[0]
-        
+        issue_data = issues[0]
+        doc_id = issue_data.get('doc_id')
         try:
-            return process_issue_from_db(issue_data)
+            with Heartbeat(lambda: db.heartbeat_issue(doc_id, self.worker_id)) as heartbeat:
+                return process_issue_from_db(issue_data, owner=self.worker_id, lease_lost=lambda: heartbeat.lost)
+        except LeaseLost as e:
+            print(f"⏭️ Abandoned issue: {e}")
+            return None
         except Exception as e:
             print(f"❌ Failed: {e}")
+            # Иначе issue висел бы в PROCESSING до истечения lease
+            db.set_failed(doc_id, str(e), owner=self.worker_id)
             return None
 
 
-def run_worker():
-    """Запуск воркера"""
+class WorkerPool:
+    """Пул процессов-воркеров: N задач обрабатываются одновременно.
+    
+    Каждый процесс - обычный Worker (или PRReviewWorker) со своим lease,
+    сокетом notify и подключением к БД. Процессы запускаются через spawn:
+    унаследованные при fork файл блокировки TinyDB и соединение SQLite
+    разделялись бы между процессами. Рабочая папка у каждой задачи своя
+    (RepoManager клонирует в repos/{UUID}/).
+    
+    С max_concurrency > concurrency пул масштабируется по глубине
+    очереди (autoscale.py). Лишний процесс получает SIGTERM и выходит,
+    доделав текущую задачу - новых задач он уже не берёт.
+    """
+    
+    def __init__(
+        self,
+        concurrency: int,
+        interval: int = None,
+        max_concurrency: int = None,
+        target=None,
+        queue: str = ISSUES_CHANNEL
+    ):
+        """
+        Args:
+            concurrency: Размер пула (минимальный при автомасштабировании)
+            interval: Запасной интервал опроса БД в процессах
+            max_concurrency: Максимальный размер пула (больше concurrency - автомасштабирование)
+            target: Точка входа процесса (default: _run_pool_child этого модуля)
+            queue: Очередь, по которой масштабируется пул (issues / pr_reviews)
+        """
+        self.concurrency = concurrency
+        self.max_concurrency = max(max_concurrency or concurrency, concurrency)
+        self.interval = interval or WORKER_INTERVAL
+        self.target = target or _run_pool_child
+        self.queue = queue
+        self.autoscaler = None
+        if self.max_concurrency > self.concurrency:
+            self.autoscaler = Autoscaler(self.concurrency, self.max_concurrency)
+        self.running = False
+        self.children = []
+        # Процессы, которые доделывают задачу перед выходом (уменьшение пула)
+        self.draining = []
+        self._context = multiprocessing.get_context("spawn")
+        self._last_autoscale = 0.0
+        # Перезапуски по слотам: падения подряд и когда можно запустить снова
+        self._spawned_at = {}
+        self._crashes = {}
+        self._respawn_at = {}
+    
+    def _spawn(self) -> multiprocessing.Process:
+        child = self._context.Process(target=self.target, args=(self.interval,), daemon=False)
+        child.start()
+        self._spawned_at[child] = time.monotonic()
+        return child
+    
+    def _respawn_dead(self):
+        """Перезапускает упавшие процессы; падающие на старте - с экспоненциальной паузой.
+        
+        Без паузы процесс с ошибкой окружения или импорта перезапускался
+        бы в бесконечном цикле.
+        """
+        now = time.monotonic()
+        for i, child in enumerate(self.children):
+            if child.is_alive() or not self.running:
+                continue
+            if i not in self._respawn_at:
+                started = self._spawned_at.pop(child, now)
+                crashes = 1 if now - started >= RESPAWN_STABLE_SECONDS else self._crashes.get(i, 0) + 1
+                self._crashes[i] = crashes
+                delay = min(RESPAWN_BACKOFF_MAX, 2 ** (crashes - 1) - 1)
+                self._respawn_at[i] = now + delay
+                print(f"⚠️ Worker process {child.pid} exited with code {child.exitcode}, restarting"
+                      + (f" in {delay}s ({crashes} crashes in a row)" if delay else ""))
+            if now >= self._respawn_at[i]:
+                del self._respawn_at[i]
+                self.children[i] = self._spawn()
+    
+    def start(self):
+        """Запускает пул и следит за процессами до сигнала завершения"""
+        self.running = True
+        signal.signal(signal.SIGINT, self._handle_shutdown)
+        signal.signal(signal.SIGTERM, self._handle_shutdown)
+        
+        print("=" * 60)
+        if self.autoscaler:
+            print(f"🚀 Worker pool started: {self.concurrency}-{self.max_concurrency} processes (autoscaling)")
+        else:
+            print(f"🚀 Worker pool started: {self.concurrency} processes")
+        print("=" * 60)
+        
+        self.children = [self._spawn() for _ in range(self.concurrency)]
+        self._report()
+        while self.running:
+            self._respawn_dead()
+            
+            drained = [child for child in self.draining if not child.is_alive()]
+            if drained:
+                self.draining = [child for child in self.draining if child.is_alive()]
+                self._report()
+            
+            if self.autoscaler and time.time() - self._last_autoscale >= AUTOSCALE_INTERVAL:
+                self._last_autoscale = time.time()
+                try:
+                    self._autoscale()
+                except Exception as e:
+                    # БД недоступна - пул остаётся прежнего размера
+                    print(f"⚠️ Autoscale failed: {e}")
+            time.sleep(1)
+        
+        self.stop()
+    
+    def _autoscale(self):
+        """Подгоняет число процессов под очередь"""
+        stats = db.get_stats()
+        if self.queue == ISSUES_CHANNEL:
+            pending, active = stats["pending"], stats["processing"]
+        else:
+            pending, active = stats["pr_pending"], stats["pr_reviewing"]
+        
+        current = len(self.children)
+        target = self.autoscaler.desired(pending, active, current, time.monotonic())
+        if target == current:
+            return
+        
+        if target > current:
+            print(f"📈 Scaling up {current} -> {target} ({pending} pending, {active} in progress)")
+            self.children += [self._spawn() for _ in range(target - current)]
+        else:
+            print(f"📉 Scaling down {current} -> {target}, draining {current - target} process(es)")
+            while len(self.children) > target:
+                child = self.children.pop()
+                self._crashes.pop(len(self.children), None)
+                self._respawn_at.pop(len(self.children), None)
+                if child.is_alive():
+                    os.kill(child.pid, signal.SIGTERM)
+                    self.draining.append(child)
+        self._report()
+    
+    def _report(self, stopped: bool = False):
+        """Сохраняет размер пула в БД - его показывает health endpoint сервера"""
+        try:
+            db.set_pool_status(self.queue, {
+                "size": 0 if stopped else len(self.children),
+                "draining": 0 if stopped else len(self.draining),
+                "min": self.concurrency,
+                "max": self.max_concurrency,
+                "pid": os.getpid()
+            })
+        except Exception as e:
+            print(f"⚠️ Failed to report pool size: {e}")
+    
+    def stop(self):
+        """Просит воркеров завершиться и ждёт, пока они доделают текущие задачи"""
+        for child in self.children + self.draining:
+            if child.is_alive():
+                os.kill(child.pid, signal.SIGTERM)
+        for child in self.children + self.draining:
+            child.join()
+        self._report(stopped=True)
+        print("👋 Worker pool stopped")
+    
+    def _handle_shutdown(self, signum, frame):
+        """Обрабатывает сигнал завершения"""
+        print(f"\n⚠️ Shutdown signal received, waiting for {len(self.children)} worker(s) to finish...")
+        self.running = False
+
+
+def _run_pool_child(interval: int):
+    """Точка входа процесса пула"""
+    global WORKER_INTERVAL
+    WORKER_INTERVAL = interval
+    Worker().start()
+
+
+def run_worker(concurrency: int = 1, max_concurrency: int = 0):
+    """Запуск воркера (concurrency > 1 или max_concurrency > concurrency - пул процессов)"""
+    if concurrency > 1 or max_concurrency > concurrency:
+        WorkerPool(concurrency, max_concurrency=max_concurrency).start()
+        return
     worker = Worker()
     worker.start()
 
@@ -133,6 +460,7 @@ def run_once():
 def main():
     """CLI entry point"""
     import argparse
+    global WORKER_INTERVAL
     
     parser = argparse.ArgumentParser(description="Issue Solver Worker")
     parser.add_argument(
@@ -144,7 +472,19 @@ def main():
         "--interval",
         type=int,
         default=WORKER_INTERVAL,
-        help=f"Check interval in seconds (default: {WORKER_INTERVAL})"
+        help=f"Fallback poll interval in seconds (default: {WORKER_INTERVAL})"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=WORKER_CONCURRENCY,
+        help=f"Issues processed in parallel, one process each (default: {WORKER_CONCURRENCY})"
+    )
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=WORKER_MAX_CONCURRENCY,
+        help="Autoscale the pool between --concurrency and this many processes by queue depth"
     )
     
     args = parser.parse_args()
@@ -154,9 +494,8 @@ def main():
         sys.exit(0 if result else 1)
     else:
         if args.interval:
-            import worker
-            worker.WORKER_INTERVAL = args.interval
-        run_worker()
+            WORKER_INTERVAL = args.interval
+        run_worker(concurrency=args.concurrency, max_concurrency=args.max_concurrency)
 
 
 if __name__ == "__main__":
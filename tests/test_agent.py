@@ -140,6 +140,1235 @@ class TestDatabase:
         assert stats["pr_pending"] == 1
 
 
+class TestSQLiteDatabase:
+    """Тесты для SQLite бэкенда (storage.py)"""
+
+    def test_sqlite_indexes_created(self, tmp_path):
+        """Test that SQLite schema has the lookup indexes"""
+        from database import IssueDB
+        db = IssueDB(str(tmp_path / "test.sqlite3"), backend="sqlite")
+
+        indexes = {row[0] for row in db.db.query("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        assert "idx_issues_repo_issue_number" in indexes
+        assert "idx_pr_reviews_repo_pr_number" in indexes
+        assert "idx_issues_status" in indexes
+        assert "idx_pr_reviews_status" in indexes
+        # Закоммиченная пачка group commit переживает отключение питания
+        assert db.db.conn.execute("PRAGMA synchronous").fetchone()[0] == 2
+
+    def test_default_file_follows_backend(self, tmp_path):
+        """Test DB_DIR holds the database and the file name matches the backend"""
+        import database
+        with patch.object(database, "DB_DIR", str(tmp_path)), patch.dict(os.environ, {}, clear=False):
+            os.environ.pop("DB_PATH", None)
+            database.IssueDB(backend="sqlite")
+            database.IssueDB(backend="tinydb")
+
+        assert (tmp_path / "db.sqlite3").exists()
+        assert (tmp_path / "db.json").exists()
+
+    def test_sqlite_issue_flow(self, tmp_path):
+        """Test issue lifecycle on SQLite backend"""
+        from database import IssueDB, IssueStatus
+        db = IssueDB(str(tmp_path / "test.sqlite3"), backend="sqlite")
+
+        doc_id = db.add_issue("test/repo", 1, "Test", "Body")
+        # Повторный webhook не создаёт дубликат
+        assert db.add_issue("test/repo", 1, "Test", "Body") == doc_id
+
+        db.set_processing(doc_id)
+        assert db.get_issue_by_number("test/repo", 1)["status"] == IssueStatus.PROCESSING
+
+        db.set_completed(doc_id, pr_number=7)
+        issue = db.get_issue_by_id(doc_id)
+        assert issue["status"] == IssueStatus.COMPLETED
+        assert issue["pr_number"] == 7
+        assert issue["doc_id"] == doc_id
+
+    def test_sqlite_stats_and_pending_reviews(self, tmp_path):
+        """Test stats and PR review queue on SQLite backend"""
+        from database import IssueDB
+        db = IssueDB(str(tmp_path / "test.sqlite3"), backend="sqlite")
+
+        db.add_issue("test/repo", 1, "Issue 1", "")
+        db.add_issue("test/repo", 2, "Issue 2", "")
+        review_id = db.add_pr_review("test/repo", 5, ["a.py"])
+
+        pending = db.get_pending_pr_reviews()
+        assert [r["doc_id"] for r in pending] == [review_id]
+
+        stats = db.get_stats()
+        assert stats["pending"] == 2
+        assert stats["total"] == 2
+        assert stats["pr_pending"] == 1
+
+    def test_unknown_backend(self, tmp_path):
+        """Test that unknown DB_BACKEND is rejected"""
+        from database import IssueDB
+        with pytest.raises(ValueError):
+            IssueDB(str(tmp_path / "db"), backend="mongo")
+
+
+@pytest.fixture(params=["tinydb", "sqlite"])
+def any_db(request, tmp_path):
+    """IssueDB на каждом из бэкендов"""
+    from database import IssueDB
+    return IssueDB(str(tmp_path / f"test_{request.param}.db"), backend=request.param)
+
+
+class TestJobClaim:
+    """Тесты для атомарного claim/lease"""
+
+    def test_claim_is_exclusive(self, any_db):
+        """Test that a claimed issue is not handed out twice"""
+        from database import IssueStatus
+        first_id = any_db.add_issue("test/repo", 1, "Issue 1", "")
+        second_id = any_db.add_issue("test/repo", 2, "Issue 2", "")
+
+        first = any_db.claim_next_issue("worker-a")
+        second = any_db.claim_next_issue("worker-b")
+
+        assert first["doc_id"] == first_id
+        assert second["doc_id"] == second_id
+        assert any_db.claim_next_issue("worker-c") is None
+
+        issue = any_db.get_issue_by_id(first_id)
+        assert issue["status"] == IssueStatus.PROCESSING
+        assert issue["lease_owner"] == "worker-a"
+        assert issue["lease_expires_at"] > issue["updated_at"]
+        assert issue["attempts"] == 1
+
+    def test_claim_dead_letters_exhausted_jobs(self, any_db):
+        """Test that jobs over max_attempts go to DEAD instead of being claimed"""
+        from database import PRReviewStatus
+        doc_id = any_db.add_pr_review("test/repo", 1, [])
+        any_db.update_pr_status(doc_id, PRReviewStatus.PENDING, attempts=3)
+
+        assert any_db.claim_next_pr_review("worker-a", max_attempts=3) is None
+        assert any_db.get_pr_review_by_id(doc_id)["status"] == PRReviewStatus.DEAD
+
+    def test_completion_clears_lease(self, any_db):
+        """Test that finishing a job drops its lease"""
+        doc_id = any_db.add_pr_review("test/repo", 1, ["a.py"])
+        any_db.claim_next_pr_review("worker-a")
+        any_db.set_pr_review_completed(doc_id, [], all_passed=True)
+
+        review = any_db.get_pr_review_by_id(doc_id)
+        assert review["lease_owner"] is None
+        assert review["attempts"] == 1
+
+
+class TestRepoExclusion:
+    """Тесты для взаимоисключения по repo и coalescing"""
+
+    def test_busy_repo_is_skipped(self, any_db):
+        """Test a repo being processed does not get a second worker"""
+        first = any_db.add_issue("a/repo", 1, "A1", "")
+        any_db.add_issue("a/repo", 2, "A2", "")
+        other = any_db.add_issue("b/repo", 1, "B1", "")
+
+        assert [i["doc_id"] for i in any_db.claim_issue_batch("w1", exclusive_repos=True)] == [first]
+        assert [i["doc_id"] for i in any_db.claim_issue_batch("w2", exclusive_repos=True)] == [other]
+        assert any_db.claim_issue_batch("w3", exclusive_repos=True) == []
+
+    def test_batch_takes_same_repo_jobs(self, any_db):
+        """Test coalescing claims several issues of one repo together"""
+        first = any_db.add_issue("a/repo", 1, "A1", "")
+        any_db.add_issue("b/repo", 1, "B1", "")
+        urgent = any_db.add_issue("a/repo", 2, "A2", "", priority=20)
+        third = any_db.add_issue("a/repo", 3, "A3", "")
+
+        batch = any_db.claim_issue_batch("w1", limit=3, exclusive_repos=True)
+
+        assert [i["doc_id"] for i in batch] == [urgent, first, third]
+        assert all(i["lease_owner"] == "w1" for i in batch)
+
+    def test_release_does_not_count_attempt(self, any_db):
+        """Test releasing an unstarted issue returns it untouched"""
+        from database import IssueStatus
+        doc_id = any_db.add_issue("a/repo", 1, "A1", "")
+        any_db.claim_next_issue("w1")
+
+        assert any_db.release_issue(doc_id, "w2") is False
+        assert any_db.release_issue(doc_id, "w1") is True
+        issue = any_db.get_issue_by_id(doc_id)
+        assert issue["status"] == IssueStatus.PENDING
+        assert issue["attempts"] == 0
+
+
+class TestSupersedeReviews:
+    """Тесты для замены устаревших PR reviews новым push"""
+
+    def test_pending_review_takes_new_head(self, any_db):
+        """Test a push before the review starts updates the queued job"""
+        first = any_db.add_pr_review("a/repo", 1, ["a.py"], head_sha="sha1")
+        assert any_db.add_pr_review("a/repo", 1, ["a.py"], head_sha="sha1") == first
+
+        assert any_db.add_pr_review("a/repo", 1, ["a.py", "b.py"], head_sha="sha2") == first
+        review = any_db.get_pr_review_by_id(first)
+        assert review["head_sha"] == "sha2"
+        assert review["changed_files"] == ["a.py", "b.py"]
+
+    def test_push_supersedes_review_in_progress(self, any_db):
+        """Test a push during review cancels it and queues the new head"""
+        from database import PRReviewStatus
+        old = any_db.add_pr_review("a/repo", 1, [], head_sha="sha1")
+        any_db.claim_next_pr_review("w1")
+
+        new = any_db.add_pr_review("a/repo", 1, [], head_sha="sha2")
+
+        assert new != old
+        assert any_db.is_pr_review_superseded(old)
+        assert any_db.get_pr_review_by_id(old)["superseded_by"] == new
+        # Результат отменённого review не перезаписывает статус
+        assert any_db.set_pr_review_completed(old, [], all_passed=True) is False
+        assert any_db.set_pr_review_failed(old, "boom") == PRReviewStatus.SUPERSEDED
+        claimed = any_db.claim_next_pr_review("w2")
+        assert claimed["doc_id"] == new
+        assert claimed["head_sha"] == "sha2"
+
+        stats = any_db.get_stats()
+        assert stats["pr_superseded"] == 1
+        assert stats["pr_reviewing"] == 1
+        assert any_db.check_counters() == {}
+
+    def test_manual_review_does_not_supersede(self, any_db):
+        """Test a job without head SHA joins the active review"""
+        old = any_db.add_pr_review("a/repo", 1, [], head_sha="sha1")
+        any_db.claim_next_pr_review("w1")
+
+        assert any_db.add_pr_review("a/repo", 1, []) == old
+        assert not any_db.is_pr_review_superseded(old)
+
+    def test_manual_requeue_targets_latest_review(self, any_db):
+        """Test lookup by number returns the newest review and requeue skips active ones"""
+        from database import PRReviewStatus
+        old = any_db.add_pr_review("a/repo", 1, [], head_sha="sha1")
+        any_db.claim_next_pr_review("w1")
+        new = any_db.add_pr_review("a/repo", 1, [], head_sha="sha2")
+        any_db.claim_next_pr_review("w2")
+
+        assert any_db.get_pr_review_by_number("a/repo", 1)["doc_id"] == new
+        # Идущий review не сбрасывается, lease остаётся за воркером
+        assert any_db.requeue_pr_review(new, priority=100) is False
+        assert any_db.get_pr_review_by_id(new)["lease_owner"] == "w2"
+
+        any_db.set_pr_review_completed(new, [], all_passed=True, owner="w2")
+        assert any_db.requeue_pr_review(new, priority=100) is True
+        review = any_db.get_pr_review_by_id(new)
+        assert review["status"] == PRReviewStatus.PENDING
+        assert review["lease_owner"] is None
+        assert review["priority"] == 100
+        assert any_db.get_pr_review_by_id(old)["status"] == PRReviewStatus.SUPERSEDED
+        assert any_db.check_counters() == {}
+
+
+class TestLeaseReaper:
+    """Тесты для heartbeat и reaper"""
+
+    def test_heartbeat_extends_lease(self, any_db):
+        """Test heartbeat renews only the owner's lease"""
+        doc_id = any_db.add_issue("test/repo", 1, "Issue", "")
+        any_db.claim_next_issue("worker-a", lease_seconds=10)
+        before = any_db.get_issue_by_id(doc_id)["lease_expires_at"]
+
+        assert any_db.heartbeat_issue(doc_id, "worker-a", lease_seconds=600) is True
+        assert any_db.get_issue_by_id(doc_id)["lease_expires_at"] > before
+        assert any_db.heartbeat_issue(doc_id, "worker-b") is False
+
+    def test_expired_lease_is_requeued(self, any_db):
+        """Test reaper returns jobs of dead workers to the queue"""
+        from database import IssueStatus
+        alive_id = any_db.add_issue("test/repo", 1, "Alive", "")
+        dead_id = any_db.add_issue("test/repo", 2, "Dead", "")
+        any_db.claim_next_issue("worker-a", lease_seconds=600)
+        any_db.claim_next_issue("worker-b", lease_seconds=-1)
+
+        assert any_db.requeue_expired_issues(max_attempts=3) == [dead_id]
+
+        dead = any_db.get_issue_by_id(dead_id)
+        assert dead["status"] == IssueStatus.PENDING
+        assert dead["lease_owner"] is None
+        assert dead["next_attempt_at"] is not None
+        assert any_db.get_issue_by_id(alive_id)["status"] == IssueStatus.PROCESSING
+
+    def test_expired_lease_respects_attempt_limit(self, any_db):
+        """Test reaper fails jobs that used up their attempts"""
+        from database import PRReviewStatus
+        doc_id = any_db.add_pr_review("test/repo", 1, [])
+        any_db.claim_next_pr_review("worker-a", lease_seconds=-1)
+
+        assert any_db.requeue_expired_pr_reviews(max_attempts=1) == [doc_id]
+        assert any_db.get_pr_review_by_id(doc_id)["status"] == PRReviewStatus.DEAD
+
+    def test_heartbeat_thread_reports_lost_lease(self):
+        """Test Heartbeat stops and flags a lost lease"""
+        import time
+        from leases import Heartbeat
+
+        with Heartbeat(lambda: False, interval=0.01) as heartbeat:
+            time.sleep(0.1)
+        assert heartbeat.lost is True
+
+    def test_superseded_check_is_throttled(self):
+        """Test ThrottledCheck hits the DB at most once per interval and keeps True"""
+        from leases import ThrottledCheck
+        answers = [False, True, False]
+        calls = []
+
+        def check():
+            calls.append(1)
+            return answers[len(calls) - 1]
+
+        superseded = ThrottledCheck(check, interval=3600)
+        assert [superseded() for _ in range(10)] == [False] * 10
+        assert len(calls) == 1
+
+        superseded.interval = 0
+        assert superseded() is True
+        # Отменённый review не оживает, БД больше не спрашиваем
+        assert superseded() is True
+        assert len(calls) == 2
+
+    def test_stale_owner_cannot_finish_job(self, any_db):
+        """Test a worker whose lease was requeued cannot overwrite the new owner's job"""
+        from database import IssueStatus, PRReviewStatus
+        doc_id = any_db.add_issue("test/repo", 1, "Issue", "")
+        # Lease worker-a истёк, reaper вернул issue в очередь, его взял worker-b
+        any_db.claim_next_issue("worker-b")
+
+        assert any_db.set_completed(doc_id, 42, owner="worker-a") is False
+        assert any_db.set_failed(doc_id, "boom", owner="worker-a") is False
+        issue = any_db.get_issue_by_id(doc_id)
+        assert issue["status"] == IssueStatus.PROCESSING
+        assert issue["lease_owner"] == "worker-b"
+        assert any_db.set_completed(doc_id, 42, owner="worker-b") is True
+
+        review_id = any_db.add_pr_review("test/repo", 1, [])
+        any_db.claim_next_pr_review("worker-a")
+        assert any_db.set_pr_review_completed(review_id, [], True, owner="worker-b") is False
+        assert any_db.set_pr_review_failed(review_id, "boom", owner="worker-b") is False
+        assert any_db.get_pr_review_by_id(review_id)["status"] == PRReviewStatus.REVIEWING
+
+
+class TestRetryBackoff:
+    """Тесты для повторов с backoff и DEAD статуса"""
+
+    def test_failed_attempt_is_scheduled_with_backoff(self, any_db):
+        """Test a failed attempt returns to PENDING but is not due yet"""
+        from database import IssueStatus
+        doc_id = any_db.add_issue("test/repo", 1, "Issue", "")
+        any_db.claim_next_issue("worker-a")
+
+        assert any_db.set_failed(doc_id, "429 Too Many Requests", max_attempts=3) == IssueStatus.PENDING
+        issue = any_db.get_issue_by_id(doc_id)
+        assert issue["next_attempt_at"] > issue["updated_at"]
+        assert issue["lease_owner"] is None
+        assert any_db.claim_next_issue("worker-b") is None
+
+    def test_manual_reset_skips_backoff(self, any_db):
+        """Test @coding-agent requeue runs immediately with fresh attempts"""
+        doc_id = any_db.add_issue("test/repo", 1, "Issue", "")
+        any_db.claim_next_issue("worker-a")
+        # Пока issue в работе, ручной повтор его не трогает
+        assert any_db.reset_to_pending(doc_id) is False
+
+        any_db.set_failed(doc_id, "GitHub is down")
+        assert any_db.reset_to_pending(doc_id) is True
+
+        claimed = any_db.claim_next_issue("worker-b")
+        assert claimed["doc_id"] == doc_id
+        assert claimed["attempts"] == 1
+
+    def test_exhausted_and_permanent_failures(self, any_db):
+        """Test DEAD after the last attempt and FAILED without retry"""
+        from database import IssueStatus, PRReviewStatus
+        issue_id = any_db.add_issue("test/repo", 1, "Issue", "")
+        any_db.claim_next_issue("worker-a")
+        assert any_db.set_failed(issue_id, "boom", max_attempts=1) == IssueStatus.DEAD
+        assert "gave up after 1 attempt" in any_db.get_issue_by_id(issue_id)["error"]
+
+        review_id = any_db.add_pr_review("test/repo", 1, [])
+        assert any_db.set_pr_review_failed(review_id, "bad", retry=False) == PRReviewStatus.FAILED
+
+        stats = any_db.get_stats()
+        assert stats["dead"] == 1
+        assert stats["pr_failed"] == 1
+
+    def test_retry_delay_grows_exponentially(self):
+        """Test jittered delay doubles per attempt and is capped"""
+        import database
+        with patch.object(database, "RETRY_BASE_SECONDS", 10), \
+                patch.object(database, "RETRY_MAX_SECONDS", 100):
+            assert 5 <= database.retry_delay(1) <= 10
+            assert 20 <= database.retry_delay(3) <= 40
+            assert 50 <= database.retry_delay(10) <= 100
+
+
+class TestStatusCounters:
+    """Тесты для счётчиков статусов (get_stats)"""
+
+    def test_counters_follow_transitions(self, any_db):
+        """Test stats match a full recount after status changes"""
+        first = any_db.add_issue("test/repo", 1, "Issue 1", "")
+        any_db.add_issue("test/repo", 2, "Issue 2", "")
+        any_db.claim_next_issue("worker-a")
+        any_db.set_completed(first, pr_number=3)
+        review = any_db.add_pr_review("test/repo", 3, [])
+        any_db.claim_next_pr_review("worker-a")
+        any_db.set_pr_review_completed(review, [], all_passed=False)
+
+        stats = any_db.get_stats()
+        assert stats["pending"] == 1
+        assert stats["processing"] == 0
+        assert stats["completed"] == 1
+        assert stats["total"] == 2
+        assert stats["pr_rejected"] == 1
+        assert any_db.check_counters() == {}
+
+    def test_check_counters_repairs_drift(self, any_db):
+        """Test consistency check rebuilds corrupted counters"""
+        any_db.add_issue("test/repo", 1, "Issue 1", "")
+        any_db.db.add_counters({"issues:pending": 5})
+        assert any_db.get_stats()["pending"] == 6
+
+        drift = any_db.check_counters()
+        assert drift == {"issues:pending": (6, 1)}
+        assert any_db.get_stats()["pending"] == 1
+
+    def test_legacy_tinydb_file_gets_counters(self, tmp_path):
+        """Test counters are built for db.json files written before counters existed"""
+        from database import IssueDB
+        db_path = tmp_path / "legacy.json"
+        db_path.write_text(json.dumps({
+            "issues": {
+                "1": {"repo": "test/repo", "issue_number": 1, "status": "pending"},
+                "2": {"repo": "test/repo", "issue_number": 2, "status": "failed"}
+            }
+        }))
+
+        stats = IssueDB(str(db_path)).get_stats()
+        assert stats["pending"] == 1
+        assert stats["failed"] == 1
+        assert stats["total"] == 2
+
+
+class TestNotify:
+    """Тесты для notify.py (пробуждение воркеров)"""
+
+    def test_notification_wakes_listener(self, tmp_path):
+        """Test server notification reaches a waiting worker"""
+        import notify
+        with patch.object(notify, "NOTIFY_DIR", tmp_path):
+            listener = notify.WakeupListener("issues")
+            try:
+                assert listener.wait(0) is False
+                assert notify.notify_workers("issues") == 1
+                assert notify.notify_workers("pr_reviews") == 0
+                assert listener.wait(1) is True
+                # Накопленные уведомления вычитаны
+                assert listener.wait(0) is False
+            finally:
+                listener.close()
+
+    def test_stale_socket_is_removed(self, tmp_path):
+        """Test sockets of dead workers are cleaned up"""
+        import notify
+        with patch.object(notify, "NOTIFY_DIR", tmp_path):
+            listener = notify.WakeupListener("issues")
+            listener.sock.close()  # воркер умер, файл сокета остался
+
+            assert notify.notify_workers("issues") == 0
+            assert not listener.path.exists()
+
+
+class TestRuntime:
+    """Тесты для all-in-one runtime (runtime.py)"""
+
+    def test_notify_wakes_in_process_worker(self, tmp_path):
+        """Test the server wakes an in-process worker without sockets"""
+        import asyncio
+        import threading
+        import notify
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+            from runtime import AgentRuntime
+
+        class FakeWorker:
+            def __init__(self):
+                self.running = True
+                self.calls = 0
+                self.threads = set()
+
+            def run_iteration(self):
+                self.calls += 1
+                self.threads.add(threading.current_thread().name)
+                return False
+
+        worker = FakeWorker()
+        runtime = AgentRuntime(issue_workers=0, review_workers=0, interval=30)
+
+        async def scenario():
+            task = asyncio.create_task(runtime._run_worker("issues", worker))
+            await asyncio.sleep(0.1)
+            assert worker.calls == 1
+            assert notify.notify_workers("issues") == 1
+            await asyncio.sleep(0.1)
+            assert worker.calls == 2
+            worker.running = False
+            notify.notify_workers("issues")
+            await asyncio.wait_for(task, timeout=1)
+
+        with patch.object(notify, "NOTIFY_DIR", tmp_path):
+            asyncio.run(scenario())
+
+        # Блокирующая работа - не в потоке event loop
+        assert all(name.startswith("job") for name in worker.threads)
+        assert notify._local_subscribers["issues"] == []
+
+    def test_worker_error_does_not_kill_task(self, tmp_path):
+        """Test a failing iteration is logged and the worker keeps polling"""
+        import asyncio
+        import notify
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+            from runtime import AgentRuntime
+            from pr_review_worker import PRReviewWorker
+
+        # Сбой БД внутри прохода PR review воркера ловится им самим
+        review_worker = PRReviewWorker(worker_id="test")
+        review_worker.running = True
+        with patch("pr_review_worker.db") as db:
+            db.claim_next_pr_review.side_effect = RuntimeError("database is locked")
+            assert review_worker.run_iteration() is False
+            assert db.claim_next_pr_review.called
+
+        class FlakyWorker:
+            def __init__(self):
+                self.running = True
+                self.calls = 0
+
+            def run_iteration(self):
+                self.calls += 1
+                raise RuntimeError("transient")
+
+        worker = FlakyWorker()
+        runtime = AgentRuntime(issue_workers=0, review_workers=0, interval=0.05)
+
+        async def scenario():
+            task = asyncio.create_task(runtime._run_worker("reviews", worker))
+            await asyncio.sleep(0.2)
+            assert not task.done()
+            worker.running = False
+            await asyncio.wait_for(task, timeout=1)
+
+        with patch.object(notify, "NOTIFY_DIR", tmp_path):
+            asyncio.run(scenario())
+        assert worker.calls >= 2
+
+
+class TestScheduler:
+    """Тесты для приоритетов и честной очереди (scheduler.py)"""
+
+    def test_priority_from_labels(self):
+        """Test GitHub labels map to queue priority"""
+        from scheduler import priority_from_labels, DEFAULT_PRIORITY
+        assert priority_from_labels([{"name": "Priority: High"}]) == 20
+        assert priority_from_labels([{"name": "p3"}, {"name": "p0"}]) == 40
+        assert priority_from_labels([{"name": "bug"}]) == DEFAULT_PRIORITY
+        assert priority_from_labels(None) == DEFAULT_PRIORITY
+
+    def test_higher_priority_is_claimed_first(self, any_db):
+        """Test a high-priority job jumps ahead of older ones"""
+        any_db.add_issue("test/repo", 1, "Old", "")
+        urgent_id = any_db.add_issue("test/repo", 2, "Urgent", "", priority=20)
+
+        assert any_db.claim_next_issue("worker-a")["doc_id"] == urgent_id
+
+    def test_requeue_raises_priority(self, any_db):
+        """Test re-adding an active job with higher priority bumps it"""
+        any_db.add_pr_review("test/repo", 1, [])
+        doc_id = any_db.add_pr_review("test/repo", 2, [])
+        assert any_db.add_pr_review("test/repo", 2, [], priority=50) == doc_id
+
+        assert any_db.claim_next_pr_review("worker-a")["doc_id"] == doc_id
+
+    def test_round_robin_across_installations(self, any_db):
+        """Test a busy installation does not starve others"""
+        busy = [any_db.add_issue("busy/repo", n, "Busy", "", installation_id=1) for n in range(1, 4)]
+        quiet = any_db.add_issue("quiet/repo", 1, "Quiet", "", installation_id=2)
+
+        claimed = [any_db.claim_next_issue("worker-a")["doc_id"] for _ in range(3)]
+        assert claimed == [busy[0], quiet, busy[1]]
+
+    def test_pending_shows_queue_position(self, any_db):
+        """Test pending list follows claim order and reports positions"""
+        first = any_db.add_issue("a/repo", 1, "A1", "", installation_id=1)
+        second = any_db.add_issue("a/repo", 2, "A2", "", installation_id=1)
+        other = any_db.add_issue("b/repo", 1, "B1", "", installation_id=2)
+
+        pending = any_db.get_pending_issues()
+        assert [(i["doc_id"], i["queue_position"]) for i in pending] == [
+            (first, 1), (other, 2), (second, 3)
+        ]
+        assert any_db.claim_next_issue("worker-a")["doc_id"] == first
+        assert any_db.claim_next_issue("worker-a")["doc_id"] == other
+
+    def test_schedule_order_matches_claim_order(self):
+        """Test the sorted queue order equals repeated pick_next on random queues"""
+        import random
+        from scheduler import mark_served, pick_next, schedule_order
+
+        rng = random.Random(7)
+        for _ in range(50):
+            jobs = [
+                {
+                    "doc_id": doc_id,
+                    "repo": f"repo-{rng.randint(1, 6)}",
+                    "installation_id": rng.choice([None, 1, 2, 3]),
+                    "priority": rng.choice([0, 0, 20]),
+                }
+                for doc_id in range(1, rng.randint(2, 40))
+            ]
+            served = {"_seq": 10, "installation:2": 9, "repo:repo-3": 4, "installation:1/repo:repo-5": 9}
+
+            expected, state, ready = [], dict(served), list(jobs)
+            while ready:
+                job = pick_next(ready, state)
+                mark_served(job, state)
+                ready.remove(job)
+                expected.append(job["doc_id"])
+
+            assert [job["doc_id"] for job in schedule_order(jobs, served)] == expected
+
+    def test_served_state_forgets_idle_groups(self, any_db):
+        """Test fairness state keeps only groups that still have pending jobs"""
+        any_db.add_issue("a/repo", 1, "A1", "", installation_id=1)
+        any_db.add_issue("b/repo", 1, "B1", "", installation_id=2)
+        any_db.add_issue("b/repo", 2, "B2", "", installation_id=2)
+
+        any_db.claim_next_issue("worker-a")
+        any_db.claim_next_issue("worker-a")
+        any_db.claim_next_issue("worker-a")
+
+        served = any_db.db.get_meta("scheduler:issues", {})
+        assert "installation:1" not in served and "installation:1/repo:a/repo" not in served
+        assert served["installation:2"] == served["_seq"] == 3
+
+
+class TestArchive:
+    """Тесты для архивации завершённых задач"""
+
+    def _finish_issue(self, db, number, days_ago):
+        from datetime import datetime, timedelta
+        doc_id = db.add_issue("test/repo", number, f"Issue {number}", "body")
+        db.set_completed(doc_id, pr_number=100 + number)
+        db.issues.update({
+            "updated_at": (datetime.now() - timedelta(days=days_ago)).isoformat()
+        }, doc_id)
+        return doc_id
+
+    def test_old_finished_jobs_leave_hot_table(self, any_db):
+        """Test only old terminal jobs are archived and counters follow"""
+        old_id = self._finish_issue(any_db, 1, days_ago=30)
+        recent_id = self._finish_issue(any_db, 2, days_ago=0)
+        pending_id = any_db.add_issue("test/repo", 3, "Pending", "")
+
+        assert any_db.archive_finished(older_than_days=7) == {"issues": 1, "pr_reviews": 0}
+
+        assert any_db.get_issue_by_id(old_id) is None
+        assert any_db.get_issue_by_id(recent_id) is not None
+        assert any_db.get_issue_by_id(pending_id) is not None
+        stats = any_db.get_stats()
+        assert stats["completed"] == 1
+        assert stats["total"] == 2
+        assert stats["archived"] == 1
+        assert any_db.check_counters() == {}
+
+    def test_archived_job_is_found_by_number(self, any_db):
+        """Test lookups by number fall back to the archive"""
+        old_id = self._finish_issue(any_db, 1, days_ago=30)
+        any_db.archive_finished(older_than_days=7)
+
+        issue = any_db.get_issue_by_number("test/repo", 1)
+        assert issue["doc_id"] == old_id
+        assert issue["archived"] is True
+        assert issue["pr_number"] == 101
+        assert any_db.get_issue_by_number("test/repo", 99) is None
+
+    def test_doc_ids_are_not_reused(self, any_db):
+        """Test new jobs never get the ID of an archived one"""
+        old_id = self._finish_issue(any_db, 1, days_ago=30)
+        any_db.archive_finished(older_than_days=7)
+
+        assert any_db.add_issue("test/repo", 2, "New", "") > old_id
+
+    def test_segments_rotate(self, tmp_path):
+        """Test archive starts a new segment once the current one is full"""
+        import archive
+        store = archive.Archive(tmp_path)
+        with patch.object(archive, "ARCHIVE_SEGMENT_BYTES", 1):
+            store.append("issues", [{"repo": "a/b", "issue_number": 1}])
+            store.append("issues", [{"repo": "a/b", "issue_number": 1, "status": "failed"}])
+
+        assert [p.name for p in store.segments("issues")] == [
+            "issues-000001.jsonl.gz", "issues-000002.jsonl.gz"
+        ]
+        assert store.find("issues", repo="a/b", issue_number=1)["status"] == "failed"
+
+    def test_index_limits_segments_read(self, tmp_path):
+        """Test lookups by key only open segments holding the key, misses open none"""
+        import gzip
+        import archive
+        store = archive.Archive(tmp_path, index_fields={"issues": ("repo", "issue_number")})
+        with patch.object(archive, "ARCHIVE_SEGMENT_BYTES", 1):
+            for number in range(1, 5):
+                store.append("issues", [{"repo": "a/b", "issue_number": number, "status": "completed"}])
+            store.append("issues", [{"repo": "a/b", "issue_number": 2, "status": "failed"}])
+
+        with patch.object(archive.gzip, "open", wraps=gzip.open) as opened:
+            assert store.find("issues", repo="a/b", issue_number=99) is None
+            assert opened.call_count == 0
+            assert store.find("issues", repo="a/b", issue_number=2)["status"] == "failed"
+            assert opened.call_count == 1
+            # Старая запись ключа - во втором по давности сегменте
+            assert store.find("issues", repo="a/b", issue_number=2, status="completed")["status"] == "completed"
+
+        # Архив без индекса (записан до его появления) индексируется при первом поиске
+        (tmp_path / "issues.index.jsonl").unlink()
+        fresh = archive.Archive(tmp_path, index_fields={"issues": ("repo", "issue_number")})
+        assert fresh.find("issues", repo="a/b", issue_number=3)["status"] == "completed"
+        assert fresh.find("issues", repo="a/b", issue_number=99) is None
+        assert (tmp_path / "issues.index.jsonl").exists()
+
+
+class TestGroupCommit:
+    """Тесты для пакетной записи постановок в очередь"""
+
+    def test_concurrent_adds_share_one_flush(self, tmp_path):
+        """Test a burst of webhooks is written in a few transactions"""
+        from concurrent.futures import ThreadPoolExecutor
+        from database import IssueDB
+        db = IssueDB(str(tmp_path / "db.json"), backend="tinydb", group_commit_ms=50)
+
+        with ThreadPoolExecutor(max_workers=20) as pool:
+            doc_ids = list(pool.map(
+                lambda n: db.add_issue("test/repo", n, f"Issue {n}", ""), range(1, 21)
+            ))
+
+        assert sorted(doc_ids) == list(range(1, 21))
+        assert db.get_stats()["pending"] == 20
+        stats = db.get_write_stats()
+        assert stats["writes"] == 20
+        assert stats["flushes"] < 20
+        assert stats["max_batch"] > 1
+
+    def test_duplicates_in_one_batch_are_merged(self, any_db):
+        """Test the same issue twice in a batch yields one job"""
+        from database import IssueStatus
+        doc_ids = any_db._add_jobs([
+            (any_db.issues, {"repo": "a/b", "issue_number": 1, "priority": 0, "status": IssueStatus.PENDING}),
+            (any_db.issues, {"repo": "a/b", "issue_number": 1, "priority": 20, "status": IssueStatus.PENDING}),
+            (any_db.pr_reviews, {"repo": "a/b", "pr_number": 1, "priority": 0, "status": "pending"}),
+        ])
+
+        assert doc_ids[0] == doc_ids[1]
+        assert any_db.get_issue_by_id(doc_ids[0])["priority"] == 20
+        assert any_db.get_stats()["total"] == 1
+        assert any_db.get_stats()["pr_pending"] == 1
+
+    def test_flush_error_reaches_caller(self):
+        """Test a failed batch write is raised in every waiting caller"""
+        from group_commit import GroupCommit
+
+        def flush(requests):
+            raise RuntimeError("disk full")
+
+        with pytest.raises(RuntimeError, match="disk full"):
+            GroupCommit(flush, window_ms=1).submit("job")
+
+
+class TestMigrateDB:
+    """Тесты для migrate_db.py (db.json <-> SQLite)"""
+
+    def _make_tinydb(self, tmp_path):
+        from database import IssueDB
+        db = IssueDB(str(tmp_path / "db.json"), backend="tinydb", group_commit_ms=0)
+        for n in range(1, 8):
+            db.add_issue("test/repo", n, f"Issue {n} «юникод»", "body " * n)
+        db.set_completed(1, pr_number=10)
+        db.set_failed(2, "boom", retry=False)
+        db.claim_next_issue("worker-a")
+        db.add_pr_review("test/repo", 5, ["a.py"], installation_id=7)
+        return db
+
+    def test_stream_reader_handles_small_reads(self, tmp_path):
+        """Test streaming parser yields every record across buffer boundaries"""
+        from migrate_db import TinyDBStreamReader
+        db = self._make_tinydb(tmp_path)
+
+        with open(tmp_path / "db.json", encoding="utf-8") as f:
+            records = list(TinyDBStreamReader(f, read_bytes=7).records())
+
+        issues = {int(doc_id): doc for table, doc_id, doc in records if table == "issues"}
+        assert len(issues) == 7
+        assert issues[3]["title"] == db.get_issue_by_id(3)["title"]
+
+    def test_import_then_export_roundtrip(self, tmp_path):
+        """Test db.json -> SQLite -> db.json keeps records, IDs and counts"""
+        from database import IssueDB
+        from migrate_db import export_tinydb, import_tinydb
+        source = self._make_tinydb(tmp_path)
+
+        assert import_tinydb(str(tmp_path / "db.json"), str(tmp_path / "db.sqlite3"), chunk_size=3) == {}
+        migrated = IssueDB(str(tmp_path / "db.sqlite3"), backend="sqlite", group_commit_ms=0)
+        assert migrated.get_stats() == source.get_stats()
+        assert migrated.get_issue_by_id(4) == source.get_issue_by_id(4)
+        assert migrated.add_issue("test/repo", 99, "New", "") == 8
+
+        assert export_tinydb(str(tmp_path / "db.sqlite3"), str(tmp_path / "back.json"), chunk_size=2) == {}
+        restored = IssueDB(str(tmp_path / "back.json"), backend="tinydb", group_commit_ms=0)
+        assert restored.get_stats()["total"] == 8
+        assert restored.get_pr_review_by_id(1)["installation_id"] == 7
+
+    def test_refuses_to_overwrite(self, tmp_path):
+        """Test migration never clobbers an existing target"""
+        from migrate_db import import_tinydb
+        self._make_tinydb(tmp_path)
+        (tmp_path / "db.sqlite3").write_text("")
+
+        with pytest.raises(FileExistsError):
+            import_tinydb(str(tmp_path / "db.json"), str(tmp_path / "db.sqlite3"))
+
+
+class TestIssueSolver:
+    """Тесты для issue_solver.py"""
+
+    def test_lost_lease_stops_before_push(self, tmp_path):
+        """Test a solver that lost its lease does not push or open a PR"""
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+            import issue_solver
+        from leases import LeaseLost
+
+        solver = issue_solver.IssueSolver.__new__(issue_solver.IssueSolver)
+        solver.repo_full_name = "test/repo"
+        solver.repo = Mock()
+        solver.repo.clone_or_pull.return_value = tmp_path
+        solver.repo.get_files.return_value = [tmp_path / "a.py"]
+        solver.repo.get_issue.return_value = Mock(title="Bug", body="")
+
+        with patch.object(solver, "analyze_files", return_value=["fixed"]), \
+                patch.object(issue_solver, "Checkpoint"), \
+                pytest.raises(LeaseLost):
+            solver.solve_issue(1, lease_lost=lambda: True)
+
+        solver.repo.push.assert_not_called()
+        solver.repo.create_pull_request.assert_not_called()
+        solver.repo.add_comment_to_issue.assert_not_called()
+
+    def test_files_are_analyzed_concurrently_in_priority_order(self, tmp_path):
+        """Test analysis runs in parallel but fixes come back in file order"""
+        import time
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+            import issue_solver
+        from ai_client import AnalysisResult
+
+        files = [tmp_path / name for name in ("mentioned.py", "a.py", "b.py", "c.py")]
+        calls = []
+
+        def analyze(filepath, file_content, issue_description):
+            time.sleep(0.2)
+            calls.append((filepath.name, file_content))
+            if filepath.name in ("mentioned.py", "c.py") and file_content == "old":
+                return AnalysisResult(issue_found=True, code_correction="new", explanation="fix")
+            return AnalysisResult(issue_found=False, code_correction="", explanation="")
+
+        solver = issue_solver.IssueSolver.__new__(issue_solver.IssueSolver)
+        solver.repo = Mock()
+        solver.repo.read_file.return_value = "old"
+
+        with patch.object(issue_solver.ai_client, "analyze_file", side_effect=analyze), \
+                patch.object(issue_solver, "ANALYSIS_CONCURRENCY", 4):
+            started = time.monotonic()
+            fixes = solver.analyze_files(files, tmp_path, "issue")
+            elapsed = time.monotonic() - started
+
+        assert fixes == ["new", None, None, "new"]
+        # Второй проход по исправленному файлу - после первого
+        assert [c for c in calls if c[0] == "mentioned.py"] == [("mentioned.py", "old"), ("mentioned.py", "new")]
+        assert elapsed < 0.6
+
+    def test_retry_resumes_from_checkpoint(self, tmp_path):
+        """Test files analyzed before a failure are not sent to the LLM again"""
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+            import issue_solver
+        from ai_client import AnalysisResult
+        from checkpoint import Checkpoint
+
+        files = [tmp_path / name for name in ("a.py", "b.py", "c.py")]
+        analyzed = []
+
+        def analyze(filepath, file_content, issue_description):
+            analyzed.append(filepath.name)
+            if filepath.name == "c.py":
+                raise RuntimeError("LLM is down")
+            if filepath.name == "a.py" and file_content == "old":
+                return AnalysisResult(issue_found=True, code_correction="new", explanation="fix")
+            return AnalysisResult(issue_found=False, code_correction="", explanation="")
+
+        solver = issue_solver.IssueSolver.__new__(issue_solver.IssueSolver)
+        solver.repo = Mock()
+        solver.repo.read_file.return_value = "old"
+        checkpoints = str(tmp_path / "checkpoints")
+
+        with patch.object(issue_solver.ai_client, "analyze_file", side_effect=analyze), \
+                patch.object(issue_solver, "ANALYSIS_CONCURRENCY", 1):
+            checkpoint = Checkpoint.open("owner/repo", 7, "sha1", "issue", checkpoints)
+            with pytest.raises(RuntimeError):
+                solver.analyze_files(files, tmp_path, "issue", checkpoint)
+
+            # Повтор от того же коммита: a.py и b.py берутся из checkpoint
+            analyzed.clear()
+            checkpoint = Checkpoint.open("owner/repo", 7, "sha1", "issue", checkpoints)
+            assert checkpoint.resumed == 2
+            with pytest.raises(RuntimeError):
+                solver.analyze_files(files, tmp_path, "issue", checkpoint)
+            assert analyzed == ["c.py"]
+
+            # Default branch ушёл вперёд - исправления устарели
+            analyzed.clear()
+            checkpoint = Checkpoint.open("owner/repo", 7, "sha2", "issue", checkpoints)
+            assert checkpoint.resumed == 0
+            with pytest.raises(RuntimeError):
+                solver.analyze_files(files, tmp_path, "issue", checkpoint)
+            assert analyzed[0] == "a.py"
+
+        resumed = Checkpoint.open("owner/repo", 7, "sha2", "issue", checkpoints)
+        assert resumed.get("a.py") == (True, "new")
+        assert resumed.get("c.py") == (False, None)
+        resumed.delete()
+        assert not resumed.path.exists()
+
+    def test_failed_analysis_is_not_checkpointed(self, tmp_path):
+        """Test a file whose LLM call failed is re-sent on retry instead of counted as clean"""
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+            import issue_solver
+        from ai_client import AnalysisResult
+        from checkpoint import Checkpoint
+
+        files = [tmp_path / name for name in ("a.py", "b.py")]
+        llm_down = True
+
+        def analyze(filepath, file_content, issue_description):
+            # analyze_file сам ловит ошибку LLM и помечает результат error
+            if filepath.name == "b.py" and llm_down:
+                return AnalysisResult(issue_found=False, code_correction="", explanation="timeout", error=True)
+            if filepath.name == "b.py" and file_content == "old":
+                return AnalysisResult(issue_found=True, code_correction="new", explanation="fix")
+            return AnalysisResult(issue_found=False, code_correction="", explanation="")
+
+        solver = issue_solver.IssueSolver.__new__(issue_solver.IssueSolver)
+        solver.repo = Mock()
+        solver.repo.read_file.return_value = "old"
+        checkpoints = str(tmp_path / "checkpoints")
+
+        with patch.object(issue_solver.ai_client, "analyze_file", side_effect=analyze):
+            checkpoint = Checkpoint.open("owner/repo", 7, "sha1", "issue", checkpoints)
+            # Без исправлений и с упавшим файлом - не "No fixes found", а повтор
+            with pytest.raises(issue_solver.AnalysisError):
+                solver.analyze_files(files, tmp_path, "issue", checkpoint)
+            assert checkpoint.get("a.py") == (True, None)
+            assert checkpoint.get("b.py") == (False, None)
+
+            llm_down = False
+            checkpoint = Checkpoint.open("owner/repo", 7, "sha1", "issue", checkpoints)
+            assert solver.analyze_files(files, tmp_path, "issue", checkpoint) == [None, "new"]
+
+    def test_stale_checkpoints_are_pruned(self, tmp_path):
+        """Test prune_checkpoints removes only old checkpoint files"""
+        import time
+        from checkpoint import Checkpoint, prune_checkpoints
+
+        old = Checkpoint.open("owner/repo", 1, "sha", "issue", str(tmp_path))
+        old.record("a.py", None)
+        fresh = Checkpoint.open("owner/repo", 2, "sha", "issue", str(tmp_path))
+        fresh.record("a.py", None)
+        week_ago = time.time() - 8 * 86400
+        os.utime(old.path, (week_ago, week_ago))
+
+        assert prune_checkpoints(7, str(tmp_path)) == 1
+        assert not old.path.exists()
+        assert fresh.path.exists()
+
+    def test_patch_edits_are_applied(self):
+        """Test search/replace edits are applied with whitespace tolerance and rejected when ambiguous"""
+        from patches import PatchError, apply_edits, validate
+
+        content = "def f():  \n    return 1\n\nx = f()\ny = f()\n"
+        patched = apply_edits(content, [
+            {"search": "def f():\n    return 1\n", "replace": "def f():\n    return 2\n"},
+            {"search": "y = f()\n", "replace": ""},
+        ])
+        assert patched == "def f():\n    return 2\n\nx = f()\n"
+
+        with pytest.raises(PatchError, match="matches 3 places"):
+            apply_edits(content, [{"search": "f()", "replace": "g()"}])
+        with pytest.raises(PatchError, match="not found"):
+            apply_edits(content, [{"search": "z = 3", "replace": ""}])
+        with pytest.raises(PatchError, match="does not parse"):
+            validate(Path("a.py"), "def f(:\n")
+
+    def test_rejected_patch_falls_back_to_full_file(self, tmp_path):
+        """Test fix_file applies edits and asks for the full file when an edit does not apply"""
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+            import issue_solver
+        from ai_client import AnalysisResult
+
+        modes = []
+
+        def analyze(filepath, file_content, issue_description, mode=None):
+            modes.append((filepath.name, mode))
+            if file_content != "x = 1\n":
+                return AnalysisResult(issue_found=False, code_correction="")
+            if mode == "full":
+                return AnalysisResult(issue_found=True, code_correction="x = 3\n")
+            search = "x = 1" if filepath.name == "good.py" else "x = 100"
+            return AnalysisResult(issue_found=True, code_correction="", edits=[{"search": search, "replace": "x = 2"}])
+
+        solver = issue_solver.IssueSolver.__new__(issue_solver.IssueSolver)
+        solver.repo = Mock()
+        solver.repo.read_file.return_value = "x = 1\n"
+
+        with patch.object(issue_solver.ai_client, "analyze_file", side_effect=analyze):
+            assert solver.fix_file(tmp_path / "good.py", tmp_path, "issue") == "x = 2\n"
+            assert solver.fix_file(tmp_path / "bad.py", tmp_path, "issue") == "x = 3\n"
+
+        assert ("good.py", "full") not in modes
+        assert modes[-3:] == [("bad.py", None), ("bad.py", "full"), ("bad.py", None)]
+
+
+class TestRateLimiter:
+    """Тесты для общего rate limiter (rate_limiter.py)"""
+
+    def test_budget_is_shared_between_instances(self, tmp_path):
+        """Test two processes' limiters draw from one request bucket"""
+        from rate_limiter import RateLimiter
+        path = str(tmp_path / "rate.sqlite3")
+        first = RateLimiter(path, rpm=2, tpm=0)
+        second = RateLimiter(path, rpm=2, tpm=0)
+
+        assert first._transaction(lambda conn, now: first._try_acquire(conn, now, {"requests": 1, "tokens": 10})) == 0
+        assert second._transaction(lambda conn, now: second._try_acquire(conn, now, {"requests": 1, "tokens": 10})) == 0
+        # Бюджет исчерпан - ждать ~30 секунд до следующего запроса
+        wait = first._transaction(lambda conn, now: first._try_acquire(conn, now, {"requests": 1, "tokens": 10}))
+        assert 29 < wait <= 30
+
+    def test_token_usage_is_reconciled(self, tmp_path):
+        """Test actual usage above the estimate borrows from the next window"""
+        from rate_limiter import RateLimiter
+        limiter = RateLimiter(str(tmp_path / "rate.sqlite3"), rpm=0, tpm=1000)
+
+        assert limiter.acquire(400) < 1
+        limiter.record_usage(estimated=400, actual=900)
+
+        wait = limiter._transaction(lambda conn, now: limiter._try_acquire(conn, now, {"requests": 1, "tokens": 400}))
+        assert wait > 0
+
+    def test_retry_after_blocks_everyone(self, tmp_path):
+        """Test a 429 pause applies to other limiter instances"""
+        from rate_limiter import RateLimiter, retry_after_seconds
+        path = str(tmp_path / "rate.sqlite3")
+        RateLimiter(path, rpm=0, tpm=0).block(retry_after_seconds({"retry-after": "20"}))
+
+        other = RateLimiter(path, rpm=0, tpm=0)
+        wait = other._transaction(lambda conn, now: other._try_acquire(conn, now, {"requests": 1, "tokens": 1}))
+        assert 19 < wait <= 20
+        assert retry_after_seconds({"retry-after-ms": "1500"}) == 1.5
+        assert retry_after_seconds({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"}, default=3) == 3
+
+    def test_call_retries_after_429(self, tmp_path):
+        """Test AIClient._call pauses on 429 and retries"""
+        from openai import RateLimitError
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+            import ai_client
+        from rate_limiter import RateLimiter
+
+        rate_limited = RateLimitError.__new__(RateLimitError)
+        rate_limited.response = Mock(headers={"retry-after-ms": "10"})
+        ok = Mock(usage=None, choices=[Mock(message=Mock(content="hi"))])
+
+        client = ai_client.AIClient.__new__(ai_client.AIClient)
+        client.model = "test"
+        client.client = Mock()
+        client.client.chat.completions.create.side_effect = [rate_limited, ok]
+        client.rate_limiter = RateLimiter(str(tmp_path / "rate.sqlite3"), rpm=0, tpm=0)
+        client.cache = None
+
+        assert client._call([{"role": "user", "content": "hello"}]) == "hi"
+        assert client.client.chat.completions.create.call_count == 2
+
+    def test_server_errors_are_retried_through_the_limiter(self, tmp_path):
+        """Test SDK retries are off and every 5xx retry takes budget from the shared limiter"""
+        from openai import InternalServerError
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+            import ai_client
+        from rate_limiter import RateLimiter
+
+        assert ai_client.AIClient()._create_client().max_retries == 0
+
+        server_error = InternalServerError.__new__(InternalServerError)
+        ok = Mock(usage=None, choices=[Mock(message=Mock(content="hi"))])
+
+        client = ai_client.AIClient.__new__(ai_client.AIClient)
+        client.model = "test"
+        client.client = Mock()
+        client.client.chat.completions.create.side_effect = [server_error, ok]
+        client.rate_limiter = Mock(wraps=RateLimiter(str(tmp_path / "rate.sqlite3"), rpm=0, tpm=0))
+        client.cache = None
+
+        with patch.object(client, "_transient_delay", return_value=0):
+            assert client._call([{"role": "user", "content": "hello"}]) == "hi"
+        assert client.rate_limiter.acquire.call_count == 2
+
+
+class TestLLMCache:
+    """Тесты для кэша ответов LLM (llm_cache.py)"""
+
+    def test_hit_miss_and_ttl(self, tmp_path):
+        """Test cached responses are shared between instances and expire"""
+        from llm_cache import LLMCache, cache_key
+        path = str(tmp_path / "cache.sqlite3")
+        key = cache_key("model", 0.2, [{"role": "user", "content": "hello"}])
+        assert key != cache_key("model", 0.3, [{"role": "user", "content": "hello"}])
+
+        first = LLMCache(path, max_bytes=1024, ttl=60)
+        assert first.get(key) is None
+        first.put(key, "answer")
+        assert LLMCache(path, max_bytes=1024, ttl=60).get(key) == "answer"
+        assert LLMCache(path, max_bytes=1024, ttl=0).get(key) is None
+
+        stats = first.get_stats()
+        assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 2, 0)
+        assert stats["hit_rate"] == 0.333
+
+    def test_lru_eviction(self, tmp_path):
+        """Test the least recently read responses are evicted over the size limit"""
+        from llm_cache import LLMCache
+        cache = LLMCache(str(tmp_path / "cache.sqlite3"), max_bytes=25, ttl=60)
+        cache.put("a", "a" * 10)
+        cache.put("b", "b" * 10)
+        assert cache.get("a") == "a" * 10
+        cache.put("c", "c" * 10)
+
+        assert cache.get("b") is None
+        assert cache.get("a") == "a" * 10
+        assert cache.get("c") == "c" * 10
+        assert cache.get_stats()["evictions"] == 1
+
+    def test_call_uses_cache(self, tmp_path):
+        """Test a repeated prompt is answered from the cache without an LLM request"""
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+            import ai_client
+        from llm_cache import LLMCache
+        from llm_metrics import ParseMetrics
+        from rate_limiter import RateLimiter
+
+        client = ai_client.AIClient.__new__(ai_client.AIClient)
+        client.model = "test"
+        client.client = Mock()
+        client.client.chat.completions.create.return_value = Mock(
+            usage=None, choices=[Mock(message=Mock(content="not json"))]
+        )
+        client.rate_limiter = RateLimiter(str(tmp_path / "rate.sqlite3"), rpm=0, tpm=0)
+        client.cache = LLMCache(str(tmp_path / "cache.sqlite3"), max_bytes=1024, ttl=60)
+        client.parse_metrics = ParseMetrics(str(tmp_path / "rate.sqlite3"))
+        messages = [{"role": "user", "content": "hello"}]
+
+        assert client._call(messages) == "not json"
+        assert client._call(messages) == "not json"
+        assert client.client.chat.completions.create.call_count == 1
+
+        # Неразобранный ответ (и ответ repair запроса) не кэшируется - повтор идёт в LLM
+        with patch.object(ai_client, "ANALYSIS_STREAMING", False):
+            client.analyze_file(Path("a.py"), "x = 1", "bug")
+            client.analyze_file(Path("a.py"), "x = 1", "bug")
+        assert client.client.chat.completions.create.call_count == 5
+        assert client.parse_metrics.get_stats()["analysis"]["failed"] == 2
+
+
+class TestQuotas:
+    """Тесты для квот installations (quotas.py)"""
+
+    def test_concurrent_job_limit_defers_jobs(self, any_db, tmp_path):
+        """Test jobs over an installation's job limit stay pending"""
+        from database import IssueStatus
+        from quotas import QuotaTracker
+        any_db.quota = QuotaTracker(str(tmp_path / "quota.sqlite3"), daily_tokens=0, max_jobs=1, overrides={})
+        first = any_db.add_issue("a/repo", 1, "A1", "", installation_id=1)
+        second = any_db.add_issue("b/repo", 1, "B1", "", installation_id=1)
+        other = any_db.add_issue("c/repo", 1, "C1", "", installation_id=2)
+
+        assert any_db.claim_next_issue("w1")["doc_id"] == first
+        assert any_db.claim_next_issue("w2")["doc_id"] == other
+        assert any_db.claim_next_issue("w3") is None
+        deferred = any_db.get_issue_by_id(second)
+        assert deferred["status"] == IssueStatus.PENDING
+        assert deferred["attempts"] == 0
+
+        any_db.set_completed(first, pr_number=5)
+        assert any_db.claim_next_issue("w3")["doc_id"] == second
+
+    def test_daily_token_budget_defers_jobs(self, any_db, tmp_path):
+        """Test an installation over its daily budget is skipped and reported"""
+        from quotas import QuotaTracker
+        any_db.quota = QuotaTracker(
+            str(tmp_path / "quota.sqlite3"),
+            daily_tokens=1000,
+            max_jobs=0,
+            overrides={"2": {"daily_tokens": 5000}}
+        )
+        any_db.add_issue("a/repo", 1, "A1", "", installation_id=1)
+        other = any_db.add_pr_review("b/repo", 1, [], installation_id=2)
+        any_db.quota.record("installation:1", 1200)
+        any_db.quota.record("installation:2", 1200)
+
+        assert any_db.claim_next_issue("w1") is None
+        assert any_db.claim_next_pr_review("w1")["doc_id"] == other
+
+        quotas = any_db.get_quotas()
+        assert quotas["installation:1"]["tokens_remaining"] == 0
+        assert quotas["installation:2"]["tokens_remaining"] == 3800
+        assert quotas["installation:2"]["active_jobs"] == 1
+        assert quotas["installation:2"]["max_jobs"] is None
+
+    def test_llm_usage_is_charged_to_job_installation(self, tmp_path):
+        """Test AIClient records tokens for the job in scope, also from pool threads"""
+        import contextvars
+        from concurrent.futures import ThreadPoolExecutor
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+            import ai_client
+        from quotas import QuotaTracker, quota_scope
+        from rate_limiter import RateLimiter
+
+        client = ai_client.AIClient.__new__(ai_client.AIClient)
+        client.model = "test"
+        client.client = Mock()
+        client.client.chat.completions.create.return_value = Mock(
+            usage=Mock(total_tokens=300), choices=[Mock(message=Mock(content="hi"))]
+        )
+        client.rate_limiter = RateLimiter(str(tmp_path / "rate.sqlite3"), rpm=0, tpm=0)
+        client.quota = QuotaTracker(str(tmp_path / "rate.sqlite3"), overrides={})
+        client.cache = None
+        messages = [{"role": "user", "content": "hello"}]
+
+        client._call(messages)  # вне задачи - не списывается
+        with quota_scope({"repo": "a/repo", "installation_id": 7}):
+            client._call(messages)
+            with ThreadPoolExecutor(2) as pool:
+                futures = [pool.submit(contextvars.copy_context().run, client._call, messages) for _ in range(2)]
+                [future.result() for future in futures]
+
+        assert client.quota.used_today() == {"installation:7": 900}
+
+
 class TestAIClient:
     """Тесты для ai_client.py"""
     
@@ -163,6 +1392,198 @@ class TestAIClient:
         assert "notes" in result
         assert result["issue_solved"] is True
 
+    def test_stream_reader_parses_fields_incrementally(self):
+        """Test JSONStreamReader reports top-level fields as soon as they are complete"""
+        from json_stream import JSONStreamReader
+        text = '```json\n{"issue_found": false, "score": 125, "explanation": "a \\"quoted\\" {x}", "edits": []}'
+        reader = JSONStreamReader()
+        seen = []
+        for char in text:
+            values = reader.feed(char)
+            if values and list(values) != seen:
+                seen = list(values)
+                if seen == ["issue_found"]:
+                    assert reader.text.endswith("false")
+
+        assert reader.values == {"issue_found": False, "score": 125, "explanation": 'a "quoted" {x}', "edits": []}
+        assert JSONStreamReader().feed('{"score": 12') == {}
+
+    def _stream(self, parts, consumed, total_tokens=None):
+        def chunks():
+            for part in parts:
+                consumed.append(part)
+                yield Mock(usage=None, choices=[Mock(delta=Mock(content=part))])
+            yield Mock(usage=Mock(total_tokens=total_tokens), choices=[])
+
+        stream = MagicMock()
+        stream.__iter__.return_value = chunks()
+        return stream
+
+    def test_stream_is_cancelled_when_no_issue(self, tmp_path):
+        """Test analyze_file stops the stream at issue_found false and reads the whole fix otherwise"""
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+            import ai_client
+        from llm_metrics import ParseMetrics
+        from quotas import QuotaTracker, quota_scope
+        from rate_limiter import RateLimiter
+
+        consumed = []
+        no_issue = self._stream(['{"issue_found"', ': false', ', "explanation": "', "long text"], consumed)
+        fixed = ['{"issue_found": true, "code_correction": "x = 2", ', '"explanation": "fixed"}']
+        client = ai_client.AIClient.__new__(ai_client.AIClient)
+        client.model = "test"
+        client.client = Mock()
+        client.client.chat.completions.create.side_effect = [no_issue, self._stream(fixed, [], total_tokens=500)]
+        client.rate_limiter = RateLimiter(str(tmp_path / "rate.sqlite3"), rpm=0, tpm=0)
+        client.quota = QuotaTracker(str(tmp_path / "rate.sqlite3"), overrides={})
+        client.cache = None
+        client.parse_metrics = ParseMetrics(str(tmp_path / "rate.sqlite3"))
+
+        with quota_scope({"repo": "a/repo", "installation_id": 1}):
+            result = client.analyze_file(Path("a.py"), "x = 1", "bug", mode="full")
+            assert result.issue_found is False
+            assert consumed == ['{"issue_found"', ': false']
+            no_issue.close.assert_called_once()
+            assert client.client.chat.completions.create.call_args.kwargs["stream"] is True
+            estimated = client.quota.used_today()["installation:1"]
+            assert 0 < estimated < 1024
+
+            result = client.analyze_file(Path("a.py"), "x = 1", "bug", mode="full")
+        assert (result.issue_found, result.code_correction, result.explanation) == (True, "x = 2", "fixed")
+        assert client.quota.used_today()["installation:1"] == estimated + 500
+
+    def test_async_client_runs_requests_concurrently(self, tmp_path):
+        """Test AsyncAIClient keeps requests in flight together and cancels on timeout"""
+        import asyncio
+        import time
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+            import ai_client
+        from llm_metrics import ParseMetrics
+        from rate_limiter import RateLimiter
+
+        async def create(**kwargs):
+            prompt = kwargs["messages"][0]["content"]
+            await asyncio.sleep(5 if "slow.py" in prompt else 0.2)
+            return Mock(usage=None, choices=[Mock(message=Mock(content='{"issue_found": false}'))])
+
+        client = ai_client.AsyncAIClient.__new__(ai_client.AsyncAIClient)
+        client.model = "test"
+        client.client = Mock()
+        client.client.chat.completions.create = create
+        client.rate_limiter = RateLimiter(str(tmp_path / "rate.sqlite3"), rpm=0, tpm=0)
+        client.cache = None
+        client.parse_metrics = ParseMetrics(str(tmp_path / "rate.sqlite3"))
+        client.semaphore = asyncio.Semaphore(8)
+
+        async def scan():
+            files = [Path(f"f{i}.py") for i in range(8)]
+            return await asyncio.gather(
+                *(client.analyze_file(path, "x = 1", "bug") for path in files),
+                client.analyze_file(Path("slow.py"), "x = 1", "bug", timeout=0.5)
+            )
+
+        started = time.monotonic()
+        with patch.object(ai_client, "ANALYSIS_STREAMING", False):
+            results = asyncio.run(scan())
+        elapsed = time.monotonic() - started
+
+        assert [r.issue_found for r in results] == [False] * 9
+        assert "TimeoutError" in results[-1].explanation
+        assert elapsed < 1.5
+
+    def test_async_client_waits_for_budget_without_blocking(self, tmp_path):
+        """Test AsyncAIClient sleeps on the event loop while the rate limiter is blocked"""
+        import asyncio
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+            import ai_client
+        from rate_limiter import RateLimiter
+
+        # Общая часть вынесена в BaseAIClient - async клиент не подменяет sync методы
+        assert not issubclass(ai_client.AsyncAIClient, ai_client.AIClient)
+
+        client = ai_client.AsyncAIClient.__new__(ai_client.AsyncAIClient)
+        client.rate_limiter = RateLimiter(str(tmp_path / "rate.sqlite3"), rpm=10, tpm=0)
+        client.rate_limiter.block(0.5)
+        ticks = []
+
+        async def scenario():
+            async def tick():
+                while True:
+                    ticks.append(1)
+                    await asyncio.sleep(0.05)
+
+            ticker = asyncio.create_task(tick())
+            waited = await client._acquire(100)
+            ticker.cancel()
+            return waited
+
+        assert asyncio.run(scenario()) >= 0.4
+        # Пока клиент ждал бюджет, event loop выполнял другие задачи
+        assert len(ticks) >= 5
+
+    def test_async_client_is_per_event_loop(self):
+        """Test each asyncio.run gets its own AsyncAIClient and the base class is abstract"""
+        import asyncio
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+            import ai_client
+
+        with pytest.raises(TypeError):
+            ai_client.BaseAIClient()
+
+        async def current():
+            first = ai_client.get_async_ai_client()
+            assert ai_client.get_async_ai_client() is first
+            return first
+
+        assert asyncio.run(current()) is not asyncio.run(current())
+
+    def test_json_is_extracted_from_noisy_responses(self):
+        """Test extract_json skips fences and prose and accepts raw newlines in strings"""
+        from json_stream import extract_json
+        noisy = 'Sure! Here is the result:\n```json\n{"issue_found": true, "code_correction": "a\nb", "n": {"x": 1}}\n```\nHope it helps {}'
+        assert extract_json(noisy) == {"issue_found": True, "code_correction": "a\nb", "n": {"x": 1}}
+        assert extract_json('use {braces} then {"approved": false}') == {"approved": False}
+        with pytest.raises(ValueError):
+            extract_json('{"approved": tru')
+
+    def test_unparseable_response_is_repaired_once(self, tmp_path):
+        """Test a bad response triggers one repair request, is cached fixed and counted"""
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+            import ai_client
+        from llm_cache import LLMCache
+        from llm_metrics import ParseMetrics
+        from rate_limiter import RateLimiter
+
+        def reply(content):
+            return Mock(usage=None, choices=[Mock(message=Mock(content=content))])
+
+        client = ai_client.AIClient.__new__(ai_client.AIClient)
+        client.model = "test"
+        client.client = Mock()
+        client.client.chat.completions.create.side_effect = [
+            reply("I think the PR looks fine overall."),
+            reply('{"approved": true, "summary": "ok", "issues": [], "suggestions": []}'),
+        ]
+        client.rate_limiter = RateLimiter(str(tmp_path / "rate.sqlite3"), rpm=0, tpm=0)
+        client.cache = LLMCache(str(tmp_path / "cache.sqlite3"), max_bytes=4096, ttl=60)
+        client.parse_metrics = ParseMetrics(str(tmp_path / "rate.sqlite3"))
+
+        with patch.object(ai_client, "LLM_RESPONSE_FORMAT", "json_schema"):
+            result = client.review_pr("diff", ["a.py"])
+            again = client.review_pr("diff", ["a.py"])
+
+        assert result.approved is True and again.summary == "ok"
+        calls = client.client.chat.completions.create.call_args_list
+        assert len(calls) == 2
+        assert calls[0].kwargs["response_format"]["json_schema"]["name"] == "review"
+        repair = calls[1].kwargs["messages"]
+        assert repair[-2] == {"role": "assistant", "content": "I think the PR looks fine overall."}
+        assert "could not be parsed" in repair[-1]["content"]
+
+        stats = client.parse_metrics.get_stats()["review"]
+        assert (stats["ok"], stats["repaired"], stats["failed"]) == (1, 1, 0)
+        assert stats["parse_failure_rate"] == 0.5
+
 
 class TestRepoManager:
     """Тесты для repo_manager.py"""
@@ -234,11 +1655,108 @@ class TestPRReviewer:
         
         passed_count = sum(1 for r in review_results if r["issue_solved"])
         assert passed_count == 2
+    
+    def test_files_are_reviewed_concurrently_in_order(self):
+        """Test parallel review keeps file order and isolates failures"""
+        import time
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+            import pr_reviewer
+        
+        def get_contents(path, ref):
+            if path == "broken.py":
+                raise RuntimeError("404")
+            return Mock(decoded_content=path.encode())
+        
+        def slow_review(content, path, description):
+            time.sleep(0.2)
+            return {"issue_solved": path != "b.py", "notes": f"notes for {path}"}
+        
+        repo = Mock()
+        repo.get_contents.side_effect = get_contents
+        repo.get_pull.return_value = Mock(title="PR", body="Fix", head=Mock(sha="abc"))
+        files = ["a.py", "b.py", "broken.py", "c.py"]
+        
+        with patch.dict(os.environ, {"GITHUB_TOKEN": "t"}), \
+                patch.object(pr_reviewer, "Github") as github, \
+                patch.object(pr_reviewer, "review_file_for_issue", side_effect=slow_review), \
+                patch.object(pr_reviewer, "PR_REVIEW_CONCURRENCY", 4):
+            github.return_value.get_repo.return_value = repo
+            started = time.monotonic()
+            result = pr_reviewer.review_pr_files(1, "owner/repo", files)
+            elapsed = time.monotonic() - started
+        
+        assert elapsed < 0.5
+        assert [r["file"] for r in result["review_results"]] == files
+        assert [r["issue_solved"] for r in result["review_results"]] == [True, False, False, True]
+        assert "Could not fetch" in result["review_results"][2]["notes"]
+        assert result["all_passed"] is False
+
+    def test_superseded_review_stops_early(self):
+        """Test a newer push skips remaining files and the PR comment"""
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+            import pr_reviewer
+
+        reviewed = []
+
+        def review(content, path, description):
+            reviewed.append(path)
+            return {"issue_solved": True, "notes": "OK"}
+
+        repo = Mock()
+        repo.get_contents.return_value = Mock(decoded_content=b"code")
+        pr = Mock(title="PR", body="Fix", head=Mock(sha="abc12345"))
+        repo.get_pull.return_value = pr
+
+        with patch.dict(os.environ, {"GITHUB_TOKEN": "t"}), \
+                patch.object(pr_reviewer, "Github") as github, \
+                patch.object(pr_reviewer, "review_file_for_issue", side_effect=review), \
+                patch.object(pr_reviewer, "PR_REVIEW_CONCURRENCY", 1):
+            github.return_value.get_repo.return_value = repo
+            result = pr_reviewer.review_pr_files(
+                1, "owner/repo", ["a.py", "b.py", "c.py"], superseded=lambda: len(reviewed) >= 1
+            )
+
+        assert result["superseded"] is True
+        assert result["success"] is False
+        assert reviewed == ["a.py"]
+        pr.create_issue_comment.assert_not_called()
 
 
 class TestServer:
     """Тесты для server.py"""
     
+    def test_handlers_read_db_off_the_event_loop(self):
+        """Test health and issue listings call the database from a threadpool"""
+        import asyncio
+        import threading
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+            import server
+        
+        threads = []
+        
+        def record(result):
+            def call(*args, **kwargs):
+                threads.append(threading.current_thread())
+                return result
+            return call
+        
+        fake_db = Mock()
+        fake_db.get_stats.side_effect = record({"pending": 0})
+        fake_db.get_pool_status.side_effect = record({})
+        fake_db.get_all.side_effect = record([])
+        fake_db.get_pending_issues.side_effect = record([])
+        
+        async def scenario():
+            await server.health()
+            await server.list_issues()
+            await server.list_pending()
+            return threading.current_thread()
+        
+        with patch.object(server, "db", fake_db):
+            loop_thread = asyncio.run(scenario())
+        assert len(threads) == 5
+        assert loop_thread not in threads
+    
     def test_webhook_signature_verification(self):
         """Test webhook signature verification logic"""
         import hmac
@@ -321,6 +1839,156 @@ class TestWorker:
         # Default should be 3
         default_max = 3
         assert default_max == 3
+    
+    def test_pool_drains_children_on_stop(self):
+        """Test pool forwards SIGTERM to every child and waits for them"""
+        import multiprocessing
+        import time
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+            from worker import WorkerPool
+        
+        pool = WorkerPool(concurrency=2)
+        context = multiprocessing.get_context("fork")
+        pool.children = [context.Process(target=time.sleep, args=(30,)) for _ in range(2)]
+        for child in pool.children:
+            child.start()
+        
+        pool.stop()
+        
+        assert all(not child.is_alive() for child in pool.children)
+        assert [child.exitcode for child in pool.children] == [-15, -15]
+    
+    def test_pool_backs_off_crashing_children(self):
+        """Test a child that dies on start is restarted with a growing delay"""
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+            import worker
+        
+        dead = Mock(pid=1, exitcode=1)
+        dead.is_alive.return_value = False
+        pool = worker.WorkerPool(concurrency=1)
+        pool.running = True
+        pool.children = [dead]
+        clock = [100.0]
+        
+        with patch.object(pool, "_spawn", return_value=dead) as spawn, \
+                patch.object(worker.time, "monotonic", side_effect=lambda: clock[0]):
+            pool._spawned_at[dead] = clock[0]
+            pool._respawn_dead()
+            assert spawn.call_count == 1  # первое падение - сразу
+            pool._respawn_dead()
+            assert spawn.call_count == 1  # второе подряд - через 1s
+            clock[0] += 1
+            pool._respawn_dead()
+            assert spawn.call_count == 2
+            pool._respawn_dead()
+            clock[0] += 2
+            pool._respawn_dead()
+            assert spawn.call_count == 2  # третье - через 3s
+            clock[0] += 1
+            pool._respawn_dead()
+            assert spawn.call_count == 3
+        assert pool._crashes[0] == 3
+    
+    def test_process_one_fails_job_on_error(self, tmp_path):
+        """Test run-once mode marks a crashed issue failed instead of leaving it PROCESSING"""
+        from database import IssueDB, IssueStatus
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+            import worker
+        
+        test_db = IssueDB(str(tmp_path / "db.json"))
+        doc_id = test_db.add_issue("a/repo", 1, "Issue", "")
+        with patch.object(worker, "db", test_db), \
+                patch.object(worker, "process_issue_from_db", side_effect=RuntimeError("boom")):
+            assert worker.Worker(worker_id="w1").process_one() is None
+        
+        issue = test_db.get_issue_by_id(doc_id)
+        assert issue["status"] == IssueStatus.PENDING
+        assert issue["lease_owner"] is None
+        assert issue["error"] == "boom"
+    
+    def test_autoscaler_hysteresis(self):
+        """Test pool grows at once but shrinks only after a quiet period"""
+        from autoscale import Autoscaler
+        scaler = Autoscaler(min_workers=1, max_workers=4, jobs_per_worker=2, down_delay=60)
+        
+        assert scaler.desired(pending=0, active=0, current=1, now=0) == 1
+        assert scaler.desired(pending=12, active=0, current=1, now=1) == 4
+        # Очередь разобрана - размер держится down_delay секунд
+        assert scaler.desired(pending=0, active=1, current=4, now=10) == 4
+        assert scaler.desired(pending=0, active=1, current=4, now=50) == 4
+        # Всплеск посреди паузы сбрасывает отсчёт
+        assert scaler.desired(pending=7, active=1, current=4, now=55) == 4
+        assert scaler.desired(pending=0, active=1, current=4, now=100) == 4
+        assert scaler.desired(pending=0, active=1, current=4, now=161) == 1
+    
+    def test_pool_scales_with_queue_and_drains(self, tmp_path):
+        """Test pool spawns on backlog, drains extra processes and reports its size"""
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+            import worker
+        from database import IssueDB
+        from autoscale import Autoscaler
+        
+        test_db = IssueDB(str(tmp_path / "db.json"))
+        for number in range(6):
+            test_db.add_issue("a/repo", number, "Issue", "")
+        
+        class FakeProcess:
+            def __init__(self, pid):
+                self.pid = pid
+                self.alive = True
+            
+            def is_alive(self):
+                return self.alive
+        
+        spawned = []
+        
+        def spawn():
+            spawned.append(FakeProcess(1000 + len(spawned)))
+            return spawned[-1]
+        
+        pool = worker.WorkerPool(concurrency=1, max_concurrency=3)
+        pool.autoscaler = Autoscaler(1, 3, jobs_per_worker=2, down_delay=0)
+        pool.children = [spawn()]
+        with patch.object(worker, "db", test_db), \
+                patch.object(pool, "_spawn", side_effect=spawn), \
+                patch.object(worker.os, "kill") as kill:
+            pool._autoscale()
+            assert len(pool.children) == 3
+            assert test_db.get_pool_status()["issues"]["size"] == 3
+            
+            for issue in test_db.get_pending_issues():
+                test_db.set_completed(issue["doc_id"], pr_number=1)
+            pool._autoscale()
+        
+        assert len(pool.children) == 1
+        assert [p.pid for p in pool.draining] == [1002, 1001]
+        assert kill.call_count == 2
+        status = test_db.get_pool_status()["issues"]
+        assert status["size"] == 1
+        assert status["draining"] == 2
+    
+    def test_coalesced_session_shares_one_clone(self, tmp_path):
+        """Test coalesced issues of one repo reuse a single RepoManager"""
+        from database import IssueDB
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+            import worker
+        
+        test_db = IssueDB(str(tmp_path / "db.json"), backend="tinydb", group_commit_ms=0)
+        for n in (1, 2):
+            test_db.add_issue("a/repo", n, f"Issue {n}", "")
+        
+        with patch.object(worker, "db", test_db), \
+                patch.object(worker, "COALESCE_REPO_JOBS", True), \
+                patch.object(worker, "RepoManager") as repo_manager, \
+                patch.object(worker, "process_issue_from_db", return_value=10) as process:
+            w = worker.Worker()
+            w.running = True
+            assert w._process_pending() is True
+        
+        repo_manager.assert_called_once_with("a/repo")
+        assert [c.args[1] for c in process.call_args_list] == [repo_manager.return_value] * 2
+        repo_manager.return_value.cleanup.assert_called_once()
+        assert w.processed_count == 2
 
 
 class TestCLI: